@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制
+流量突增时尽早拒绝处理不了的请求，而不是让它们堆积在执行器前直到客户端超时：
+- AdmissionController：限制同时执行的代码数量，超出的请求在有界队列中按顺序等待，
+  队列已满或等待超过期限时立即拒绝，并根据近期的执行耗时估算Retry-After
+- RateLimiter：按客户端（nginx传入的X-Real-IP）的令牌桶限流，客户端数量有上限
+- cancel_on_disconnect：客户端断开连接时取消仍在排队或执行的请求
+所有状态只在事件循环线程中访问，不需要加锁
+"""
+
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入"""
+
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ClientDisconnected(Exception):
+    """客户端已断开连接，请求被取消"""
+
+
+class AdmissionController:
+    """
+    并发执行数限制和有界等待队列
+
+    参数:
+    - max_in_flight: 最多同时执行的请求数
+    - max_queue: 最多排队等待的请求数，超出时立即拒绝
+    - queue_timeout: 排队等待的最长时间（秒），超过后拒绝
+    """
+
+    def __init__(self, max_in_flight, max_queue, queue_timeout):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = deque()
+        # 近期单个请求执行耗时的指数移动平均，用于估算Retry-After
+        self._service_time = 1.0
+        self._admitted = 0
+        self._rejected = {'queue_full': 0, 'queue_timeout': 0}
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def saturated(self):
+        """执行槽和等待队列是否都已占满"""
+        return self.in_flight >= self.max_in_flight and len(self._waiters) >= self.max_queue
+
+    def retry_after(self):
+        """估算排在队尾的请求需要等待的秒数"""
+        backlog = len(self._waiters) + 1
+        return max(1, math.ceil(self._service_time * backlog / self.max_in_flight))
+
+    def _reject(self, reason, message):
+        self._rejected[reason] += 1
+        return AdmissionRejected(message, reason, self.retry_after())
+
+    async def acquire(self, bounded=True):
+        """
+        获取一个执行槽
+
+        参数:
+        - bounded: 为False时不受队列长度和等待期限限制（用于已被接受的批量请求中的各项）
+
+        返回:
+        - 排队等待的秒数
+        """
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self._admitted += 1
+            return 0.0
+        if bounded and len(self._waiters) >= self.max_queue:
+            raise self._reject('queue_full', "服务繁忙，等待队列已满，请稍后重试")
+
+        queued_at = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout if bounded else None)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # 执行槽已经转交过来，但请求不再需要，交给下一个等待者
+                self.release()
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(
+                    'queue_timeout', f"服务繁忙，排队超过{self.queue_timeout:g}秒未能执行，请稍后重试"
+                ) from None
+            raise
+        self._admitted += 1
+        return time.perf_counter() - queued_at
+
+    def release(self, service_time=None):
+        """
+        释放执行槽；有等待者时直接转交给最早的等待者
+
+        参数:
+        - service_time: 本次执行的耗时（秒），用于估算Retry-After
+        """
+        if service_time is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        """返回准入控制状态"""
+        return {
+            'max_in_flight': self.max_in_flight,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'queued': len(self._waiters),
+            'admitted': self._admitted,
+            'rejected': dict(self._rejected)
+        }
+
+
+class RateLimiter:
+    """
+    按客户端的令牌桶限流
+
+    参数:
+    - rate: 每秒补充的令牌数，不大于0时不限流
+    - burst: 令牌桶容量，即允许的突发请求数
+    - max_clients: 最多记录的客户端数量，超出时淘汰最久未访问的客户端
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        # 客户端 -> (剩余令牌数, 上次更新时间)
+        self._buckets = OrderedDict()
+        self._limited = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def check(self, client, cost=1):
+        """
+        消耗令牌
+
+        返回:
+        - 0表示允许；否则为需要等待的秒数（向上取整）
+        """
+        if not self.enabled:
+            return 0
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens >= cost:
+            tokens -= cost
+            wait = 0
+        else:
+            wait = max(1, math.ceil((cost - tokens) / self.rate))
+            self._limited += 1
+        self._buckets[client] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        """返回限流状态"""
+        return {
+            'enabled': self.enabled,
+            'clients': len(self._buckets),
+            'limited': self._limited
+        }
+
+
+async def cancel_on_disconnect(receive, awaitable):
+    """
+    执行awaitable，客户端断开连接时取消它
+
+    参数:
+    - receive: ASGI的receive函数；请求体已读取完毕后，只有断开连接时才会返回消息
+    - awaitable: 要执行的协程
+
+    返回:
+    - awaitable的结果；客户端断开时抛出ClientDisconnected
+    """
+    task = asyncio.ensure_future(awaitable)
+
+    async def wait_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    watcher = asyncio.ensure_future(wait_disconnect())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        task.cancel()
+        watcher.cancel()
+        raise
+    watcher.cancel()
+    if task.done():
+        return task.result()
+    task.cancel()
+    # 等待任务完成取消处理（结束正在执行的工作进程、记录日志）
+    await asyncio.wait({task})
+    raise ClientDisconnected("客户端已断开连接")
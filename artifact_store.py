@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片文件存储
+picture/ 下的生成文件按内容寻址保存：
+- 文件名为图片内容的哈希，相同内容只保存一份，不同请求之间不会互相覆盖
+- 按哈希前缀分两级子目录存放，避免单个目录中文件过多导致查找变慢
+- 先写临时文件再重命名，下载时不会读到写了一半的文件
+- 后台回收按文件年龄和总磁盘预算清理旧文件
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+
+# 内容哈希的长度（十六进制字符数）
+DIGEST_LENGTH = 32
+
+_ARTIFACT_NAME = re.compile(r'^([0-9a-f]{%d})\.[a-z]+$' % DIGEST_LENGTH)
+_DERIVATIVE_NAME = re.compile(r'^thumb_([0-9a-f]{%d})_\d+x\d+\.[a-z]+$' % DIGEST_LENGTH)
+# 分片之前的平铺文件名（output_时间戳.png 等），仍然可以下载
+_LEGACY_NAME = re.compile(r'^[\w\-]+\.[a-z]+$')
+
+# 不参与回收的子目录（渲染缓存索引）
+_SKIP_DIRS = {'index'}
+
+# 临时文件超过该时间仍未重命名，视为写入中断的残留文件
+_STALE_TMP_SECONDS = 3600
+
+
+class ArtifactStore:
+    """内容寻址、分片存放的图片文件存储"""
+
+    def __init__(self, directory='picture', max_bytes=2048 * 1024 * 1024, max_age=7 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+        self.writes = 0
+        self.dedup_hits = 0
+        self.collected_files = 0
+        self.collected_bytes = 0
+        self.total_bytes = None
+        self.total_files = None
+
+    @staticmethod
+    def digest(data):
+        """图片内容的哈希"""
+        return hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH]
+
+    def shard_dir(self, digest):
+        """哈希对应的分片目录"""
+        return os.path.join(self.directory, digest[:2], digest[2:4])
+
+    def put(self, data, extension='png'):
+        """
+        保存图片（阻塞IO，应在线程池中调用）
+        相同内容的文件已存在时直接复用，只刷新修改时间
+
+        返回:
+        - 文件名（不含目录），用于构造下载链接
+        """
+        digest = self.digest(data)
+        filename = f"{digest}.{extension}"
+        shard = self.shard_dir(digest)
+        path = os.path.join(shard, filename)
+
+        if os.path.exists(path):
+            # 刷新修改时间，避免仍在使用的文件被按年龄回收
+            os.utime(path)
+            with self._lock:
+                self.dedup_hits += 1
+            return filename
+
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self._write(shard, tmp_path, data)
+        except FileNotFoundError:
+            # 分片目录恰好被回收删除，重建后再写一次
+            self._write(shard, tmp_path, data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.writes += 1
+            if self.total_bytes is not None:
+                self.total_bytes += len(data)
+                self.total_files += 1
+        return filename
+
+    def path_for(self, filename):
+        """
+        下载文件名对应的磁盘路径，文件名不合法时返回None
+        同时支持分片前的平铺文件名
+        """
+        match = _ARTIFACT_NAME.match(filename) or _DERIVATIVE_NAME.match(filename)
+        if match:
+            return os.path.join(self.shard_dir(match.group(1)), filename)
+        if _LEGACY_NAME.match(filename):
+            return os.path.join(self.directory, filename)
+        return None
+
+    def etag_for(self, filename):
+        """
+        内容寻址文件的ETag（不含引号）：文件名本身由内容决定，不需要读取文件
+        其他文件返回None
+        """
+        if _ARTIFACT_NAME.match(filename) or _DERIVATIVE_NAME.match(filename):
+            return os.path.splitext(filename)[0]
+        return None
+
+    def collect(self):
+        """
+        回收旧文件（阻塞IO，应在线程池中调用）
+        先删除超过保存期限的文件，总大小仍超出预算时从最旧的文件开始删除
+        """
+        now = time.time()
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                dirs[:] = [d for d in dirs if d not in _SKIP_DIRS]
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    if now - stat.st_mtime > _STALE_TMP_SECONDS:
+                        self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed_files = 0
+        removed_bytes = 0
+        # 清理到预算的90%，避免每轮回收都刚好卡在预算线上
+        target = self.max_bytes * 0.9
+        for mtime, size, path in entries:
+            expired = now - mtime > self.max_age
+            if not expired and total <= target:
+                break
+            if self._remove(path):
+                total -= size
+                removed_files += 1
+                removed_bytes += size
+
+        self._remove_empty_shards()
+        with self._lock:
+            self.total_bytes = total
+            self.total_files = len(entries) - removed_files
+            self.collected_files += removed_files
+            self.collected_bytes += removed_bytes
+        return removed_files, removed_bytes
+
+    def stats(self):
+        """返回存储统计"""
+        with self._lock:
+            return {
+                'writes': self.writes,
+                'dedup_hits': self.dedup_hits,
+                'collected_files': self.collected_files,
+                'collected_bytes': self.collected_bytes,
+                'total_files': self.total_files,
+                'total_bytes': self.total_bytes
+            }
+
+    def _write(self, shard, tmp_path, data):
+        """写入临时文件"""
+        os.makedirs(shard, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+    def _remove(self, path):
+        """删除文件，文件不存在时返回False"""
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _remove_empty_shards(self):
+        """删除空的分片目录"""
+        # 自底向上遍历，子目录删除后上一级目录也可能变空；非空目录rmdir会失败，直接跳过
+        for root, dirs, files in os.walk(self.directory, topdown=False):
+            if root == self.directory or os.path.basename(root) in _SKIP_DIRS:
+                continue
+            if os.path.relpath(root, self.directory).split(os.sep)[0] in _SKIP_DIRS:
+                continue
+            if not files:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
@@ -0,0 +1,594 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基准测试
+对 /execute-code 施加可重复的并发负载，测量吞吐量和延迟分位数，结果写入JSON文件便于对比：
+- 默认在本进程中启动一个uvicorn实例（127.0.0.1的空闲端口），也可以用 --url 测试已运行的服务
+- 负载为按权重混合的代码片段：README中的正弦图和2x2子图示例、大量点的散点图、执行出错和未生成图片，
+  请求顺序由 --seed 决定，相同的参数得到相同的请求序列
+- 端到端延迟在客户端测量；各阶段耗时（排队、预处理、执行、渲染、写入）从服务的JSON日志中读取
+- 运行期间采样服务进程及其执行进程的常驻内存，并统计图片和任务状态目录的磁盘占用变化
+- compare 对比两次结果，延迟或吞吐量变差超过阈值时以非0状态退出，可用于发布前检查
+
+用法:
+    python3 benchmark.py run --requests 200 --concurrency 8 --output bench.json
+    python3 benchmark.py run --url http://localhost:8000 --pid 12345 --output bench.json
+    python3 benchmark.py compare baseline.json bench.json --threshold 0.1
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+# 代码片段：名称 -> (代码, 期望的状态码)
+SNIPPETS = {
+    'sine': ("""
+import matplotlib.pyplot as plt
+import numpy as np
+
+x = np.linspace(0, 10, 100)
+y = np.sin(x)
+
+plt.figure(figsize=(10, 6))
+plt.plot(x, y, 'b-', linewidth=2)
+plt.title('正弦函数图')
+plt.xlabel('x')
+plt.ylabel('sin(x)')
+plt.grid(True)
+plt.show()
+""", 200),
+    'subplots': ("""
+import matplotlib.pyplot as plt
+import numpy as np
+
+np.random.seed(42)
+data = np.random.randn(1000)
+
+plt.figure(figsize=(12, 8))
+
+plt.subplot(2, 2, 1)
+plt.hist(data, bins=30, alpha=0.7, color='skyblue')
+plt.title('直方图')
+
+plt.subplot(2, 2, 2)
+plt.scatter(np.arange(len(data)), data, alpha=0.5, s=20)
+plt.title('散点图')
+
+plt.subplot(2, 2, 3)
+plt.boxplot(data)
+plt.title('箱线图')
+
+plt.subplot(2, 2, 4)
+plt.plot(np.cumsum(data), 'g-', linewidth=1)
+plt.title('累积和')
+
+plt.tight_layout()
+plt.show()
+""", 200),
+    'scatter': ("""
+import matplotlib.pyplot as plt
+import numpy as np
+
+rng = np.random.default_rng(7)
+x = rng.standard_normal(200000)
+y = x * 0.5 + rng.standard_normal(200000)
+
+plt.figure(figsize=(8, 6))
+plt.scatter(x, y, s=1, alpha=0.2)
+plt.title('heavy scatter')
+plt.show()
+""", 200),
+    'error': ("""
+import matplotlib.pyplot as plt
+plt.plot([1, 2, 3])
+print(undefined_variable)
+""", 400),
+    'no_figure': ("""
+import numpy as np
+print(np.arange(10).sum())
+""", 400),
+}
+
+# 默认的混合权重
+DEFAULT_MIX = 'sine=4,subplots=3,scatter=1,error=1,no_figure=1'
+
+# 各阶段耗时的名称，与日志中timings的键一致
+PHASES = ('queue_wait', 'preprocess', 'exec', 'render', 'write')
+
+# 等待服务把请求的结束记录写入日志的最长时间（秒）
+LOG_WAIT_TIMEOUT = 5.0
+
+# 内存采样间隔（秒）
+RSS_SAMPLE_INTERVAL = 0.5
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def parse_mix(value):
+    """解析 名称=权重 的逗号分隔列表"""
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in SNIPPETS:
+            raise argparse.ArgumentTypeError(f"未知的代码片段: {name}（可选: {', '.join(SNIPPETS)}）")
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"无效的权重: {item}")
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError("至少需要一个权重大于0的代码片段")
+    return mix
+
+
+def summarize(values):
+    """计算数量、平均值、分位数和最大值（秒）"""
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def percentile(q):
+        # 最近秩法
+        return values[min(len(values), max(1, math.ceil(q * len(values)))) - 1]
+
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(0.50),
+        'p90': percentile(0.90),
+        'p99': percentile(0.99),
+        'max': values[-1]
+    }
+
+
+def process_tree_rss(pid):
+    """进程及其全部子进程的常驻内存总和（字节）；无法读取/proc时返回None"""
+    total = 0
+    pending = [pid]
+    seen = set()
+    while pending:
+        current = pending.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        try:
+            with open(f'/proc/{current}/statm', 'r') as f:
+                total += int(f.read().split()[1]) * _PAGE_SIZE
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children', 'r') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            if current == pid:
+                return None
+    return total
+
+
+def directory_usage(path):
+    """目录下文件的数量和总大小（字节）"""
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                pass
+    return {'files': files, 'bytes': size}
+
+
+class RssSampler:
+    """在后台线程中定期采样进程树的常驻内存"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(RSS_SAMPLE_INTERVAL)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if not self.samples:
+            return None
+        return {
+            'start_bytes': self.samples[0],
+            'peak_bytes': max(self.samples),
+            'end_bytes': self.samples[-1]
+        }
+
+
+class LocalServer:
+    """在本进程的后台线程中运行uvicorn和main.app"""
+
+    def __init__(self):
+        import uvicorn
+        import main
+
+        self.main = main
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=self.port, log_level='warning'))
+        self._thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout=120):
+        """启动服务并等待启动预热完成"""
+        self._thread.start()
+        deadline = time.time() + timeout
+        while not self.server.started:
+            if not self._thread.is_alive() or time.time() > deadline:
+                raise RuntimeError("本地服务启动失败")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self._thread.join(timeout=30)
+
+
+class Client:
+    """每个线程一个持久连接的HTTP客户端"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.https = parts.scheme == 'https'
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = cls(self.host, self.port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def request(self, method, path, payload=None):
+        """
+        发送请求并读取完整的响应
+
+        返回:
+        - (状态码, 响应体bytes)；连接失败时状态码为None
+        """
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                # 服务端关闭了空闲连接时重新连接一次
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    return None, b''
+
+
+def read_phase_timings(log_file, since):
+    """
+    从JSON日志中读取since之后结束的请求的各阶段耗时
+
+    返回:
+    - ({阶段: [秒数, ...]}, {结果: 数量})
+    """
+    from log_reader import line_time, log_files, open_log
+
+    phases = {phase: [] for phase in PHASES}
+    outcomes = {}
+    for path in log_files(log_file):
+        with open_log(path) as f:
+            for raw in f:
+                timestamp = line_time(raw)
+                if timestamp is None or timestamp < since or b'"phase": "total"' not in raw:
+                    continue
+                try:
+                    entry = json.loads(raw)
+                except ValueError:
+                    continue
+                outcome = entry.get('outcome')
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                for phase, seconds in (entry.get('timings') or {}).items():
+                    if phase in phases:
+                        phases[phase].append(seconds)
+    return phases, outcomes
+
+
+def environment():
+    """运行环境，便于判断两次结果是否可比"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit
+    }
+    for name in ('EXECUTOR_WORKERS', 'THREAD_EXECUTOR_WORKERS', 'SERVER_WORKERS', 'ADMISSION_MAX_IN_FLIGHT'):
+        if name in os.environ:
+            info[name] = os.environ[name]
+    return info
+
+
+def run_benchmark(args):
+    """执行一次基准测试，返回结果字典"""
+    mix = args.mix
+    rng = random.Random(args.seed)
+    names = [name for name in mix if mix[name] > 0]
+    sequence = rng.choices(names, weights=[mix[name] for name in names], k=args.warmup + args.requests)
+
+    server = None
+    pid = args.pid
+    url = args.url
+    if url is None:
+        print("🚀 启动本地服务...")
+        server = LocalServer()
+        server.start()
+        url = server.url
+        pid = os.getpid()
+    client = Client(url, args.timeout)
+
+    def send(name):
+        code, expected = SNIPPETS[name]
+        payload = {
+            'code': code,
+            'cache': args.cache,
+            'response_mode': args.response_mode,
+            'format': args.format
+        }
+        start = time.perf_counter()
+        status, _ = client.request('POST', '/execute-code', payload)
+        return name, expected, status, time.perf_counter() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            if args.warmup:
+                print(f"🔥 预热 {args.warmup} 个请求...")
+                list(pool.map(send, sequence[:args.warmup]))
+
+            data_dirs = {name: os.path.join(args.data_dir, name) for name in ('picture', args.job_dir)}
+            disk_before = {name: directory_usage(path) for name, path in data_dirs.items()}
+            sampler = RssSampler(pid) if pid else None
+            if sampler is not None:
+                sampler.start()
+            # 日志时间精确到毫秒，与日志格式一致以便按字符串比较
+            since = datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f')[:23]
+            print(f"📈 发送 {args.requests} 个请求，并发 {args.concurrency}...")
+            wall_start = time.perf_counter()
+            results = list(pool.map(send, sequence[args.warmup:]))
+            wall_time = time.perf_counter() - wall_start
+            rss = sampler.stop() if sampler is not None else None
+            disk_after = {name: directory_usage(path) for name, path in data_dirs.items()}
+
+        metrics = None
+        status, body = client.request('GET', '/metrics')
+        if status == 200:
+            metrics = parse_metrics(body.decode('utf-8'))
+    finally:
+        if server is not None:
+            server.stop()
+
+    latencies = [latency for _, _, _, latency in results]
+    by_case = {}
+    status_codes = {}
+    unexpected = 0
+    for name, expected, status, latency in results:
+        by_case.setdefault(name, []).append(latency)
+        key = str(status) if status is not None else 'connection_error'
+        status_codes[key] = status_codes.get(key, 0) + 1
+        if status != expected:
+            unexpected += 1
+
+    phases = None
+    outcomes = None
+    log_file = args.log_file
+    if log_file is None and server is not None:
+        import config
+        log_file = config.LOG_FILE
+    if log_file and os.path.exists(log_file):
+        # 服务的日志由后台线程写入，等待全部请求的结束记录写入文件
+        expected = sum(1 for _, _, status, _ in results if status is not None)
+        deadline = time.time() + LOG_WAIT_TIMEOUT
+        while True:
+            phase_values, outcomes = read_phase_timings(log_file, since)
+            if sum(outcomes.values()) >= expected or time.time() > deadline:
+                break
+            time.sleep(0.2)
+        phases = {phase: summarize(values) for phase, values in phase_values.items()}
+
+    return {
+        'benchmark': {
+            'url': None if server is not None else url,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'mix': mix,
+            'cache': args.cache,
+            'response_mode': args.response_mode,
+            'format': args.format
+        },
+        'environment': environment(),
+        'started_at': since,
+        'wall_time': wall_time,
+        'throughput_rps': len(results) / wall_time if wall_time > 0 else None,
+        'latency': summarize(latencies),
+        'latency_by_case': {name: summarize(values) for name, values in sorted(by_case.items())},
+        'phases': phases,
+        'outcomes': outcomes,
+        'status_codes': status_codes,
+        'unexpected_status': unexpected,
+        'rss': rss,
+        'executor_rss_bytes': (metrics or {}).get('code_exec_executor_rss_bytes'),
+        'disk': {
+            name: {
+                'files': disk_after[name]['files'] - disk_before[name]['files'],
+                'bytes': disk_after[name]['bytes'] - disk_before[name]['bytes'],
+                'total_bytes': disk_after[name]['bytes']
+            }
+            for name in disk_after
+        }
+    }
+
+
+def parse_metrics(text):
+    """读取没有标签的指标值"""
+    values = {}
+    for line in text.splitlines():
+        if line.startswith('#') or '{' in line:
+            continue
+        name, _, value = line.partition(' ')
+        try:
+            values[name] = float(value)
+        except ValueError:
+            pass
+    return values
+
+
+def print_report(result):
+    """打印结果摘要"""
+    def ms(summary, key):
+        return f"{summary[key] * 1000:8.1f}" if summary.get(key) is not None else f"{'-':>8}"
+
+    print(f"\n{'=' * 72}")
+    print(f"请求数: {result['latency']['count']}, 耗时: {result['wall_time']:.2f}秒, "
+          f"吞吐量: {result['throughput_rps']:.2f} 请求/秒, 状态不符合预期: {result['unexpected_status']}")
+    print(f"状态码: {result['status_codes']}")
+    print(f"\n{'延迟(ms)':<16}{'count':>8}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}")
+    rows = [('全部', result['latency'])] + list(result['latency_by_case'].items())
+    if result['phases']:
+        rows += [(f"阶段:{phase}", summary) for phase, summary in result['phases'].items() if summary['count']]
+    for name, summary in rows:
+        print(f"{name:<16}{summary['count']:>8}" + ''.join(ms(summary, key) for key in ('p50', 'p90', 'p99', 'max')))
+    if result['rss']:
+        rss = result['rss']
+        print(f"\n常驻内存(MB): 开始 {rss['start_bytes'] / 1048576:.0f}, 峰值 {rss['peak_bytes'] / 1048576:.0f}, "
+              f"结束 {rss['end_bytes'] / 1048576:.0f}")
+    for name, usage in result['disk'].items():
+        print(f"磁盘 {name}/: 新增 {usage['files']} 个文件, {usage['bytes'] / 1024:.0f}KB")
+    print('=' * 72)
+
+
+def compare_results(baseline, current, threshold):
+    """
+    对比两次结果，打印变化并返回变差的指标列表
+
+    延迟分位数增大或吞吐量下降超过threshold（比例）视为变差
+    """
+    checks = [('吞吐量', baseline.get('throughput_rps'), current.get('throughput_rps'), False)]
+    for key in ('p50', 'p90', 'p99'):
+        checks.append((f"延迟 {key}", baseline['latency'].get(key), current['latency'].get(key), True))
+    for name in sorted(set(baseline.get('latency_by_case', {})) & set(current.get('latency_by_case', {}))):
+        for key in ('p50', 'p99'):
+            checks.append((f"{name} {key}", baseline['latency_by_case'][name].get(key),
+                           current['latency_by_case'][name].get(key), True))
+    for phase in PHASES:
+        old = (baseline.get('phases') or {}).get(phase) or {}
+        new = (current.get('phases') or {}).get(phase) or {}
+        checks.append((f"阶段:{phase} p50", old.get('p50'), new.get('p50'), True))
+
+    differences = [
+        key for key in set(baseline.get('benchmark', {})) | set(current.get('benchmark', {}))
+        if key != 'url' and baseline.get('benchmark', {}).get(key) != current.get('benchmark', {}).get(key)
+    ]
+    if differences:
+        print(f"⚠️ 两次测试的参数不同（{', '.join(sorted(differences))}），结果可能不可比\n")
+
+    regressions = []
+    print(f"{'指标':<24}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for name, old, new, lower_is_better in checks:
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = change > threshold if lower_is_better else change < -threshold
+        # 很小的耗时（例如排队时间）绝对变化不到1毫秒时不算变差
+        if lower_is_better and abs(new - old) < 0.001:
+            worse = False
+        marker = '  ❌' if worse else ''
+        print(f"{name:<24}{old:>12.4f}{new:>12.4f}{change:>+10.1%}{marker}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='代码执行API基准测试')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    run_parser = subparsers.add_parser('run', help='执行基准测试')
+    run_parser.add_argument('--url', type=str, help='已运行的服务地址，不指定时在本进程中启动服务')
+    run_parser.add_argument('--pid', type=int, help='--url 服务的进程ID，用于采样常驻内存')
+    run_parser.add_argument('--requests', '-n', type=int, default=200, help='测量的请求数')
+    run_parser.add_argument('--warmup', type=int, default=10, help='测量前的预热请求数')
+    run_parser.add_argument('--concurrency', '-c', type=int, default=4, help='并发请求数')
+    run_parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                            help=f'代码片段权重，默认 {DEFAULT_MIX}')
+    run_parser.add_argument('--seed', type=int, default=0, help='请求序列的随机种子')
+    run_parser.add_argument('--cache', action='store_true', help='允许使用渲染缓存（默认每次都执行代码）')
+    run_parser.add_argument('--response-mode', choices=['url', 'png', 'base64'], default='url', help='返回方式')
+    run_parser.add_argument('--format', choices=['png', 'webp', 'jpeg', 'svg'], default='png', help='图片格式')
+    run_parser.add_argument('--timeout', type=float, default=120.0, help='单个请求的客户端超时（秒）')
+    run_parser.add_argument('--log-file', type=str, help='服务的JSON日志文件，用于读取各阶段耗时')
+    run_parser.add_argument('--data-dir', type=str, default='.', help='服务的工作目录，用于统计磁盘占用')
+    run_parser.add_argument('--job-dir', type=str, default='jobs', help='任务状态文件目录（相对于--data-dir）')
+    run_parser.add_argument('--output', '-o', type=str, help='结果JSON文件')
+
+    compare_parser = subparsers.add_parser('compare', help='对比两次基准测试结果')
+    compare_parser.add_argument('baseline', help='基线结果JSON文件')
+    compare_parser.add_argument('current', help='本次结果JSON文件')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help='视为变差的变化比例，默认0.10')
+
+    args = parser.parse_args()
+
+    if args.action == 'run':
+        result = run_benchmark(args)
+        print_report(result)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            print(f"📄 结果已写入 {args.output}")
+    elif args.action == 'compare':
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        regressions = compare_results(baseline, current, args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} 项指标变差超过 {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\n✅ 没有超过阈值的变化")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代码规范化
+基于ast/tokenize对用户代码做一次性规范化，生成规范源码、内容哈希和编译后的代码对象：
+- 去除```python代码块标记和公共缩进
+- 单行中粘连的多个import语句按token拆分（不会误伤字符串中的内容）
+- 删除plt.show()语句
+规范化结果和代码对象都按原始代码的内容哈希缓存，重复提交时跳过解析和compile()
+"""
+
+import ast
+import hashlib
+import io
+import re
+import textwrap
+import threading
+import tokenize
+from collections import OrderedDict, namedtuple
+
+# 规范化结果：source为规范源码，digest为规范形式的哈希（与格式、注释无关）
+NormalizedCode = namedtuple('NormalizedCode', ['source', 'digest'])
+
+_FENCE_START = re.compile(r'^\s*```[\w+-]*[ \t]*(\n|$)')
+_FENCE_END = re.compile(r'(^|\n)[ \t]*```\s*$')
+
+
+class _LRU:
+    """线程安全的小型LRU缓存"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+_normalized_cache = _LRU(1024)
+_compiled_cache = _LRU(256)
+
+
+class _StripShow(ast.NodeTransformer):
+    """删除plt.show()语句：API环境中图片统一在代码执行结束后渲染"""
+
+    def visit_Expr(self, node):
+        call = node.value
+        if (
+            isinstance(call, ast.Call)
+            and isinstance(call.func, ast.Attribute)
+            and call.func.attr == 'show'
+            and isinstance(call.func.value, ast.Name)
+            and call.func.value.id == 'plt'
+        ):
+            return ast.copy_location(ast.Pass(), node)
+        return node
+
+
+def _content_hash(code):
+    """原始代码的内容哈希"""
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def _strip_fences(code):
+    """去除Markdown代码块标记"""
+    code = code.replace('\r\n', '\n')
+    code = _FENCE_START.sub('', code, count=1)
+    code = _FENCE_END.sub('', code, count=1)
+    return code
+
+
+def _split_glued_imports(line):
+    """
+    按token拆分单行中粘连的import语句，例如
+    "import numpy as np import matplotlib.pyplot as plt"
+    字符串和注释中的import不受影响；无法拆分时返回None
+    """
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(line).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return None
+
+    split_offsets = []
+    statement_kind = None  # 当前语句的第一个关键字
+    seen_import = False
+    previous = None
+    for tok in tokens:
+        if tok.type == tokenize.OP and tok.string == ';':
+            statement_kind, seen_import = None, False
+        elif tok.type == tokenize.NAME and tok.string in ('import', 'from'):
+            if statement_kind is None:
+                statement_kind = tok.string
+                seen_import = tok.string == 'import'
+            elif statement_kind in ('import', 'from') and seen_import and previous not in ('yield', 'raise'):
+                # 上一条import语句已经完整，这里开始新的语句
+                split_offsets.append(tok.start[1])
+                statement_kind = tok.string
+                seen_import = tok.string == 'import'
+            elif tok.string == 'import':
+                seen_import = True
+        elif tok.type == tokenize.NAME and statement_kind is None:
+            statement_kind = tok.string
+        if tok.type not in (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER):
+            previous = tok.string
+
+    if not split_offsets:
+        return None
+    parts = []
+    start = 0
+    for offset in split_offsets:
+        parts.append(line[start:offset].rstrip())
+        start = offset
+    parts.append(line[start:])
+    return '\n'.join(parts)
+
+
+def _parse(code):
+    """
+    规范化并解析代码
+
+    返回:
+    - (ast模块节点, 规范化后的源码文本)，无法解析时抛出SyntaxError
+    """
+    text = textwrap.dedent(_strip_fences(code)).strip('\n')
+    try:
+        tree = ast.parse(text, '<string>')
+    except SyntaxError:
+        if '\n' in text:
+            raise
+        split = _split_glued_imports(text)
+        if split is None:
+            raise
+        tree = ast.parse(split, '<string>')
+        text = split
+    tree = ast.fix_missing_locations(_StripShow().visit(tree))
+    return tree, text
+
+
+def _canonical(tree, text):
+    """由语法树生成规范源码和与格式无关的哈希"""
+    digest = hashlib.sha256(ast.dump(tree).encode('utf-8')).hexdigest()
+    source = ast.unparse(tree) if hasattr(ast, 'unparse') else text
+    return NormalizedCode(source, digest)
+
+
+def normalize_code(code):
+    """
+    返回代码的规范形式（带缓存）
+    无法解析的代码按去除标记和缩进后的文本计算哈希，执行时再报告语法错误
+    """
+    key = _content_hash(code)
+    cached = _normalized_cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        tree, text = _parse(code)
+        normalized = _canonical(tree, text)
+    except SyntaxError:
+        text = textwrap.dedent(_strip_fences(code)).strip('\n')
+        normalized = NormalizedCode(text, _content_hash(text))
+    _normalized_cache.put(key, normalized)
+    return normalized
+
+
+def compile_code(code):
+    """
+    规范化并编译代码（带缓存）
+
+    返回:
+    - (NormalizedCode, 代码对象)，语法错误时抛出SyntaxError
+    """
+    key = _content_hash(code)
+    cached = _compiled_cache.get(key)
+    if cached is not None:
+        return cached
+
+    tree, text = _parse(code)
+    normalized = _canonical(tree, text)
+    # 直接编译语法树，错误堆栈中的行号对应去除标记和缩进后的代码
+    code_object = compile(tree, '<string>', 'exec')
+    _compiled_cache.put(key, (normalized, code_object))
+    _normalized_cache.put(key, normalized)
+    return normalized, code_object
+
+
+def cache_stats():
+    """返回规范化和编译缓存的命中统计"""
+    return {
+        'normalize_hits': _normalized_cache.hits,
+        'normalize_misses': _normalized_cache.misses,
+        'compile_hits': _compiled_cache.hits,
+        'compile_misses': _compiled_cache.misses
+    }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+服务配置文件
+所有配置项都可以通过同名环境变量覆盖
+"""
+
+import os
+
+
+def _env_int(name, default):
+    """读取整数类型的环境变量"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return int(value)
+
+
+def _env_float(name, default):
+    """读取浮点类型的环境变量"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return float(value)
+
+
+def _env_str(name, default):
+    """读取字符串类型的环境变量"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip()
+
+
+# 执行器工作进程数量，默认与CPU核心数相同
+EXECUTOR_WORKERS = _env_int('EXECUTOR_WORKERS', os.cpu_count() or 1)
+
+# 工作进程的启动方式（fork / forkserver / spawn）
+EXECUTOR_START_METHOD = _env_str('EXECUTOR_START_METHOD', 'fork')
+
+# 等待工作进程完成预热的最长时间（秒）
+WORKER_START_TIMEOUT = _env_float('WORKER_START_TIMEOUT', 60.0)
+
+# 每个任务在执行进程中允许新增的虚拟内存（MB，RLIMIT_AS），0表示不限制
+EXECUTOR_MEMORY_LIMIT_MB = _env_int('EXECUTOR_MEMORY_LIMIT_MB', 2048)
+
+# 每个任务允许使用的CPU时间（秒，RLIMIT_CPU），0表示不限制；多线程计算时CPU时间可能大于执行时间
+EXECUTOR_CPU_LIMIT = _env_int('EXECUTOR_CPU_LIMIT', 120)
+
+# 每个执行进程最多执行的任务数，达到后回收替换，防止内存碎片和模块状态累积，0表示不限制
+EXECUTOR_MAX_JOBS_PER_WORKER = _env_int('EXECUTOR_MAX_JOBS_PER_WORKER', 500)
+
+# 执行进程的常驻内存（MB）超过该值时回收替换，0表示不限制
+EXECUTOR_MAX_RSS_MB = _env_int('EXECUTOR_MAX_RSS_MB', 1024)
+
+# matplotlib的配置和缓存目录（MPLCONFIGDIR），字体列表缓存保存在其中，重启后不再重新扫描系统字体；
+# 已设置MPLCONFIGDIR环境变量时以其为准
+MATPLOTLIB_CACHE_DIR = _env_str('MATPLOTLIB_CACHE_DIR', '.matplotlib')
+
+# 启动时预先查找的字体（逗号分隔），默认为常用的中文字体
+WARMUP_FONTS = _env_str('WARMUP_FONTS', 'Heiti TC,Hiragino Sans,PingFang SC,DejaVu Sans')
+
+# 启动时预先读取的matplotlib样式（逗号分隔），例如 ggplot,seaborn-v0_8
+WARMUP_STYLES = _env_str('WARMUP_STYLES', '')
+
+# 启动时预导入的可选库（逗号分隔），例如 seaborn,plotly.graph_objects
+PRELOAD_MODULES = _env_str('PRELOAD_MODULES', '')
+
+# 启动时是否执行一次试渲染（1 / 0），完成后/health才报告就绪
+WARMUP_RENDER = _env_int('WARMUP_RENDER', 1) == 1
+
+# 线程执行器的线程数量，0表示不启用（请求指定executor=thread时回退到进程池）
+# 启用时建议把EXECUTOR_START_METHOD设为forkserver，避免在多线程进程中fork替换进程
+THREAD_EXECUTOR_WORKERS = _env_int('THREAD_EXECUTOR_WORKERS', 0)
+
+# 输出图片单边最大像素数，超出时按比例降低DPI
+MAX_IMAGE_SIDE = _env_int('MAX_IMAGE_SIDE', 8000)
+
+# 请求开启decimate时，点数达到该值的折线和散点才抽稀
+DECIMATION_MIN_POINTS = _env_int('DECIMATION_MIN_POINTS', 10000)
+
+# 是否启用渲染结果缓存
+RENDER_CACHE_ENABLED = _env_int('RENDER_CACHE_ENABLED', 1) == 1
+
+# 渲染缓存内存层容量（MB）和最大条目数
+RENDER_CACHE_MEMORY_MB = _env_int('RENDER_CACHE_MEMORY_MB', 64)
+RENDER_CACHE_MEMORY_ENTRIES = _env_int('RENDER_CACHE_MEMORY_ENTRIES', 512)
+
+# 渲染缓存过期时间（秒）
+RENDER_CACHE_TTL = _env_int('RENDER_CACHE_TTL', 24 * 3600)
+
+# 批量执行接口单次最多包含的项数
+BATCH_MAX_ITEMS = _env_int('BATCH_MAX_ITEMS', 200)
+
+# 缩略图等衍生图的磁盘缓存容量（MB）
+THUMBNAIL_CACHE_MB = _env_int('THUMBNAIL_CACHE_MB', 256)
+
+# 衍生图单边最大像素数
+THUMBNAIL_MAX_SIDE = _env_int('THUMBNAIL_MAX_SIDE', 2048)
+
+# picture/ 下图片文件的总磁盘预算（MB），超出时后台回收从最旧的文件开始删除
+ARTIFACT_DISK_MB = _env_int('ARTIFACT_DISK_MB', 2048)
+
+# 图片文件最长保存时间（秒）
+ARTIFACT_MAX_AGE = _env_int('ARTIFACT_MAX_AGE', 7 * 24 * 3600)
+
+# 后台回收的执行间隔（秒）
+ARTIFACT_GC_INTERVAL = _env_float('ARTIFACT_GC_INTERVAL', 600.0)
+
+# /download 热门文件内存缓存容量（MB），以及可缓存的单个文件大小上限（KB）
+HOT_FILE_CACHE_MB = _env_int('HOT_FILE_CACHE_MB', 32)
+HOT_FILE_MAX_KB = _env_int('HOT_FILE_MAX_KB', 1024)
+
+# /download 响应的 Cache-Control max-age（秒）
+DOWNLOAD_MAX_AGE = _env_int('DOWNLOAD_MAX_AGE', 365 * 24 * 3600)
+
+# 准入控制：最多同时执行的请求数（默认等于执行进程数和执行线程数之和）、
+# 最多排队等待的请求数和最长排队时间（秒）；队列已满或排队超时的请求立即返回429
+ADMISSION_MAX_IN_FLIGHT = _env_int('ADMISSION_MAX_IN_FLIGHT', EXECUTOR_WORKERS + THREAD_EXECUTOR_WORKERS)
+ADMISSION_QUEUE_SIZE = _env_int('ADMISSION_QUEUE_SIZE', 4 * ADMISSION_MAX_IN_FLIGHT)
+ADMISSION_QUEUE_TIMEOUT = _env_float('ADMISSION_QUEUE_TIMEOUT', 10.0)
+
+# 按客户端IP（nginx传入的X-Real-IP）的令牌桶限流：每秒请求数和允许的突发请求数，0表示不限流
+RATE_LIMIT_PER_SECOND = _env_float('RATE_LIMIT_PER_SECOND', 0.0)
+RATE_LIMIT_BURST = _env_int('RATE_LIMIT_BURST', 20)
+
+# 异步任务（/jobs）：状态文件目录、结束的任务结果保留时间（秒）和SSE心跳间隔（秒）
+JOB_DIR = _env_str('JOB_DIR', 'jobs')
+JOB_RESULT_TTL = _env_int('JOB_RESULT_TTL', 3600)
+JOB_SSE_KEEPALIVE = _env_float('JOB_SSE_KEEPALIVE', 15.0)
+
+# 数据集（/datasets）：存储目录、全部数据集的磁盘预算（MB）和单个上传文件的大小上限（MB）
+DATASET_DIR = _env_str('DATASET_DIR', 'datasets')
+DATASET_DISK_MB = _env_int('DATASET_DISK_MB', 2048)
+DATASET_MAX_UPLOAD_MB = _env_int('DATASET_MAX_UPLOAD_MB', 512)
+
+# 服务监听地址、端口和uvicorn工作进程数
+# 每个uvicorn工作进程都有自己的执行进程池（EXECUTOR_WORKERS个），总进程数为两者之积
+SERVER_HOST = _env_str('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = _env_int('SERVER_PORT', 8000)
+SERVER_WORKERS = _env_int('SERVER_WORKERS', 1)
+
+# 下载链接的公开地址，例如 https://charts.example.com；为空时按请求头（X-Forwarded-Proto / X-Forwarded-Host / Host）推断
+PUBLIC_BASE_URL = _env_str('PUBLIC_BASE_URL', '')
+
+# nginx内部location前缀，例如 /protected-picture/；设置后/download只返回X-Accel-Redirect，由nginx发送文件
+ACCEL_REDIRECT_PREFIX = _env_str('ACCEL_REDIRECT_PREFIX', '')
+
+# 日志级别、日志文件、单个文件最大大小（MB）、保留的备份文件数量，以及是否同时输出到控制台
+LOG_LEVEL = _env_str('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = _env_str('LOG_FILE', 'api.log')
+LOG_MAX_SIZE = _env_int('LOG_MAX_SIZE', 10)
+LOG_BACKUP_COUNT = _env_int('LOG_BACKUP_COUNT', 5)
+LOG_CONSOLE = _env_int('LOG_CONSOLE', 1) == 1
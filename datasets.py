@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据集存储
+调用方上传一次数据，之后在 /execute-code 中按ID引用，不再把数据写成代码中的Python字面量：
+- 支持 .npy、.npz 和数值CSV；数据集ID为上传内容的SHA-256，相同内容重复上传直接返回已有的数据集
+- 上传时解析一次并转换为 .npy 文件（.npy 原样保存），执行时以只读内存映射的方式加载，不复制、不解析
+- 每个数据集一个目录：datasets/<ID>/ 下是各数组的 .npy 文件和 manifest.json；
+  使用时更新manifest的修改时间，总大小超出预算时从最久未使用的数据集开始淘汰
+- 多个uvicorn工作进程共用同一个目录，状态都保存在文件中
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+# 上传或转换中断后遗留的临时文件和目录，超过该时间（秒）后清理
+_STALE_TEMP_AGE = 3600
+
+# 上传文件复制时的块大小
+_COPY_CHUNK = 1024 * 1024
+
+_NPY_MAGIC = b'\x93NUMPY'
+_ZIP_MAGIC = b'PK\x03\x04'
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class InvalidDatasetError(ValueError):
+    """上传的文件不是支持的数据格式"""
+
+
+class DatasetTooLargeError(ValueError):
+    """上传的文件超出大小限制"""
+
+
+class DatasetStore:
+    """
+    数据集磁盘存储
+
+    参数:
+    - directory: 存储目录
+    - max_bytes: 全部数据集的总大小预算（字节）
+    - max_upload_bytes: 单个上传文件的大小上限（字节）
+    """
+
+    def __init__(self, directory='datasets', max_bytes=2 * 1024 ** 3, max_upload_bytes=512 * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_upload_bytes = max_upload_bytes
+        self.uploads = 0
+        self.deduplicated = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, dataset_id):
+        return os.path.join(self.directory, dataset_id)
+
+    def add(self, source, filename=''):
+        """
+        保存上传的数据集（阻塞IO，应在线程池中调用）
+
+        参数:
+        - source: 可读的二进制文件对象
+        - filename: 上传时的文件名，用于识别格式
+
+        返回:
+        - (manifest字典, 是否为重复上传)
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.upload_')
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = source.read(_COPY_CHUNK)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_upload_bytes:
+                        raise DatasetTooLargeError(
+                            f"数据集超出大小限制（{self.max_upload_bytes // 1024 // 1024}MB）"
+                        )
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            if size == 0:
+                raise InvalidDatasetError("上传的文件为空")
+
+            dataset_id = digest.hexdigest()[:32]
+            manifest = self.get(dataset_id)
+            if manifest is not None:
+                self.uploads += 1
+                self.deduplicated += 1
+                return manifest, True
+
+            build_dir = os.path.join(self.directory, f".build_{uuid.uuid4().hex}")
+            os.makedirs(build_dir)
+            try:
+                manifest = _convert(tmp_path, filename, build_dir)
+                manifest.update({'dataset_id': dataset_id, 'filename': filename, 'upload_bytes': size,
+                                 'created_at': time.time()})
+                if manifest['bytes'] > self.max_bytes:
+                    raise DatasetTooLargeError("数据集超出存储预算")
+                with open(os.path.join(build_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+                    json.dump(manifest, f, ensure_ascii=False)
+                try:
+                    os.rename(build_dir, self._path(dataset_id))
+                except OSError:
+                    # 其他工作进程同时上传了相同的内容
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                    self.uploads += 1
+                    self.deduplicated += 1
+                    return self.get(dataset_id), True
+            except BaseException:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+        finally:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        self.uploads += 1
+        self.collect(keep=dataset_id)
+        return manifest, False
+
+    def get(self, dataset_id, touch=True):
+        """
+        读取数据集的manifest，并记录为最近使用（阻塞IO）
+
+        返回:
+        - manifest字典；不存在时返回None
+        """
+        if not valid_dataset_id(dataset_id):
+            return None
+        path = os.path.join(self._path(dataset_id), MANIFEST_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if touch:
+                os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return manifest
+
+    def resolve(self, dataset_id):
+        """
+        执行任务用的数据集描述：各数组 .npy 文件的绝对路径（阻塞IO）
+
+        返回:
+        - {'single': 是否为单个数组, 'arrays': {数组名: 路径}}；不存在时返回None
+        """
+        manifest = self.get(dataset_id)
+        if manifest is None:
+            return None
+        directory = os.path.abspath(self._path(dataset_id))
+        return {
+            'single': manifest['single'],
+            'arrays': {name: os.path.join(directory, info['file']) for name, info in manifest['arrays'].items()}
+        }
+
+    def remove(self, dataset_id):
+        """删除数据集，返回是否存在（阻塞IO）"""
+        if not valid_dataset_id(dataset_id) or not os.path.isdir(self._path(dataset_id)):
+            return False
+        # 先改名再删除，正在读取的任务不会看到只删了一半的目录；已映射的文件在任务结束前仍然有效
+        trash = os.path.join(self.directory, f".trash_{uuid.uuid4().hex}")
+        try:
+            os.rename(self._path(dataset_id), trash)
+        except FileNotFoundError:
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
+
+    def _entries(self):
+        """全部数据集 [(最近使用时间, 大小, ID), ...]"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not valid_dataset_id(name):
+                continue
+            path = os.path.join(self._path(name), MANIFEST_NAME)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    size = json.load(f)['bytes']
+                entries.append((os.path.getmtime(path), size, name))
+            except (OSError, ValueError, KeyError):
+                continue
+        return entries
+
+    def collect(self, keep=None):
+        """
+        总大小超出预算时从最久未使用的数据集开始删除（阻塞IO）
+
+        参数:
+        - keep: 不删除的数据集ID（刚上传的数据集）
+
+        返回:
+        - (删除的数据集数, 释放的字节数)
+        """
+        self._remove_stale_temp()
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        freed = 0
+        for _, size, dataset_id in entries:
+            if total <= self.max_bytes:
+                break
+            if dataset_id == keep:
+                continue
+            if self.remove(dataset_id):
+                total -= size
+                removed += 1
+                freed += size
+        self.evictions += removed
+        return removed, freed
+
+    def _remove_stale_temp(self):
+        """删除中断的上传遗留的临时文件和目录"""
+        deadline = time.time() - _STALE_TEMP_AGE
+        for name in os.listdir(self.directory):
+            if not name.startswith(('.upload_', '.build_', '.trash_')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) >= deadline:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """返回数据集存储统计（阻塞IO）"""
+        entries = self._entries()
+        return {
+            'datasets': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+            'uploads': self.uploads,
+            'deduplicated': self.deduplicated,
+            'evictions': self.evictions
+        }
+
+
+def valid_dataset_id(dataset_id):
+    """数据集ID只能是32位十六进制，防止路径穿越"""
+    return len(dataset_id) == 32 and all(c in '0123456789abcdef' for c in dataset_id)
+
+
+def _detect_format(path, filename):
+    """按扩展名识别格式，没有扩展名时按文件头识别"""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension in ('.npy', '.npz', '.csv'):
+        return extension[1:]
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if head.startswith(_NPY_MAGIC):
+        return 'npy'
+    if head.startswith(_ZIP_MAGIC):
+        return 'npz'
+    return 'csv'
+
+
+def _check_array(array, name):
+    if array.dtype.hasobject:
+        raise InvalidDatasetError(f"数组 {name} 包含Python对象，只支持数值等固定类型的数组")
+
+
+def _array_info(array, file):
+    return {'file': file, 'shape': list(array.shape), 'dtype': array.dtype.str}
+
+
+def _convert(path, filename, build_dir):
+    """
+    把上传的文件转换为一组 .npy 文件，写入build_dir
+
+    返回:
+    - manifest字典（不含ID等上传信息）
+    """
+    import numpy as np
+
+    fmt = _detect_format(path, filename)
+    arrays = {}
+    # npy和没有表头的CSV是单个数组，在代码中直接是ndarray；其余是按名称索引的字典
+    single = fmt == 'npy'
+    try:
+        if fmt == 'npy':
+            # 只读取文件头做校验，文件本身原样保存
+            array = np.load(path, mmap_mode='r', allow_pickle=False)
+            _check_array(array, 'data')
+            shutil.copyfile(path, os.path.join(build_dir, 'data.npy'))
+            arrays['data'] = _array_info(array, 'data.npy')
+        elif fmt == 'npz':
+            with np.load(path, allow_pickle=False) as archive:
+                if not archive.files:
+                    raise InvalidDatasetError("npz文件中没有数组")
+                for index, name in enumerate(archive.files):
+                    array = archive[name]
+                    _check_array(array, name)
+                    file = f"array_{index}.npy"
+                    np.save(os.path.join(build_dir, file), array, allow_pickle=False)
+                    arrays[name] = _array_info(array, file)
+        else:
+            arrays, single = _convert_csv(path, build_dir)
+    except InvalidDatasetError:
+        raise
+    except (ValueError, OSError, EOFError) as e:
+        raise InvalidDatasetError(f"无法解析{fmt}文件: {e}")
+
+    size = sum(os.path.getsize(os.path.join(build_dir, info['file'])) for info in arrays.values())
+    return {
+        'format': fmt,
+        'single': single,
+        'arrays': arrays,
+        'bytes': size
+    }
+
+
+def _convert_csv(path, build_dir):
+    """
+    解析数值CSV：有表头时每列保存为一个数组（以列名为键），没有表头时保存为一个数组（单列时为一维）
+
+    返回:
+    - (数组信息, 是否为单个数组)
+    """
+    import numpy as np
+
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        first_line = f.readline()
+    header = [name.strip().strip('"') for name in first_line.split(',')]
+    has_header = not all(_is_number(value) for value in header if value)
+
+    try:
+        data = np.loadtxt(path, delimiter=',', skiprows=1 if has_header else 0, ndmin=2, dtype=np.float64,
+                          encoding='utf-8-sig')
+    except ValueError as e:
+        raise InvalidDatasetError(f"CSV只支持数值列: {e}")
+    if data.size == 0:
+        raise InvalidDatasetError("CSV中没有数据")
+
+    arrays = {}
+    if not has_header:
+        array = data[:, 0] if data.shape[1] == 1 else data
+        np.save(os.path.join(build_dir, 'data.npy'), np.ascontiguousarray(array))
+        arrays['data'] = _array_info(array, 'data.npy')
+        return arrays, True
+    if len(header) != data.shape[1]:
+        raise InvalidDatasetError(f"CSV表头有{len(header)}列，数据有{data.shape[1]}列")
+    for index, name in enumerate(header):
+        name = name or f"column_{index}"
+        if name in arrays:
+            raise InvalidDatasetError(f"CSV表头中的列名重复: {name}")
+        column = np.ascontiguousarray(data[:, index])
+        file = f"column_{index}.npy"
+        np.save(os.path.join(build_dir, file), column)
+        arrays[name] = _array_info(column, file)
+    return arrays, False
+
+
+def _is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def load_dataset(spec):
+    """
+    在执行任务的进程中加载数据集，数组以只读内存映射的方式打开
+
+    参数:
+    - spec: DatasetStore.resolve 返回的描述
+
+    返回:
+    - 单个数组时为ndarray，否则为 {数组名: ndarray}
+    """
+    import numpy as np
+
+    arrays = {}
+    for name, path in spec['arrays'].items():
+        try:
+            array = np.load(path, mmap_mode='r', allow_pickle=False)
+        except ValueError:
+            # 空数组无法映射，直接读取
+            array = np.load(path, allow_pickle=False)
+            array.setflags(write=False)
+        arrays[name] = array
+    if spec['single']:
+        return next(iter(arrays.values()))
+    return arrays
@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代码执行器
+- ExecutorPool：维护一组预热好的工作进程，每个进程启动时完成一次导入和预热（见warmup.py），
+  请求被分派给空闲的工作进程执行，超时的进程会被强制结束并替换；
+  每个任务在RLIMIT_AS/RLIMIT_CPU限制下执行，执行任务数或常驻内存超过阈值的进程会被回收替换
+- ThreadExecutor：在API进程内用线程执行，适合进程分派开销大于执行时间的简单代码
+"""
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import Executor, Future
+
+import warmup
+
+try:
+    import resource
+except ImportError:  # Windows没有resource模块，不限制资源
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionTimeoutError(Exception):
+    """代码执行超时"""
+
+
+class WorkerCrashedError(Exception):
+    """工作进程在执行过程中异常退出"""
+
+
+class ResourceLimitError(Exception):
+    """工作进程因超出资源限制被结束"""
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _memory_usage():
+    """
+    当前进程的内存使用
+
+    返回:
+    - (虚拟内存字节数, 常驻内存字节数)；无法读取/proc时返回 (None, None)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            size, rss = f.read().split()[:2]
+        return int(size) * _PAGE_SIZE, int(rss) * _PAGE_SIZE
+    except (OSError, ValueError):
+        return None, None
+
+
+def _apply_limits(memory_limit, cpu_limit):
+    """
+    为下一个任务设置资源软限制，硬限制保持不变，任务结束后可以恢复
+
+    参数:
+    - memory_limit: 在当前虚拟内存之上允许新增的字节数（RLIMIT_AS），0表示不限制
+    - cpu_limit: 允许使用的CPU秒数（RLIMIT_CPU），0表示不限制
+
+    返回:
+    - 原来的限制 [(资源, 软限制, 硬限制), ...]
+    """
+    previous = []
+    if resource is None:
+        return previous
+    targets = []
+    if memory_limit:
+        vsize, _ = _memory_usage()
+        if vsize is not None:
+            targets.append((resource.RLIMIT_AS, vsize + memory_limit))
+    if cpu_limit:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # RLIMIT_CPU按进程累计的CPU时间计算
+        targets.append((resource.RLIMIT_CPU, math.ceil(usage.ru_utime + usage.ru_stime) + cpu_limit))
+    for limit, target in targets:
+        soft, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            target = min(target, hard)
+        try:
+            resource.setrlimit(limit, (target, hard))
+        except (ValueError, OSError):
+            continue
+        previous.append((limit, soft, hard))
+    return previous
+
+
+def _restore_limits(previous):
+    """恢复任务执行前的资源限制"""
+    for limit, soft, hard in previous:
+        resource.setrlimit(limit, (soft, hard))
+
+
+def _worker_main(conn, memory_limit=0, cpu_limit=0, warm_up_options=None):
+    """工作进程主循环：预热后逐个接收任务，在资源限制下执行并返回结果"""
+    # Ctrl+C 由主进程统一处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import runner
+    if cpu_limit and hasattr(signal, 'SIGXCPU'):
+        # 超出CPU时间软限制时内核发送SIGXCPU，转换为异常，任务返回资源超限错误而不是结束进程
+        def on_cpu_limit(signum, frame):
+            raise runner.ResourceLimitExceeded(f"CPU时间超出限制（{cpu_limit}秒）")
+        signal.signal(signal.SIGXCPU, on_cpu_limit)
+
+    # fork方式启动时API进程已经完成预热，这里几乎不耗时
+    report = warmup.warm_up(**(warm_up_options or {}))
+    conn.send({'type': 'ready', 'pid': os.getpid(), 'rss': _memory_usage()[1], 'warm_up': report})
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        previous = _apply_limits(memory_limit, cpu_limit)
+        try:
+            # 需要推送进度时，执行过程中的事件先于结果发送
+            result = runner.run_job(job, emit=conn.send if job.get('stream') else None)
+        finally:
+            _restore_limits(previous)
+        # 附带执行后的常驻内存，主进程据此决定是否回收该进程
+        result['rss'] = _memory_usage()[1]
+        conn.send(result)
+
+
+async def _wait_readable(conn, timeout):
+    """等待管道可读，不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    fd = conn.fileno()
+
+    def on_readable():
+        if not future.done():
+            future.set_result(None)
+
+    loop.add_reader(fd, on_readable)
+    try:
+        await asyncio.wait_for(future, timeout)
+    finally:
+        loop.remove_reader(fd)
+
+
+class _Worker:
+    """工作进程及其通信管道"""
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.jobs_done = 0
+        self.rss = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def kill(self):
+        """强制结束工作进程"""
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+    def stop(self, timeout=2):
+        """等待已收到退出通知的工作进程结束，超时后强制结束（阻塞调用）"""
+        self.process.join(timeout=timeout)
+        self.kill()
+
+
+class ExecutorPool:
+    """
+    预热的工作进程池
+
+    参数:
+    - size: 工作进程数量
+    - start_method: 工作进程的启动方式
+    - start_timeout: 等待工作进程预热完成的最长时间（秒）
+    - memory_limit: 每个任务允许新增的虚拟内存（字节），0表示不限制
+    - cpu_limit: 每个任务允许使用的CPU时间（秒），0表示不限制
+    - max_jobs: 每个工作进程最多执行的任务数，达到后回收替换，0表示不限制
+    - max_rss: 工作进程常驻内存（字节）超过该值时回收替换，0表示不限制
+    - warm_up_options: 工作进程预热参数，传给warmup.warm_up
+    """
+
+    def __init__(self, size, start_method='fork', start_timeout=60.0,
+                 memory_limit=0, cpu_limit=0, max_jobs=0, max_rss=0, warm_up_options=None):
+        self.size = max(1, size)
+        self.start_timeout = start_timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.warm_up_options = warm_up_options or {}
+        self._ctx = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            # forkserver进程预先导入，由它fork出的工作进程不再重复导入
+            self._ctx.set_forkserver_preload(['warmup', 'runner'])
+        self._idle = None
+        self._workers = set()
+        self._closed = False
+        self._replaced = 0
+        self._recycled = 0
+        self._resource_limited = 0
+
+    async def start(self):
+        """启动全部工作进程并等待预热完成"""
+        self._idle = asyncio.Queue()
+        self._closed = False
+        start_time = time.time()
+        await asyncio.gather(*(self._spawn() for _ in range(self.size)))
+        logger.info("执行器启动完成: %d个工作进程, 耗时: %.3f秒", self.size, time.time() - start_time)
+
+    async def shutdown(self):
+        """停止全部工作进程"""
+        self._closed = True
+        for worker in list(self._workers):
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in list(self._workers):
+            worker.process.join(timeout=2)
+            worker.kill()
+        self._workers.clear()
+        logger.info("执行器已停止")
+
+    async def _spawn(self):
+        """创建一个工作进程，预热完成后加入空闲队列"""
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.memory_limit, self.cpu_limit, self.warm_up_options),
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        worker = _Worker(process, parent_conn)
+
+        try:
+            await _wait_readable(parent_conn, self.start_timeout)
+            ready = parent_conn.recv()
+            worker.rss = ready.get('rss')
+            logger.debug("工作进程 %s 预热完成: %s", worker.pid, warmup.format_timings(ready['warm_up']['timings']))
+        except BaseException:
+            worker.kill()
+            raise
+
+        if self._closed:
+            worker.kill()
+            return
+        self._workers.add(worker)
+        self._idle.put_nowait(worker)
+
+    async def _respawn(self):
+        """替换被结束的工作进程"""
+        try:
+            await self._spawn()
+        except Exception as e:
+            logger.error("替换工作进程失败: %s", e)
+
+    def _discard(self, worker):
+        """结束工作进程，并在后台启动一个新的进程替换它"""
+        self._workers.discard(worker)
+        worker.kill()
+        self._replaced += 1
+        if not self._closed:
+            asyncio.get_running_loop().create_task(self._respawn())
+
+    def _recycle(self, worker, reason):
+        """通知空闲的工作进程退出，并在后台启动一个新的进程替换它"""
+        logger.info("回收工作进程 %s: %s", worker.pid, reason)
+        self._workers.discard(worker)
+        self._recycled += 1
+        try:
+            worker.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, worker.stop)
+        if not self._closed:
+            loop.create_task(self._respawn())
+
+    def _recycle_reason(self, worker, result):
+        """工作进程需要回收的原因，不需要时返回None"""
+        if result.get('status') == 'resource_limit':
+            # 内存分配失败后进程状态不可靠
+            return "任务超出资源限制"
+        if self.max_jobs and worker.jobs_done >= self.max_jobs:
+            return f"已执行{worker.jobs_done}个任务"
+        if self.max_rss and worker.rss and worker.rss > self.max_rss:
+            return f"常驻内存 {worker.rss / 1024 / 1024:.0f}MB 超过阈值"
+        return None
+
+    async def run(self, job, timeout, on_event=None):
+        """
+        在空闲的工作进程中执行任务
+
+        参数:
+        - job: 任务字典
+        - timeout: 执行超时时间（秒），不包含排队等待时间
+        - on_event: 可选回调，接收执行过程中的阶段变化和输出事件（在事件循环线程中调用）
+
+        返回:
+        - 工作进程返回的结果字典，timings中附加queue_wait
+        """
+        queued_at = time.perf_counter()
+        worker = await self._idle.get()
+        queue_wait = time.perf_counter() - queued_at
+
+        loop = asyncio.get_running_loop()
+        try:
+            if on_event is not None:
+                job = dict(job, stream=True)
+            worker.conn.send(job)
+            deadline = loop.time() + timeout
+            while True:
+                await _wait_readable(worker.conn, max(0.0, deadline - loop.time()))
+                result = worker.conn.recv()
+                if 'event' not in result:
+                    break
+                on_event(result)
+        except asyncio.TimeoutError:
+            logger.warning("工作进程 %s 执行超时(%s秒)，正在替换", worker.pid, timeout)
+            self._discard(worker)
+            raise ExecutionTimeoutError(f"代码执行超时（超过{timeout}秒）")
+        except (EOFError, OSError) as e:
+            logger.error("工作进程 %s 异常退出: %s", worker.pid, e)
+            self._discard(worker)
+            # 内存耗尽被系统结束（SIGKILL）或超过CPU时间硬限制（SIGXCPU）
+            limit_signals = [signal.SIGKILL] + ([signal.SIGXCPU] if hasattr(signal, 'SIGXCPU') else [])
+            if worker.process.exitcode in [-signum for signum in limit_signals]:
+                self._resource_limited += 1
+                raise ResourceLimitError("资源超出限制: 工作进程因内存耗尽或CPU时间超限被结束")
+            raise WorkerCrashedError("工作进程异常退出")
+        except BaseException:
+            # 请求被取消时工作进程仍在执行，只能结束它
+            self._discard(worker)
+            raise
+
+        worker.jobs_done += 1
+        worker.rss = result.pop('rss', None)
+        if result.get('status') == 'resource_limit':
+            self._resource_limited += 1
+        reason = self._recycle_reason(worker, result)
+        if reason is None:
+            self._idle.put_nowait(worker)
+        else:
+            self._recycle(worker, reason)
+        result.setdefault('timings', {})['queue_wait'] = queue_wait
+        return result
+
+    def stats(self):
+        """返回执行器状态"""
+        return {
+            'workers': len(self._workers),
+            'idle': self._idle.qsize() if self._idle else 0,
+            'replaced': self._replaced,
+            'recycled': self._recycled,
+            'resource_limited': self._resource_limited,
+            'rss_bytes': sum(worker.rss or 0 for worker in self._workers)
+        }
+
+
+class _DaemonThreadPool(Executor):
+    """
+    由守护线程组成的固定大小线程池
+    ThreadPoolExecutor的线程在解释器退出时会被等待，卡在C代码中的任务会让进程无法退出；
+    守护线程不会阻止退出
+    """
+
+    def __init__(self, size, name):
+        self._queue = queue.SimpleQueue()
+        self._shutdown = False
+        self._size = size
+        for index in range(size):
+            threading.Thread(target=self._work, name=f'{name}_{index}', daemon=True).start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, fn, /, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError('线程池已停止')
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """停止接收任务；排队中的任务照常执行，线程随后退出（不等待）"""
+        if not self._shutdown:
+            self._shutdown = True
+            for _ in range(self._size):
+                self._queue.put(None)
+
+
+class ThreadExecutor:
+    """
+    线程池执行器
+    每个任务使用独立的执行上下文，多个线程可以安全地同时执行。
+    线程无法被强制结束：超时后请求立即返回，用户代码在下一次执行Python代码时检查截止时间并中断；
+    阻塞在C代码中（如time.sleep）的任务会一直占用线程，直到调用返回。
+    超时后仍在运行的任务计为滞留，所有线程都滞留时执行器不再可用（available为False），
+    调用方应改用进程执行；线程均为守护线程，滞留的任务不会阻止进程退出
+    """
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._pool = None
+        self._runner = None
+        self._timed_out = 0
+        self._overdue = 0  # 已超时但仍占用线程的任务数
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """是否还有未被滞留任务占用的线程"""
+        return self._pool is not None and self._overdue < self.size
+
+    async def start(self):
+        """创建线程池并预热"""
+        start_time = time.time()
+        import runner
+        self._runner = runner
+        self._pool = _DaemonThreadPool(self.size, 'code-exec')
+        await asyncio.get_running_loop().run_in_executor(self._pool, warmup.warm_up)
+        logger.info("线程执行器启动完成: %d个线程, 耗时: %.3f秒", self.size, time.time() - start_time)
+
+    async def shutdown(self):
+        """停止线程池，不等待仍在运行的任务"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        logger.info("线程执行器已停止")
+
+    async def run(self, job, timeout, on_event=None):
+        """
+        在线程池中执行任务
+
+        参数:
+        - job: 任务字典
+        - timeout: 超时时间（秒），包含排队等待时间；同时作为用户代码的截止时间
+        - on_event: 可选回调，接收执行过程中的阶段变化和输出事件（在事件循环线程中调用）
+
+        返回:
+        - 结果字典，timings中附加queue_wait
+        """
+        submitted_at = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        emit = None
+        if on_event is not None:
+            def emit(event):
+                loop.call_soon_threadsafe(on_event, event)
+
+        state = {'started': False, 'finished': False, 'overdue': False}
+
+        def call():
+            with self._lock:
+                state['started'] = True
+            try:
+                queue_wait = time.perf_counter() - submitted_at
+                result = self._runner.run_job(job, emit=emit, isolated=True, deadline=deadline)
+                result.setdefault('timings', {})['queue_wait'] = queue_wait
+                return result
+            finally:
+                with self._lock:
+                    state['finished'] = True
+                    if state['overdue']:
+                        self._overdue -= 1
+                        logger.info("线程执行器中超时的任务已结束，滞留任务数: %d", self._overdue)
+
+        try:
+            result = await asyncio.wait_for(loop.run_in_executor(self._pool, call), timeout)
+        except asyncio.TimeoutError:
+            self._timed_out += 1
+            with self._lock:
+                if state['started'] and not state['finished']:
+                    state['overdue'] = True
+                    self._overdue += 1
+                    if self._overdue >= self.size:
+                        logger.error("线程执行器的%d个线程都被超时的任务占用，请求改用进程执行", self.size)
+            raise ExecutionTimeoutError(f"代码执行超时（超过{timeout}秒）")
+        if result['status'] == 'timeout':
+            # 用户代码先于wait_for检查到了截止时间
+            self._timed_out += 1
+            raise ExecutionTimeoutError(f"代码执行超时（超过{timeout}秒）")
+        return result
+
+    def stats(self):
+        """返回执行器状态"""
+        return {
+            'threads': self.size,
+            'timed_out': self._timed_out,
+            'overdue': self._overdue
+        }
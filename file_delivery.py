@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片文件下发
+生成的图片写入后不再修改，/download 按不可变资源返回：
+- 强ETag：内容寻址的文件直接用文件名中的哈希，其他文件用修改时间和大小
+- If-None-Match 命中时返回304
+- 长期有效的 Cache-Control: immutable
+- 单段 Range 请求返回206
+- 热门小文件的字节缓存在进程内存中，命中时不再访问文件系统
+部署在nginx之后时，也可以只返回X-Accel-Redirect，由nginx用sendfile发送文件
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from urllib.parse import quote
+
+from fastapi.responses import FileResponse, Response
+
+from output_format import media_type_for_filename
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileEntry:
+    """待下发的文件：元数据，以及可选的文件内容"""
+
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'data')
+
+    def __init__(self, path, size, mtime, etag, data=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.data = data
+
+
+class HotFileCache:
+    """热门图片文件的进程内LRU缓存"""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._entries = OrderedDict()  # 路径 -> FileEntry
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """只查询内存，命中时返回FileEntry"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry
+
+    def load(self, path, etag=None):
+        """
+        读取文件元数据，小文件同时读入内存并缓存（阻塞IO，应在线程池中调用）
+
+        参数:
+        - path: 文件路径
+        - etag: 已知的ETag（不含引号），为None时按修改时间和大小生成
+
+        返回:
+        - FileEntry；文件不存在时返回None
+        """
+        try:
+            stat = os.stat(path)
+            data = None
+            if stat.st_size <= self.max_file_bytes:
+                with open(path, 'rb') as f:
+                    data = f.read()
+        except FileNotFoundError:
+            return None
+
+        entry = FileEntry(path, stat.st_size, stat.st_mtime, etag or f"{stat.st_mtime_ns:x}-{stat.st_size:x}", data)
+        with self._lock:
+            self.misses += 1
+            if data is not None and len(data) <= self.max_bytes:
+                if path in self._entries:
+                    self._bytes -= len(self._entries.pop(path).data)
+                self._entries[path] = entry
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    _, oldest = self._entries.popitem(last=False)
+                    self._bytes -= len(oldest.data)
+        return entry
+
+    def clear(self):
+        """清空缓存，磁盘文件被回收后调用"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """返回缓存统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._bytes
+            }
+
+
+def parse_range(header, size):
+    """
+    解析单段Range请求头
+
+    返回:
+    - (起始位置, 结束位置)，均包含在内；请求头无效或包含多段时返回None，按完整文件返回
+    - 范围无法满足时返回 (None, None)
+    """
+    match = _RANGE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N 表示最后N个字节
+        length = int(last)
+        if length == 0:
+            return None, None
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return None, None
+    return start, end
+
+
+def _etag_matches(header, etag):
+    """If-None-Match 是否包含当前ETag（按弱比较）"""
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _read_range(path, start, length):
+    """从文件读取指定范围"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(length)
+
+
+async def file_response(request, entry, filename, max_age, loop):
+    """
+    按请求头构造文件响应：304、206或200
+
+    参数:
+    - request: 当前请求
+    - entry: FileEntry
+    - filename: 下载文件名
+    - max_age: Cache-Control的max-age（秒）
+    - loop: 事件循环，大文件的Range读取在线程池中执行
+    """
+    etag = f'"{entry.etag}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={max_age}, immutable',
+        'Last-Modified': formatdate(entry.mtime, usegmt=True),
+        'Accept-Ranges': 'bytes'
+    }
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = media_type_for_filename(filename)
+    headers['Content-Disposition'] = f"attachment; filename*=utf-8''{quote(filename)}"
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range(range_header, entry.size)
+        if byte_range is not None:
+            start, end = byte_range
+            if start is None:
+                headers['Content-Range'] = f'bytes */{entry.size}'
+                return Response(status_code=416, headers=headers)
+            length = end - start + 1
+            if entry.data is not None:
+                body = entry.data[start:end + 1]
+            else:
+                body = await loop.run_in_executor(None, _read_range, entry.path, start, length)
+            headers['Content-Range'] = f'bytes {start}-{end}/{entry.size}'
+            return Response(content=body, status_code=206, media_type=media_type, headers=headers)
+
+    if entry.data is not None:
+        return Response(content=entry.data, media_type=media_type, headers=headers)
+    return FileResponse(entry.path, media_type=media_type, headers=headers)
+
+
+def accel_redirect_response(path, filename, prefix, max_age, root='picture'):
+    """
+    构造X-Accel-Redirect响应，nginx收到后从内部location发送文件
+
+    参数:
+    - path: 文件路径（位于root之下）
+    - filename: 下载文件名
+    - prefix: nginx内部location前缀，指向root目录
+    - max_age: Cache-Control的max-age（秒）
+    """
+    relative = os.path.relpath(path, root).replace(os.sep, '/')
+    headers = {
+        'X-Accel-Redirect': prefix.rstrip('/') + '/' + quote(relative),
+        'Cache-Control': f'public, max-age={max_age}, immutable',
+        'Content-Disposition': f"attachment; filename*=utf-8''{quote(filename)}"
+    }
+    return Response(media_type=media_type_for_filename(filename), headers=headers)
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求级执行隔离
+每个请求拥有独立的图形注册表、画布和标准输出/错误捕获，
+用户代码中的pyplot调用被路由到请求自己的上下文，而不是进程全局的pyplot状态，
+因此多个请求可以在同一进程的不同线程中同时执行
+
+已知限制：rcParams仍然是进程全局的；seaborn、pandas等在内部直接调用pyplot的库不经过路由，
+隔离模式下这些库绘制的图形不会被收集。每个进程同时只执行一个任务时应使用非隔离模式：
+plt就是全局的pyplot，只按请求捕获输出，任务结束后关闭全部图形
+"""
+
+import io
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import matplotlib
+import matplotlib.pyplot as _pyplot
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.figure import Figure
+from matplotlib.gridspec import GridSpec, SubplotSpec
+
+# 直接转发到当前坐标轴同名方法的pyplot函数
+_AXES_FUNCTIONS = {
+    'acorr', 'angle_spectrum', 'annotate', 'arrow', 'autoscale', 'axhline', 'axhspan',
+    'axis', 'axline', 'axvline', 'axvspan', 'bar', 'barbs', 'barh', 'bar_label', 'boxplot',
+    'broken_barh', 'clabel', 'cohere', 'contour', 'contourf', 'csd', 'errorbar', 'eventplot',
+    'fill', 'fill_between', 'fill_betweenx', 'grid', 'hexbin', 'hist', 'stairs', 'hist2d',
+    'hlines', 'imshow', 'legend', 'locator_params', 'loglog', 'magnitude_spectrum', 'margins',
+    'minorticks_off', 'minorticks_on', 'pcolor', 'pcolormesh', 'phase_spectrum', 'pie', 'plot',
+    'plot_date', 'psd', 'quiver', 'quiverkey', 'scatter', 'semilogx', 'semilogy', 'specgram',
+    'spy', 'stackplot', 'stem', 'step', 'streamplot', 'table', 'text', 'tick_params',
+    'ticklabel_format', 'tricontour', 'tricontourf', 'tripcolor', 'triplot', 'violinplot',
+    'vlines', 'xcorr', 'matshow'
+}
+
+# 转发到当前坐标轴 set_<name> 方法的pyplot函数
+_AXES_SETTERS = {'title', 'xlabel', 'ylabel', 'xscale', 'yscale'}
+
+# 转发到当前图形同名方法的pyplot函数
+_FIGURE_FUNCTIONS = {'suptitle', 'tight_layout', 'subplots_adjust', 'savefig', 'clf', 'figimage'}
+
+# subplots()中属于子图布局的参数，其余参数用于创建图形
+_SUBPLOTS_KWARGS = {
+    'sharex', 'sharey', 'squeeze', 'subplot_kw', 'gridspec_kw', 'width_ratios', 'height_ratios'
+}
+
+
+class DeadlineExceeded(BaseException):
+    """
+    执行超过截止时间，由截止时间检查在用户代码中抛出
+    继承BaseException，用户代码中的 except Exception 不会拦截
+    """
+
+
+class _ThreadLocalStream:
+    """按线程分发写入目标的输出流，未设置捕获的线程写入原始流"""
+
+    def __init__(self, original, local, name):
+        self._original = original
+        self._local = local
+        self._name = name
+
+    def _target(self):
+        return getattr(self._local, self._name, None) or self._original
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+# code_normalizer编译用户代码时使用的文件名，截止时间检查据此识别用户代码的栈帧
+_USER_CODE_FILENAME = '<string>'
+
+_capture_local = threading.local()
+_install_lock = threading.Lock()
+
+
+def _install_stream_dispatch():
+    """
+    把sys.stdout/sys.stderr替换为按线程分发的流
+    已经安装过时不重复包装；安装后被其他代码（如测试框架的输出捕获）替换时重新安装
+    """
+    with _install_lock:
+        for name in ('stdout', 'stderr'):
+            stream = getattr(sys, name)
+            if not isinstance(stream, _ThreadLocalStream):
+                setattr(sys, name, _ThreadLocalStream(stream, _capture_local, name))
+
+
+class _StreamingBuffer(io.StringIO):
+    """保存输出的同时把每次写入转交给回调，用于把执行中的输出实时推送给调用方"""
+
+    def __init__(self, name, on_output):
+        super().__init__()
+        self._name = name
+        self._on_output = on_output
+
+    def write(self, text):
+        written = super().write(text)
+        if text:
+            self._on_output(self._name, text)
+        return written
+
+
+class ExecutionContext:
+    """
+    单个请求的执行上下文
+
+    参数:
+    - on_output: 可选回调 on_output(流名称, 文本)，捕获的输出写入时调用
+    - isolated: 是否使用独立的图形注册表；为False时图形操作直接使用全局pyplot
+    """
+
+    def __init__(self, on_output=None, isolated=True):
+        self.isolated = isolated
+        self.figures = {}  # 图形编号 -> Figure
+        self.current_figure = None
+        self.current_image = None
+        if on_output is None:
+            self.stdout = io.StringIO()
+            self.stderr = io.StringIO()
+        else:
+            self.stdout = _StreamingBuffer('stdout', on_output)
+            self.stderr = _StreamingBuffer('stderr', on_output)
+        self.plt = PyplotProxy(self) if isolated else _pyplot
+        # 两种模式都不允许用户代码切换后端
+        self.matplotlib = MatplotlibProxy(self.plt)
+
+    @contextmanager
+    def capture_output(self):
+        """只捕获当前线程的标准输出和错误输出"""
+        _install_stream_dispatch()
+        previous = (getattr(_capture_local, 'stdout', None), getattr(_capture_local, 'stderr', None))
+        _capture_local.stdout, _capture_local.stderr = self.stdout, self.stderr
+        try:
+            yield self
+        finally:
+            _capture_local.stdout, _capture_local.stderr = previous
+
+    @contextmanager
+    def enforce_deadline(self, deadline):
+        """
+        在当前线程中检查截止时间（time.monotonic()的值），超过后抛出DeadlineExceeded
+
+        线程无法从外部结束，只能由执行中的代码自己检查：通过sys.settrace在用户代码（exec执行的代码对象
+        及其中定义的函数）的每次调用和每条指令检查，因此死循环也能被中断。用户代码中的纯Python循环
+        因此会慢数倍（线程执行器只适合简单代码）；库函数只在被用户代码调用时进入，内部不检查，
+        matplotlib等纯Python库不会因此变慢。超过截止时间后每次检查都会再次抛出，
+        用户代码捕获后也无法继续运行；阻塞在库函数或C代码中（如time.sleep、大型numpy运算）时
+        要等返回用户代码后才能中断。deadline为None时不检查
+        """
+        if deadline is None:
+            yield self
+            return
+
+        def check(frame, event, arg):
+            if time.monotonic() >= deadline:
+                raise DeadlineExceeded('执行超过截止时间')
+            return check
+
+        def trace(frame, event, arg):
+            if frame.f_code.co_filename != _USER_CODE_FILENAME:
+                return None
+            # 按指令检查：while True: pass 这样只有一条指令的循环不会产生line事件
+            frame.f_trace_opcodes = True
+            return check(frame, event, arg)
+
+        previous = sys.gettrace()
+        sys.settrace(trace)
+        try:
+            yield self
+        finally:
+            sys.settrace(previous)
+
+    def import_hook(self, name, globals=None, locals=None, fromlist=(), level=0):
+        """替换__import__：导入matplotlib/pyplot时返回本上下文的plt和matplotlib代理"""
+        if level == 0:
+            if name == 'matplotlib.pyplot' and fromlist:
+                return self.plt
+            if name == 'matplotlib' or name == 'matplotlib.pyplot':
+                return self.matplotlib
+        return __import__(name, globals, locals, fromlist, level)
+
+    def new_figure(self, num=None, **kwargs):
+        """创建一个不注册到pyplot的图形"""
+        label = ''
+        if isinstance(num, str):
+            label, num = num, None
+        if num is None:
+            num = max(self.figures, default=0) + 1
+        fig = Figure(**kwargs)
+        FigureCanvasAgg(fig)
+        fig.number = num
+        if label:
+            fig.set_label(label)
+        self.figures[num] = fig
+        self.current_figure = fig
+        return fig
+
+    def find_figure(self, num):
+        """按编号、标签或对象查找图形"""
+        if isinstance(num, Figure):
+            return num if num in self.figures.values() else None
+        if isinstance(num, str):
+            for fig in self.figures.values():
+                if fig.get_label() == num:
+                    return fig
+            return None
+        return self.figures.get(num)
+
+    def gcf(self):
+        if not self.isolated:
+            return _pyplot.gcf()
+        if self.current_figure is None:
+            return self.new_figure()
+        return self.current_figure
+
+    def gca(self):
+        return self.gcf().gca()
+
+    def get_fignums(self):
+        if not self.isolated:
+            return _pyplot.get_fignums()
+        return sorted(self.figures)
+
+    def close(self, target=None):
+        """关闭图形，target可以是None（当前图形）、'all'、编号、标签或图形对象"""
+        if isinstance(target, str) and target == 'all':
+            self.close_all()
+            return
+        fig = self.current_figure if target is None else self.find_figure(target)
+        if fig is None:
+            return
+        self.figures = {num: f for num, f in self.figures.items() if f is not fig}
+        if self.current_figure is fig:
+            self.current_figure = self.figures[max(self.figures)] if self.figures else None
+
+    def close_all(self):
+        if not self.isolated:
+            _pyplot.close('all')
+        for fig in self.figures.values():
+            fig.clear()
+        self.figures.clear()
+        self.current_figure = None
+        self.current_image = None
+
+
+class PyplotProxy:
+    """注入到执行环境中的plt对象，行为与pyplot一致但只操作所属上下文的图形"""
+
+    def __init__(self, context):
+        self._ctx = context
+
+    # ---- 图形管理 ----
+    def figure(self, num=None, figsize=None, dpi=None, clear=False, **kwargs):
+        fig = self._ctx.find_figure(num) if num is not None else None
+        if fig is None:
+            if figsize is not None:
+                kwargs['figsize'] = figsize
+            if dpi is not None:
+                kwargs['dpi'] = dpi
+            return self._ctx.new_figure(num, **kwargs)
+        self._ctx.current_figure = fig
+        if clear:
+            fig.clear()
+        return fig
+
+    def gcf(self):
+        return self._ctx.gcf()
+
+    def gca(self):
+        return self._ctx.gca()
+
+    def gci(self):
+        return self._ctx.current_image
+
+    def sci(self, image):
+        self._ctx.current_image = image
+
+    def sca(self, ax):
+        fig = ax.get_figure()
+        self._ctx.current_figure = fig
+        fig.sca(ax)
+
+    def get_fignums(self):
+        return self._ctx.get_fignums()
+
+    def fignum_exists(self, num):
+        return self._ctx.find_figure(num) is not None
+
+    def close(self, fig=None):
+        self._ctx.close(fig)
+
+    def cla(self):
+        self.gca().cla()
+
+    def subplots(self, nrows=1, ncols=1, **kwargs):
+        subplot_kwargs = {k: kwargs.pop(k) for k in list(kwargs) if k in _SUBPLOTS_KWARGS}
+        num = kwargs.pop('num', None)
+        fig = self.figure(num, **kwargs)
+        axs = fig.subplots(nrows, ncols, **subplot_kwargs)
+        return fig, axs
+
+    def subplot_mosaic(self, mosaic, **kwargs):
+        subplot_kwargs = {k: kwargs.pop(k) for k in list(kwargs)
+                          if k in _SUBPLOTS_KWARGS | {'empty_sentinel', 'per_subplot_kw'}}
+        fig = self.figure(kwargs.pop('num', None), **kwargs)
+        return fig, fig.subplot_mosaic(mosaic, **subplot_kwargs)
+
+    def subplot(self, *args, **kwargs):
+        fig = self.gcf()
+        if not args:
+            args = (1, 1, 1)
+        try:
+            spec = SubplotSpec._from_subplot_args(fig, args)
+        except Exception:
+            spec = None
+        if spec is not None and not kwargs:
+            # 与pyplot相同：位置相同的子图直接复用
+            for ax in fig.axes:
+                if hasattr(ax, 'get_subplotspec') and ax.get_subplotspec() == spec:
+                    fig.sca(ax)
+                    return ax
+        return fig.add_subplot(*args, **kwargs)
+
+    def subplot2grid(self, shape, loc, rowspan=1, colspan=1, fig=None, **kwargs):
+        fig = fig or self.gcf()
+        gs = GridSpec(shape[0], shape[1], figure=fig)
+        return fig.add_subplot(gs.new_subplotspec(loc, rowspan=rowspan, colspan=colspan), **kwargs)
+
+    def axes(self, arg=None, **kwargs):
+        fig = self.gcf()
+        if arg is None:
+            return fig.add_subplot(**kwargs)
+        if isinstance(arg, Axes):
+            self.sca(arg)
+            return arg
+        return fig.add_axes(arg, **kwargs)
+
+    def twinx(self, ax=None):
+        return (ax or self.gca()).twinx()
+
+    def twiny(self, ax=None):
+        return (ax or self.gca()).twiny()
+
+    def figtext(self, x, y, s, *args, **kwargs):
+        return self.gcf().text(x, y, s, *args, **kwargs)
+
+    def figlegend(self, *args, **kwargs):
+        return self.gcf().legend(*args, **kwargs)
+
+    def colorbar(self, mappable=None, cax=None, ax=None, **kwargs):
+        if mappable is None:
+            mappable = self._ctx.current_image
+            if mappable is None:
+                raise RuntimeError('No mappable was found to use for colorbar creation.')
+        fig = mappable.axes.get_figure() if getattr(mappable, 'axes', None) else self.gcf()
+        return fig.colorbar(mappable, cax=cax, ax=ax, **kwargs)
+
+    def clim(self, vmin=None, vmax=None):
+        if self._ctx.current_image is None:
+            raise RuntimeError('You must first define an image, e.g., with imshow')
+        self._ctx.current_image.set_clim(vmin, vmax)
+
+    # ---- 坐标轴范围和刻度 ----
+    def xlim(self, *args, **kwargs):
+        ax = self.gca()
+        if not args and not kwargs:
+            return ax.get_xlim()
+        return ax.set_xlim(*args, **kwargs)
+
+    def ylim(self, *args, **kwargs):
+        ax = self.gca()
+        if not args and not kwargs:
+            return ax.get_ylim()
+        return ax.set_ylim(*args, **kwargs)
+
+    def _ticks(self, axis, ticks, labels, minor, kwargs):
+        ax = self.gca()
+        if ticks is None:
+            locs = getattr(ax, f'get_{axis}ticks')(minor=minor)
+            if labels is not None:
+                raise TypeError("xticks(): Parameter 'labels' can't be set without setting 'ticks'")
+        else:
+            locs = getattr(ax, f'set_{axis}ticks')(ticks, minor=minor)
+        if labels is None:
+            labels = getattr(ax, f'get_{axis}ticklabels')(minor=minor)
+            for label in labels:
+                label.update(kwargs)
+        else:
+            labels = getattr(ax, f'set_{axis}ticklabels')(labels, minor=minor, **kwargs)
+        return locs, labels
+
+    def xticks(self, ticks=None, labels=None, *, minor=False, **kwargs):
+        return self._ticks('x', ticks, labels, minor, kwargs)
+
+    def yticks(self, ticks=None, labels=None, *, minor=False, **kwargs):
+        return self._ticks('y', ticks, labels, minor, kwargs)
+
+    # ---- 交互相关的函数在API环境中不需要执行 ----
+    def show(self, *args, **kwargs):
+        pass
+
+    def draw(self):
+        pass
+
+    def pause(self, interval):
+        pass
+
+    def ion(self):
+        pass
+
+    def ioff(self):
+        pass
+
+    def isinteractive(self):
+        return False
+
+    def __getattr__(self, name):
+        if name in _AXES_FUNCTIONS:
+            return self._axes_call(name, name)
+        if name in _AXES_SETTERS:
+            return self._axes_call(name, f'set_{name}')
+        if name in _FIGURE_FUNCTIONS:
+            return getattr(self.gcf(), name)
+        # 其余属性（rcParams、cm、style、get_cmap等）不涉及图形状态，直接使用pyplot
+        return getattr(_pyplot, name)
+
+    def _axes_call(self, name, method):
+        def call(*args, **kwargs):
+            result = getattr(self.gca(), method)(*args, **kwargs)
+            # 与pyplot一样记录最近创建的可映射对象，供colorbar()使用
+            candidate = result[-1] if isinstance(result, tuple) and result else result
+            if isinstance(candidate, ScalarMappable):
+                self._ctx.current_image = candidate
+            return result
+        call.__name__ = name
+        return call
+
+
+class MatplotlibProxy:
+    """注入到执行环境中的matplotlib对象，其pyplot属性指向上下文的plt（PyplotProxy或全局pyplot）"""
+
+    def __init__(self, pyplot_proxy):
+        self.pyplot = pyplot_proxy
+
+    def use(self, *args, **kwargs):
+        # 后端固定为Agg，不允许用户代码切换
+        pass
+
+    def __getattr__(self, name):
+        return getattr(matplotlib, name)
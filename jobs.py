@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步任务
+耗时较长的代码通过 /jobs 提交：提交后立即返回任务ID，客户端轮询状态或通过SSE接收进度和输出，
+不需要在nginx和客户端之间长时间保持一个请求连接：
+- 任务在提交它的uvicorn工作进程中执行，事件（状态变化、阶段、输出）保存在内存中，SSE连接可按事件编号续传
+- 每次状态变化都把任务状态写入 jobs/ 下的JSON文件，多个工作进程时任意进程都能查询状态和结果
+- 相同内容的任务在执行中（或已成功且结果未过期）时重复提交直接返回已有的任务，客户端重试不会重复执行
+- 结束的任务保留JOB_RESULT_TTL秒，之后内存记录和状态文件都被删除
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+# 每个任务在内存中保留的输出上限（字符），超出后不再记录，结束时给出提示
+MAX_OUTPUT_CHARS = 1024 * 1024
+
+
+class Job:
+    """单个任务"""
+
+    def __init__(self, job_id, request_id, dedup_key):
+        self.job_id = job_id
+        self.request_id = request_id
+        self.dedup_key = dedup_key
+        self.status = QUEUED
+        self.phase = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        # 事件列表，编号即下标，SSE断线重连时从Last-Event-ID之后继续
+        self.events = []
+        self.output_chars = 0
+        self.output_truncated = False
+        self.task = None
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def publish(self, event):
+        """记录一个事件并唤醒等待的SSE连接"""
+        kind = event.get('event')
+        if kind == 'output':
+            if self.output_chars >= MAX_OUTPUT_CHARS:
+                self.output_truncated = True
+                return
+            self.output_chars += len(event['text'])
+        elif kind == 'progress':
+            if self.status == QUEUED:
+                self.status = RUNNING
+                self.started_at = time.time()
+            self.phase = event.get('phase')
+        self.events.append(event)
+        # 唤醒当前的等待者，之后的等待者使用新的Event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_events(self, after, timeout):
+        """
+        等待编号大于after的事件
+
+        返回:
+        - 新的事件列表 [(编号, 事件), ...]；超时时返回空列表
+        """
+        if len(self.events) <= after + 1 and not self.finished:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        return [(index, self.events[index]) for index in range(after + 1, len(self.events))]
+
+    def to_dict(self):
+        """任务状态（不含事件），用于接口返回和状态文件"""
+        return {
+            'job_id': self.job_id,
+            'request_id': self.request_id,
+            'status': self.status,
+            'phase': self.phase,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error,
+            'output_truncated': self.output_truncated
+        }
+
+
+class JobManager:
+    """
+    任务管理
+
+    参数:
+    - directory: 状态文件目录
+    - ttl: 结束的任务保留的时间（秒）
+    """
+
+    def __init__(self, directory='jobs', ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        self._jobs = {}
+        # 内容哈希 -> 任务ID，用于合并重复提交
+        self._by_key = {}
+        # (过期时间, 任务ID)，按结束顺序排列，过期时间单调递增
+        self._expiry = deque()
+        self._submitted = 0
+        self._deduplicated = 0
+        # 状态文件按变化顺序写入，后写入的状态不会被先前的写入覆盖
+        self._save_lock = asyncio.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(payload):
+        """任务内容哈希"""
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def find_duplicate(self, dedup_key, reuse_result=True):
+        """
+        查找可以复用的相同任务：仍在执行的任务，或reuse_result为True时已成功的任务
+
+        返回:
+        - Job；没有时返回None
+        """
+        self.sweep()
+        job = self._jobs.get(self._by_key.get(dedup_key))
+        if job is None or job.status in (FAILED, CANCELLED):
+            return None
+        if job.status == SUCCEEDED and not reuse_result:
+            return None
+        self._deduplicated += 1
+        return job
+
+    def submit(self, request_id, dedup_key, run):
+        """
+        创建并启动任务
+
+        参数:
+        - run: 协程函数 run(on_event)，返回任务结果字典；on_event用于接收执行中的事件，
+          抛出的异常由error_detail转换为错误信息
+
+        返回:
+        - Job
+        """
+        self.sweep()
+        job = Job(f"job_{uuid.uuid4().hex}", request_id, dedup_key)
+        self._jobs[job.job_id] = job
+        self._by_key[dedup_key] = job.job_id
+        self._submitted += 1
+        job.task = asyncio.get_running_loop().create_task(self._execute(job, run))
+        return job
+
+    async def _execute(self, job, run):
+        """执行任务并记录结果"""
+        await self._persist(job)
+
+        def on_event(event):
+            queued = job.status == QUEUED
+            job.publish(event)
+            if queued and job.status == RUNNING:
+                asyncio.get_running_loop().create_task(self._persist(job))
+
+        try:
+            job.result = await run(on_event)
+            job.status = SUCCEEDED
+        except asyncio.CancelledError:
+            job.status = CANCELLED
+            job.error = {'status_code': 499, 'detail': '任务已取消'}
+        except Exception as e:
+            job.status = FAILED
+            job.error = error_detail(e)
+        job.finished_at = time.time()
+        self._expiry.append((job.finished_at + self.ttl, job.job_id))
+        job.publish({'event': 'status', 'status': job.status})
+        await self._persist(job)
+
+    async def _persist(self, job):
+        """把任务状态写入状态文件（在线程池中执行）"""
+        async with self._save_lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._save, job.to_dict())
+            except Exception as e:
+                logger.error("[%s] 保存任务状态失败: %s", job.request_id, e, extra={"request_id": job.request_id})
+
+    def get(self, job_id):
+        """内存中的任务；不存在或已过期时返回None"""
+        self.sweep()
+        return self._jobs.get(job_id)
+
+    def load(self, job_id):
+        """
+        从状态文件读取任务状态（任务由其他工作进程执行时使用，阻塞调用）
+
+        返回:
+        - 状态字典；不存在或已过期时返回None
+        """
+        if not _valid_job_id(job_id):
+            return None
+        try:
+            with open(self._path(job_id), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get('finished_at') and state['finished_at'] + self.ttl < time.time():
+            return None
+        return state
+
+    def cancel(self, job_id):
+        """取消执行中的任务，返回是否存在该任务"""
+        job = self.get(job_id)
+        if job is None:
+            return False
+        if not job.finished and job.task is not None:
+            job.task.cancel()
+        return True
+
+    def sweep(self):
+        """删除内存中已过期的任务"""
+        now = time.time()
+        while self._expiry and self._expiry[0][0] < now:
+            _, job_id = self._expiry.popleft()
+            job = self._jobs.pop(job_id, None)
+            if job is not None and self._by_key.get(job.dedup_key) == job_id:
+                del self._by_key[job.dedup_key]
+
+    def sweep_files(self):
+        """删除过期的状态文件（包括其他工作进程的任务），返回删除的文件数（阻塞调用）"""
+        removed = 0
+        deadline = time.time() - self.ttl
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                # 状态文件在任务结束时最后一次写入；执行中的任务不会超过TTL仍未结束
+                if os.path.getmtime(path) < deadline:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def stats(self):
+        """返回任务统计"""
+        counts = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'jobs': len(self._jobs),
+            'by_status': counts,
+            'submitted': self._submitted,
+            'deduplicated': self._deduplicated
+        }
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, state):
+        path = self._path(state['job_id'])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def _valid_job_id(job_id):
+    """任务ID只能由job_和32位十六进制组成，防止路径穿越"""
+    prefix, _, digest = job_id.partition('_')
+    return prefix == 'job' and len(digest) == 32 and all(c in '0123456789abcdef' for c in digest)
+
+
+def error_detail(error):
+    """把任务执行中的异常转换为错误信息字典"""
+    status_code = getattr(error, 'status_code', 500)
+    detail = getattr(error, 'detail', None) or str(error)
+    return {'status_code': status_code, 'detail': detail}
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日志跟踪
+供 view_logs.py monitor 使用，持续输出日志文件新追加的行：
+- Linux上通过inotify监听日志所在目录，有写入时立即读取，空闲时不唤醒；其他平台退回定时轮询
+- 始终只保持一个打开的文件句柄，从上次读取的位置继续读，不重复打开文件
+- 通过inode识别文件被轮转改名（RotatingFileHandler、view_logs.py clear），
+  先读完旧文件剩余的内容，再从头读取新文件；文件变小时视为被截断，从头读取
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify事件掩码，见 <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+# struct inotify_event 的固定部分: wd, mask, cookie, len
+_EVENT_HEADER = struct.Struct('iIII')
+
+# 每次读取的最大字节数
+_READ_SIZE = 64 * 1024
+
+# 即使没有事件也定期检查一次，防止错过事件（例如日志目录被替换）
+_SAFETY_INTERVAL = 5.0
+
+
+class _Inotify:
+    """通过ctypes调用libc的inotify接口，不依赖第三方库"""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"无法监听目录: {directory}")
+
+    def wait(self, timeout):
+        """
+        等待事件
+
+        返回:
+        - 发生变化的文件名集合；队列溢出时返回None，表示需要检查全部文件
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        names = set()
+        if not ready:
+            return names
+        while True:
+            try:
+                data = os.read(self.fd, _READ_SIZE)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                if mask & _IN_Q_OVERFLOW:
+                    return None
+                names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogFollower:
+    """
+    持续读取日志文件新追加的行
+
+    参数:
+    - log_file: 日志文件路径
+    - poll_interval: 无法使用inotify时的轮询间隔（秒）
+    - from_start: 为True时从文件开头读取，否则只读取之后追加的内容
+    - on_reopen: 文件被轮转或截断时的回调，参数为原因说明
+    """
+
+    def __init__(self, log_file='api.log', poll_interval=1.0, from_start=False, on_reopen=None):
+        self.log_file = log_file
+        self.poll_interval = poll_interval
+        self.on_reopen = on_reopen
+        self._name = os.path.basename(log_file)
+        self._file = None
+        self._inode = None
+        self._pending = b''
+        self._inotify = None
+        self.mode = 'polling'
+        if sys.platform.startswith('linux'):
+            try:
+                self._inotify = _Inotify(os.path.dirname(os.path.abspath(log_file)))
+                self.mode = 'inotify'
+            except (OSError, AttributeError):
+                self._inotify = None
+        self._open(from_start)
+
+    def _open(self, from_start):
+        """打开当前的日志文件；文件不存在时等待其被创建"""
+        try:
+            f = open(self.log_file, 'rb')
+        except FileNotFoundError:
+            return False
+        if self._file is not None:
+            self._file.close()
+        self._file = f
+        self._inode = os.fstat(f.fileno()).st_ino
+        self._pending = b''
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+        return True
+
+    def _read_available(self):
+        """读取当前句柄中新追加的完整行"""
+        lines = []
+        if self._file is None:
+            return lines
+        while True:
+            chunk = self._file.read(_READ_SIZE)
+            if not chunk:
+                break
+            pieces = (self._pending + chunk).split(b'\n')
+            # 最后一段是还没写完的行，等下次读取
+            self._pending = pieces.pop()
+            lines.extend(piece.rstrip(b'\r') for piece in pieces if piece)
+        return lines
+
+    def _check_replaced(self):
+        """检查文件是否被轮转或截断，必要时重新打开；产出旧文件中剩余的行"""
+        try:
+            stat = os.stat(self.log_file)
+        except FileNotFoundError:
+            # 已被改名，新文件还未创建；继续保留旧句柄
+            return
+        if self._file is None:
+            if self._open(from_start=True) and self.on_reopen:
+                self.on_reopen("日志文件已创建")
+            return
+        if stat.st_ino != self._inode:
+            # 改名前最后写入旧文件的内容
+            yield from self._read_available()
+            self._open(from_start=True)
+            if self.on_reopen:
+                self.on_reopen("日志文件已轮转")
+        elif stat.st_size < self._file.tell():
+            self._file.seek(0)
+            self._pending = b''
+            if self.on_reopen:
+                self.on_reopen("日志文件已被截断")
+
+    def lines(self):
+        """
+        持续产出新追加的行（bytes，不含换行符）
+
+        没有新内容时阻塞等待；inotify模式下写入后立即返回
+        """
+        try:
+            while True:
+                yield from self._read_available()
+                yield from self._check_replaced()
+                yield from self._read_available()
+                if self._inotify is not None:
+                    names = self._inotify.wait(_SAFETY_INTERVAL)
+                    # 只关心日志文件本身的变化，同目录下其他文件的写入忽略
+                    while names and self._name not in names:
+                        names = self._inotify.wait(_SAFETY_INTERVAL)
+                else:
+                    time.sleep(self.poll_interval)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
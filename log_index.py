@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日志索引
+为每个日志文件（当前文件和轮转备份）维护一个旁路索引，供 view_logs.py 查询：
+- 日志按约256KB分块，记录每块的起始偏移、起始行号、首末时间和各级别行数
+- 记录每个request_id出现在哪些块中
+- 索引按文件inode保存在日志目录的 .log_index/ 下，轮转改名后仍然有效
+- 每次查询前只为新追加的字节更新索引；文件被截断或inode被复用时重建
+按时间范围查询时二分查找起始块，按request_id或级别查询时只读取相关的块
+"""
+
+import bisect
+import hashlib
+import json
+import os
+
+from log_reader import line_level, line_request_id, line_time, log_segments
+
+# 每块的目标大小（字节）
+BLOCK_BYTES = 256 * 1024
+
+# 用于识别inode被复用的文件头长度
+_HEAD_BYTES = 256
+
+# 索引文件格式版本，格式变化时旧索引自动重建
+_VERSION = 1
+
+
+class SegmentIndex:
+    """单个日志文件的索引"""
+
+    def __init__(self, inode, head=''):
+        self.inode = inode
+        self.head = head
+        self.indexed_bytes = 0
+        self.line_count = 0
+        # 每块: [起始偏移, 起始行号, 首个时间, 最后时间, {级别: 行数}]
+        self.blocks = []
+        # request_id -> 出现的块编号列表
+        self.request_ids = {}
+
+    def to_dict(self):
+        return {
+            'version': _VERSION,
+            'inode': self.inode,
+            'head': self.head,
+            'indexed_bytes': self.indexed_bytes,
+            'line_count': self.line_count,
+            'blocks': self.blocks,
+            'request_ids': self.request_ids
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(data['inode'], data['head'])
+        index.indexed_bytes = data['indexed_bytes']
+        index.line_count = data['line_count']
+        index.blocks = data['blocks']
+        index.request_ids = data['request_ids']
+        return index
+
+    def block_range(self, block_id):
+        """块的字节范围 (起始, 结束)"""
+        start = self.blocks[block_id][0]
+        end = self.blocks[block_id + 1][0] if block_id + 1 < len(self.blocks) else self.indexed_bytes
+        return start, end
+
+    def first_block_after(self, since):
+        """最后时间不早于since的第一个块，没有时返回None"""
+        last_times = [block[3] or '' for block in self.blocks]
+        # 各块的最后时间按写入顺序递增，可以二分查找
+        block_id = bisect.bisect_left(last_times, since)
+        return block_id if block_id < len(self.blocks) else None
+
+    def blocks_with_level(self, level):
+        """包含该级别日志的块编号"""
+        return [block_id for block_id, block in enumerate(self.blocks) if block[4].get(level)]
+
+    def level_counts(self):
+        """各级别的行数"""
+        counts = {}
+        for block in self.blocks:
+            for level, count in block[4].items():
+                counts[level] = counts.get(level, 0) + count
+        return counts
+
+    def add_line(self, offset, raw):
+        """把一行加入索引（行内容不含换行符）"""
+        if not self.blocks or offset - self.blocks[-1][0] >= BLOCK_BYTES:
+            self.blocks.append([offset, self.line_count, None, None, {}])
+        block_id = len(self.blocks) - 1
+        block = self.blocks[block_id]
+        timestamp = line_time(raw)
+        if timestamp is not None:
+            if block[2] is None:
+                block[2] = timestamp
+            block[3] = timestamp
+        level = line_level(raw)
+        if level is not None:
+            block[4][level] = block[4].get(level, 0) + 1
+        request_id = line_request_id(raw)
+        if request_id is not None:
+            block_ids = self.request_ids.setdefault(request_id, [])
+            if not block_ids or block_ids[-1] != block_id:
+                block_ids.append(block_id)
+        self.line_count += 1
+
+
+class LogIndex:
+    """日志文件及其轮转备份的索引集合"""
+
+    def __init__(self, log_file='api.log', index_dir=None):
+        self.log_file = log_file
+        self.index_dir = index_dir or os.path.join(os.path.dirname(log_file) or '.', '.log_index')
+
+    def segments(self):
+        """
+        更新并返回全部日志文件的索引，从旧到新排列
+
+        返回:
+        - [(路径, SegmentIndex), ...]
+        """
+        result = []
+        live_inodes = set()
+        for path, inode, size in reversed(log_segments(self.log_file)):
+            index = self._update(path, inode, size)
+            if index is not None:
+                result.append((path, index))
+                live_inodes.add(inode)
+        self._remove_stale(live_inodes)
+        return result
+
+    def _index_path(self, inode):
+        return os.path.join(self.index_dir, f"{inode}.json")
+
+    def _load(self, inode):
+        try:
+            with open(self._index_path(inode), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != _VERSION:
+                return None
+            return SegmentIndex.from_dict(data)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _save(self, index):
+        os.makedirs(self.index_dir, exist_ok=True)
+        path = self._index_path(index.inode)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index.to_dict(), f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def _update(self, path, inode, size):
+        """只为新追加的字节更新索引"""
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            head = hashlib.sha1(f.read(_HEAD_BYTES)).hexdigest()
+            index = self._load(inode)
+            if index is None or index.head != head or index.indexed_bytes > size:
+                # 新文件、inode被复用或文件被截断
+                index = SegmentIndex(inode, head)
+            if index.indexed_bytes == size:
+                return index
+
+            f.seek(index.indexed_bytes)
+            offset = index.indexed_bytes
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 仍在写入的行下次再索引
+                    break
+                index.add_line(offset, line.rstrip(b'\r\n'))
+                offset += len(line)
+            index.indexed_bytes = offset
+        self._save(index)
+        return index
+
+    def _remove_stale(self, live_inodes):
+        """删除已不存在的日志文件的索引"""
+        try:
+            names = os.listdir(self.index_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            inode = name.split('.', 1)[0]
+            if name.endswith('.json') and inode.isdigit() and int(inode) not in live_inodes:
+                try:
+                    os.remove(os.path.join(self.index_dir, name))
+                except FileNotFoundError:
+                    pass
+
+
+def iter_block_lines(path, index, block_ids):
+    """
+    读取指定块中的行
+
+    产出:
+    - (行号, 行内容bytes)
+    """
+    with open(path, 'rb') as f:
+        for block_id in block_ids:
+            start, end = index.block_range(block_id)
+            f.seek(start)
+            line_number = index.blocks[block_id][1]
+            lines = f.read(end - start).split(b'\n')
+            # 块以换行符结尾，最后一段为空
+            lines.pop()
+            for line in lines:
+                line_number += 1
+                if line:
+                    yield line_number, line
+
+
+def iter_lines_from(path, index, block_id):
+    """从指定块开始读取到已索引的末尾"""
+    return iter_block_lines(path, index, range(block_id, len(index.blocks)))
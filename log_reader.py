@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日志读取
+供 /logs 接口和 view_logs.py 使用：
+- 从文件末尾按块向前读取，读取量只与返回的行数有关，与文件大小无关
+- 当前日志文件和轮转出的备份文件（api.log.1、api.log.2 ...）按时间顺序串联；
+  正向读取时也支持压缩归档的备份（api.log.3.gz）
+- 游标由文件的inode和字节偏移组成，文件轮转改名后inode不变，游标仍然有效
+- 级别、request_id、时间范围过滤在逐行读取时进行，不构建完整列表
+"""
+
+import gzip
+import json
+import os
+import re
+
+# 向前读取时每次读取的块大小
+BLOCK_SIZE = 64 * 1024
+
+_CURSOR = re.compile(r'^(\d+):(\d+)$')
+
+# 日志时间格式为 2024-08-12 10:00:00,123，按字符串比较即可确定先后
+_TIME_LENGTH = 23
+_JSON_TIME_PREFIX = b'{"time": "'
+
+_JSON_LEVEL = re.compile(rb'"level": "([A-Z]+)"')
+_TEXT_LEVEL = re.compile(rb' - ([A-Z]+) - ')
+_JSON_REQUEST_ID = re.compile(rb'"request_id": "([^"]+)"')
+_TEXT_REQUEST_ID = re.compile(rb'\[(req_[\w\-]+)\]')
+
+
+class InvalidCursorError(ValueError):
+    """游标格式不正确"""
+
+
+def parse_log_line(line):
+    """
+    解析一行日志，同时支持JSON行格式和旧的文本格式
+
+    返回:
+    - 包含time、level、message等字段的字典；无法解析时返回None
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    line = line.strip()
+    if line.startswith('{'):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+    parts = line.split(' - ', 2)
+    if len(parts) < 3:
+        return None
+    return {'time': parts[0], 'level': parts[1], 'message': parts[2]}
+
+
+def line_time(raw):
+    """不解析整行，直接取出日志时间字符串；无法识别时返回None"""
+    if raw.startswith(_JSON_TIME_PREFIX):
+        start = len(_JSON_TIME_PREFIX)
+        return raw[start:start + _TIME_LENGTH].decode('ascii', errors='replace')
+    if raw[:4].isdigit():
+        return raw[:_TIME_LENGTH].decode('ascii', errors='replace')
+    return None
+
+
+def line_level(raw):
+    """不解析整行，直接取出日志级别"""
+    match = _JSON_LEVEL.search(raw, 0, 120) if raw.startswith(b'{') else _TEXT_LEVEL.search(raw, 0, 80)
+    return match.group(1).decode('ascii') if match else None
+
+
+def line_request_id(raw):
+    """不解析整行，直接取出request_id"""
+    match = _JSON_REQUEST_ID.search(raw) if raw.startswith(b'{') else _TEXT_REQUEST_ID.search(raw)
+    return match.group(1).decode('utf-8', errors='replace') if match else None
+
+
+def normalize_time(value):
+    """把ISO格式（2024-08-12T10:00:00）的时间转换为日志中的格式，便于字符串比较"""
+    if value is None:
+        return None
+    return value.strip().replace('T', ' ')
+
+
+def log_segments(log_file='api.log'):
+    """
+    当前日志文件和轮转备份，从新到旧排列
+
+    返回:
+    - [(路径, inode, 大小), ...]
+    """
+    segments = []
+    index = 0
+    while True:
+        path = log_file if index == 0 else f"{log_file}.{index}"
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if index == 0:
+                index += 1
+                continue
+            break
+        segments.append((path, stat.st_ino, stat.st_size))
+        index += 1
+    return segments
+
+
+def log_files(log_file='api.log'):
+    """
+    当前日志文件和全部备份（包括gzip压缩的备份），从旧到新排列，用于正向流式读取
+    """
+    paths = []
+    index = 1
+    while True:
+        path = f"{log_file}.{index}"
+        if os.path.exists(path):
+            paths.append(path)
+        elif os.path.exists(path + '.gz'):
+            paths.append(path + '.gz')
+        else:
+            break
+        index += 1
+    paths.reverse()
+    if os.path.exists(log_file):
+        paths.append(log_file)
+    return paths
+
+
+def open_log(path):
+    """以二进制方式打开日志文件，.gz文件透明解压"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_lines_reverse(f, end, block_size=BLOCK_SIZE):
+    """
+    从end位置向前逐行读取完整的行
+
+    产出:
+    - (行起始偏移, 行内容bytes，不含换行符)
+    末尾没有换行符的行可能仍在写入，跳过
+    """
+    pos = end
+    buffer = b''
+    tail_skipped = False
+    while pos > 0:
+        read_size = min(block_size, pos)
+        pos -= read_size
+        f.seek(pos)
+        buffer = f.read(read_size) + buffer
+        pieces = buffer.split(b'\n')
+        if not tail_skipped:
+            if len(pieces) == 1:
+                # 还没有找到最后一个换行符，整块都属于未写完的行
+                continue
+            # 最后一个换行符之后是未写完的行（以换行符结尾时为空）
+            pieces.pop()
+            tail_skipped = True
+        # 第一段可能不完整，留到下一块
+        buffer = pieces[0]
+        complete = pieces[1:]
+        offsets = []
+        offset = pos + len(buffer) + 1
+        for piece in complete:
+            offsets.append(offset)
+            offset += len(piece) + 1
+        for offset, piece in zip(reversed(offsets), reversed(complete)):
+            if piece:
+                yield offset, piece
+    if buffer and tail_skipped:
+        yield 0, buffer
+
+
+class LogFilter:
+    """日志过滤条件：级别、request_id前缀、时间范围"""
+
+    def __init__(self, level=None, request_id=None, since=None, until=None):
+        self.level = level.upper() if level else None
+        self.request_id = request_id
+        self.since = normalize_time(since)
+        self.until = normalize_time(until)
+        self._request_id_bytes = request_id.encode('utf-8') if request_id else None
+
+    def before_range(self, raw):
+        """该行是否早于时间范围；向前读取时遇到后即可停止"""
+        if self.since is None:
+            return False
+        timestamp = line_time(raw)
+        return timestamp is not None and timestamp < self.since
+
+    def matches(self, raw):
+        """该行是否满足全部条件；先做字节级的快速检查，只有可能匹配的行才解析"""
+        if self._request_id_bytes is not None and self._request_id_bytes not in raw:
+            return False
+        if self.since is not None or self.until is not None:
+            timestamp = line_time(raw)
+            if timestamp is None:
+                return False
+            if self.since is not None and timestamp < self.since:
+                return False
+            if self.until is not None and timestamp > self.until:
+                return False
+        if self.level is None and self.request_id is None:
+            return True
+        entry = parse_log_line(raw)
+        if entry is None:
+            return False
+        if self.level is not None and entry.get('level') != self.level:
+            return False
+        if self.request_id is not None:
+            request_id = entry.get('request_id') or ''
+            if not request_id.startswith(self.request_id):
+                return False
+        return True
+
+
+def parse_cursor(cursor):
+    """解析游标，返回 (inode, 偏移)"""
+    match = _CURSOR.match(cursor or '')
+    if not match:
+        raise InvalidCursorError(f"无效的游标: {cursor}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def read_logs(log_file='api.log', limit=100, cursor=None, log_filter=None, max_scan=100000):
+    """
+    从新到旧读取满足条件的日志，按时间顺序返回
+
+    参数:
+    - log_file: 当前日志文件
+    - limit: 最多返回的行数
+    - cursor: 上一页返回的next_cursor，从该位置继续向前读取
+    - log_filter: LogFilter，为None时不过滤
+    - max_scan: 单次最多检查的行数，过滤条件很少匹配时避免扫描全部日志
+
+    返回:
+    - (日志行列表, next_cursor)；没有更早的日志时next_cursor为None
+    """
+    segments = log_segments(log_file)
+    start_index = 0
+    start_end = None
+    if cursor:
+        inode, offset = parse_cursor(cursor)
+        for index, (_, segment_inode, _) in enumerate(segments):
+            if segment_inode == inode:
+                start_index, start_end = index, offset
+                break
+        else:
+            # 游标所在的文件已被轮转删除
+            return [], None
+
+    lines = []
+    scanned = 0
+    for index in range(start_index, len(segments)):
+        path, inode, size = segments[index]
+        end = start_end if index == start_index and start_end is not None else size
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        with f:
+            for offset, raw in iter_lines_reverse(f, min(end, size)):
+                scanned += 1
+                if log_filter is not None:
+                    if log_filter.before_range(raw):
+                        lines.reverse()
+                        return lines, None
+                    if not log_filter.matches(raw):
+                        if scanned >= max_scan:
+                            lines.reverse()
+                            return lines, f"{inode}:{offset}"
+                        continue
+                lines.append(raw.decode('utf-8', errors='replace'))
+                if len(lines) >= limit or scanned >= max_scan:
+                    lines.reverse()
+                    return lines, f"{inode}:{offset}"
+    lines.reverse()
+    return lines, None
@@ -3,13 +3,23 @@
 """
 日志配置文件
 提供灵活的日志配置选项，包括文件轮转、格式化等
+- setup_logging: 同步写入的文本日志
+- setup_queue_logging: 记录先放入队列，由后台线程写入JSON行日志，不阻塞请求处理
+  多个进程写同一个日志文件时不能各自轮转（一个进程改名后其他进程仍写入旧文件），
+  此时由外部的logrotate轮转，进程通过WatchedFileHandler发现文件被改名后重新打开
 """
 
+import atexit
+import json
 import logging
 import logging.handlers
 import os
+import queue
 from datetime import datetime
 
+# LogRecord的标准属性，其余属性（通过extra传入）作为结构化字段写入JSON
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
 def setup_logging(
     log_file='api.log',
     log_level=logging.INFO,
@@ -69,6 +79,141 @@ def setup_logging(
     
     return logger
 
+class JsonFormatter(logging.Formatter):
+    """
+    JSON行格式化器
+    每条记录输出一行JSON，包含time、level、logger、message，
+    以及通过extra传入的request_id、phase、duration等字段
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    只合并消息参数，不在调用线程中格式化
+    异常堆栈等由后台线程中的格式化器处理
+    """
+
+    def prepare(self, record):
+        message = record.getMessage()
+        record = logging.makeLogRecord(vars(record))
+        record.msg = message
+        record.args = None
+        return record
+
+class RequestLogAdapter(logging.LoggerAdapter):
+    """
+    请求日志适配器
+    消息前加上 [request_id]，并把request_id与调用时传入的extra字段合并
+    """
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return f"[{self.extra['request_id']}] {msg}", kwargs
+
+class _QueueListener(logging.handlers.QueueListener):
+    """stop()可以重复调用：服务关闭时已经停止的监听器在进程退出时不再报错"""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+# 本进程已经启动的监听器；同一进程中重复调用setup_queue_logging时直接返回
+_listener = None
+
+def setup_queue_logging(
+    log_file='api.log',
+    log_level=logging.INFO,
+    max_bytes=10*1024*1024,  # 10MB
+    backup_count=5,
+    console_output=True,
+    rotate=True
+):
+    """
+    设置非阻塞日志：根logger只把记录放入队列，后台线程负责格式化和写入
+    文件为JSON行格式，控制台为文本格式
+    
+    参数与setup_logging相同，另外：
+    - log_file: 为None时不写日志文件
+    - rotate: 是否由本进程按max_bytes轮转；多个进程写同一个文件时必须为False，
+      改用WatchedFileHandler，由logrotate等外部工具轮转
+    
+    返回:
+    - QueueListener，进程退出时自动停止
+    """
+    global _listener
+    if _listener is not None:
+        # uvicorn以spawn方式启动的工作进程会把main.py导入两次（__mp_main__和main）
+        return _listener
+
+    handlers = []
+    if log_file:
+        if rotate:
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file,
+                maxBytes=max_bytes,
+                backupCount=backup_count,
+                encoding='utf-8'
+            )
+        else:
+            file_handler = logging.handlers.WatchedFileHandler(log_file, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    
+    if console_output:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handlers.append(console_handler)
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    
+    listener = _QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    def after_fork_in_child():
+        # 子进程中没有后台写入线程，改为直接输出到控制台
+        if queue_handler in logger.handlers:
+            logger.removeHandler(queue_handler)
+            logger.addHandler(logging.StreamHandler())
+    os.register_at_fork(after_in_child=after_fork_in_child)
+    
+    if not log_file:
+        logger.info("日志系统初始化完成: 不写日志文件, 级别=%s", logging.getLevelName(log_level))
+    elif rotate:
+        logger.info(
+            "日志系统初始化完成: 文件=%s, 级别=%s, 最大文件大小=%.1fMB, 备份数量=%d",
+            log_file, logging.getLevelName(log_level), max_bytes / (1024*1024), backup_count
+        )
+    else:
+        logger.info(
+            "日志系统初始化完成: 文件=%s, 级别=%s, 由外部工具轮转（进程ID %d）",
+            log_file, logging.getLevelName(log_level), os.getpid()
+        )
+    _listener = listener
+    return listener
+
 def setup_request_logging():
     """设置请求专用的日志记录器"""
     request_logger = logging.getLogger('request')
@@ -1,244 +1,783 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.responses import Response, FileResponse
-from pydantic import BaseModel
-import io
-import sys
-import traceback
-import io
-import sys
-from contextlib import redirect_stdout, redirect_stderr
-import matplotlib
-matplotlib.use('Agg')  # 使用非交互式后端
-import matplotlib.pyplot as plt
-import numpy as np
-from PIL import Image
+from fastapi import FastAPI, HTTPException, UploadFile, File, Header, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, conint
+from typing import Dict, List, Literal, Optional
+import asyncio
 import base64
+import functools
+import keyword
 import logging
+import os
 import time
 import json
+import uuid
 from datetime import datetime
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('api.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+import config
+from logging_config import RequestLogAdapter, setup_queue_logging
+from executor import ExecutorPool, ThreadExecutor, ExecutionTimeoutError, ResourceLimitError, WorkerCrashedError
+from render_cache import RenderCache
+from artifact_store import ArtifactStore
+from code_normalizer import normalize_code, cache_stats as code_cache_stats
+from output_format import EXTENSIONS, MEDIA_TYPES, build_render_options
+from thumbnails import DerivativeCache, UnsupportedDerivativeError
+from file_delivery import HotFileCache, accel_redirect_response, file_response
+from log_reader import InvalidCursorError, LogFilter, read_logs
+from admission import AdmissionController, AdmissionRejected, ClientDisconnected, RateLimiter, cancel_on_disconnect
+from jobs import JobManager
+from datasets import DatasetStore, DatasetTooLargeError, InvalidDatasetError
+from metrics import (
+    REGISTRY, PHASE_SECONDS, REQUEST_SECONDS, REQUESTS_TOTAL, IMAGE_BYTES, IN_FLIGHT, DECIMATION_POINTS
+)
+from warmup import configure_cache_dir, format_timings, warm_up
+
+# 必须在导入matplotlib之前设置，API进程和执行进程共用持久的字体列表缓存
+configure_cache_dir(config.MATPLOTLIB_CACHE_DIR)
+
+# 配置日志：记录放入队列，由后台线程写入JSON行日志文件，不阻塞事件循环
+# 多个uvicorn工作进程共同写入日志文件，不能各自轮转，改由logrotate轮转；
+# 启动工作进程的主进程（python main.py）不处理请求，只输出到控制台
+_multi_worker = config.SERVER_WORKERS > 1
+log_listener = setup_queue_logging(
+    log_file=None if _multi_worker and __name__ == "__main__" else config.LOG_FILE,
+    log_level=getattr(logging, config.LOG_LEVEL, logging.INFO),
+    max_bytes=config.LOG_MAX_SIZE * 1024 * 1024,
+    backup_count=config.LOG_BACKUP_COUNT,
+    console_output=config.LOG_CONSOLE,
+    rotate=not _multi_worker
 )
 logger = logging.getLogger(__name__)
 
 
 app = FastAPI(title="Python代码执行API", description="执行Python代码并返回生成的图片")
 
+# 按内容寻址、分片存放的图片文件存储
+artifact_store = ArtifactStore(
+    directory="picture",
+    max_bytes=config.ARTIFACT_DISK_MB * 1024 * 1024,
+    max_age=config.ARTIFACT_MAX_AGE
+)
+
+# 缩略图等衍生图缓存
+derivative_cache = DerivativeCache(artifact_store, max_bytes=config.THUMBNAIL_CACHE_MB * 1024 * 1024)
+
+# 启动预热参数：API进程和执行进程相同
+WARM_UP_OPTIONS = {
+    "fonts": config.WARMUP_FONTS,
+    "styles": config.WARMUP_STYLES,
+    "preload": config.PRELOAD_MODULES,
+    "render": config.WARMUP_RENDER
+}
+
+# 预热的代码执行进程池
+executor_pool = ExecutorPool(
+    size=config.EXECUTOR_WORKERS,
+    start_method=config.EXECUTOR_START_METHOD,
+    start_timeout=config.WORKER_START_TIMEOUT,
+    memory_limit=config.EXECUTOR_MEMORY_LIMIT_MB * 1024 * 1024,
+    cpu_limit=config.EXECUTOR_CPU_LIMIT,
+    max_jobs=config.EXECUTOR_MAX_JOBS_PER_WORKER,
+    max_rss=config.EXECUTOR_MAX_RSS_MB * 1024 * 1024,
+    warm_up_options=WARM_UP_OPTIONS
+)
+
+# 线程执行器（可选），适合执行耗时很短的简单代码
+thread_executor = ThreadExecutor(config.THREAD_EXECUTOR_WORKERS) if config.THREAD_EXECUTOR_WORKERS > 0 else None
+
+# /download 热门文件的内存缓存
+hot_files = HotFileCache(
+    max_bytes=config.HOT_FILE_CACHE_MB * 1024 * 1024,
+    max_file_bytes=config.HOT_FILE_MAX_KB * 1024
+)
+
+# 渲染结果缓存
+render_cache = RenderCache(
+    artifact_store,
+    index_dir=os.path.join("picture", "index"),
+    memory_max_bytes=config.RENDER_CACHE_MEMORY_MB * 1024 * 1024,
+    memory_max_entries=config.RENDER_CACHE_MEMORY_ENTRIES,
+    ttl=config.RENDER_CACHE_TTL
+)
+
+# 准入控制：限制同时执行的请求数，超出的请求在有界队列中等待
+admission = AdmissionController(
+    max_in_flight=config.ADMISSION_MAX_IN_FLIGHT,
+    max_queue=config.ADMISSION_QUEUE_SIZE,
+    queue_timeout=config.ADMISSION_QUEUE_TIMEOUT
+)
+
+# 按客户端的令牌桶限流（默认不启用）
+rate_limiter = RateLimiter(config.RATE_LIMIT_PER_SECOND, config.RATE_LIMIT_BURST)
+
+# 异步任务
+job_manager = JobManager(directory=config.JOB_DIR, ttl=config.JOB_RESULT_TTL)
+
+# 上传的数据集，执行代码时以只读内存映射的方式注入
+dataset_store = DatasetStore(
+    directory=config.DATASET_DIR,
+    max_bytes=config.DATASET_DISK_MB * 1024 * 1024,
+    max_upload_bytes=config.DATASET_MAX_UPLOAD_MB * 1024 * 1024
+)
+
+# 图片文件后台回收任务
+gc_task = None
+
 class CodeRequest(BaseModel):
     code: str
     timeout: int = 30  # 执行超时时间（秒）
+    cache: bool = True  # 是否使用渲染缓存，代码结果不确定时（如未设置种子的np.random）应设为False
+    # 返回方式：url返回下载链接，png直接返回图片字节，base64将图片嵌入JSON；后两种不写磁盘
+    response_mode: Literal["url", "png", "base64"] = "url"
+    # 执行方式：process在独立工作进程中执行，thread在线程执行器中执行（未启用时回退到process）
+    executor: Literal["process", "thread"] = "process"
+    # 输出编码参数
+    format: Literal["png", "webp", "jpeg", "svg"] = "png"  # 输出格式
+    dpi: conint(ge=10, le=600) = 150  # 分辨率
+    max_width: Optional[conint(ge=16)] = None  # 输出宽度上限（像素），超出时降低DPI
+    max_height: Optional[conint(ge=16)] = None  # 输出高度上限（像素），超出时降低DPI
+    quality: Optional[conint(ge=1, le=100)] = None  # jpeg/webp质量，默认85
+    effort: Literal["fast", "default", "best"] = "default"  # 编码强度，fast适合预览
+    # 注入执行环境的数据集：变量名 -> 数据集ID（POST /datasets 返回）
+    datasets: Optional[Dict[str, str]] = None
+    # 渲染前抽稀大数据量的折线和散点（按输出像素保留形状），输出在视觉上不变
+    decimate: bool = False
+
+def new_request_id():
+    """请求ID：毫秒时间戳加随机后缀，同一毫秒内的并发请求不会重复（日志统计按请求ID关联开始和结束记录）"""
+    return f"req_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+
+def build_base_url(http_request):
+    """下载链接的公开地址：优先使用配置，否则按反向代理传入的请求头推断"""
+    if config.PUBLIC_BASE_URL:
+        return config.PUBLIC_BASE_URL.rstrip("/")
+    headers = http_request.headers
+    scheme = headers.get("x-forwarded-proto", http_request.url.scheme).split(",")[0].strip()
+    host = headers.get("x-forwarded-host") or headers.get("host") or http_request.url.netloc
+    return f"{scheme}://{host.split(',')[0].strip()}"
+
+def client_address(http_request):
+    """客户端地址：经过nginx时使用X-Real-IP，否则使用连接的对端地址"""
+    real_ip = http_request.headers.get("x-real-ip")
+    if real_ip:
+        return real_ip.strip()
+    return http_request.client.host if http_request.client else "unknown"
+
+def check_rate_limit(http_request, cost=1):
+    """按客户端限流，超出时返回429"""
+    wait = rate_limiter.check(client_address(http_request), cost)
+    if wait:
+        REQUESTS_TOTAL.labels("rate_limited").inc()
+        raise HTTPException(
+            status_code=429, detail="请求过于频繁，请稍后重试", headers={"Retry-After": str(wait)}
+        )
+
+def build_download_url(filename, base_url):
+    """构造图片下载链接"""
+    return f"{base_url}/download/{filename}"
+
+def build_image_response(response_mode, image, filename=None, media_type="image/png", base_url=""):
+    """按请求的返回方式构造响应"""
+    if response_mode == "png":
+        return Response(content=image, media_type=media_type)
+    if response_mode == "base64":
+        return {
+            "image_base64": base64.b64encode(image).decode("ascii"),
+            "media_type": media_type,
+            "size": len(image)
+        }
+    return {"download_url": build_download_url(filename, base_url)}
+
+class BatchRequest(BaseModel):
+    items: List[CodeRequest]
+    stream: bool = False  # 是否以NDJSON流式返回，每完成一项返回一行
+
+async def collect_artifacts():
+    """定期回收picture/下的旧图片文件和过期的任务状态文件"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            removed_files, removed_bytes = await loop.run_in_executor(None, artifact_store.collect)
+            if removed_files:
+                # 已删除的文件不能再从内存中下发
+                hot_files.clear()
+                logger.info("图片文件回收完成: 删除%d个文件, 共%d字节", removed_files, removed_bytes)
+            # 过期的任务状态文件，以及超出预算的数据集
+            await loop.run_in_executor(None, job_manager.sweep_files)
+            await loop.run_in_executor(None, dataset_store.collect)
+        except Exception as e:
+            logger.error("图片文件回收失败: %s", e)
+        await asyncio.sleep(config.ARTIFACT_GC_INTERVAL)
+
+# 启动阶段的耗时报告，启动完成前为None
+startup_report = None
+
+@app.on_event("startup")
+async def startup():
+    """完成导入和预热，启动执行器和图片文件回收任务；全部完成后才开始接受请求"""
+    global gc_task, startup_report
+    start_time = time.perf_counter()
+    # 在API进程中完成导入和预热，fork出的执行进程（包括之后替换的进程）直接继承，不再重复导入
+    report = await asyncio.get_running_loop().run_in_executor(None, functools.partial(warm_up, **WARM_UP_OPTIONS))
+    if report["missing_fonts"]:
+        logger.warning("以下字体在系统中不存在: %s", ", ".join(report["missing_fonts"]))
+    if report["missing_styles"]:
+        logger.warning("以下matplotlib样式不存在: %s", ", ".join(report["missing_styles"]))
+
+    executor_start = time.perf_counter()
+    await executor_pool.start()
+    if thread_executor is not None:
+        await thread_executor.start()
+    report["timings"]["executor"] = time.perf_counter() - executor_start
+    report["total"] = time.perf_counter() - start_time
+    startup_report = report
+    logger.info("启动完成，总耗时: %.3f秒 (%s)", report["total"], format_timings(report["timings"]))
+    gc_task = asyncio.create_task(collect_artifacts())
+
+@app.on_event("shutdown")
+async def shutdown():
+    """停止执行器和图片文件回收任务"""
+    if gc_task is not None:
+        gc_task.cancel()
+    await executor_pool.shutdown()
+    if thread_executor is not None:
+        await thread_executor.shutdown()
+
+def record_outcome(outcome, total_time, timings=None, image=None, format=None):
+    """记录一次请求的结果、总耗时和各阶段耗时指标"""
+    REQUESTS_TOTAL.labels(outcome).inc()
+    REQUEST_SECONDS.labels(outcome).observe(total_time)
+    if timings:
+        for phase, seconds in timings.items():
+            PHASE_SECONDS.labels(phase).observe(seconds)
+    if image is not None:
+        IMAGE_BYTES.labels(format).observe(len(image))
+
+async def resolve_datasets(names):
+    """
+    检查变量名并查找数据集文件
+
+    返回:
+    - {变量名: DatasetStore.resolve的描述}；变量名无效时抛出400，数据集不存在时抛出404
+    """
+    loop = asyncio.get_running_loop()
+    resolved = {}
+    for name, dataset_id in names.items():
+        if not name.isidentifier() or keyword.iskeyword(name) or name.startswith('__'):
+            raise HTTPException(status_code=400, detail=f"无效的数据集变量名: {name}")
+        spec = await loop.run_in_executor(None, dataset_store.resolve, dataset_id)
+        if spec is None:
+            raise HTTPException(status_code=404, detail=f"数据集 {dataset_id} 不存在或已被淘汰，请重新上传")
+        resolved[name] = spec
+    return resolved
+
+async def run_code_request(request: CodeRequest, request_id: str, bounded: bool = True, on_event=None):
+    """
+    执行单个代码请求，失败时抛出HTTPException
+    
+    参数:
+    - bounded: 是否受准入控制的队列长度和排队期限限制，已被接受的批量请求和异步任务为False
+    - on_event: 可选回调，接收执行过程中的阶段变化和输出事件
+    
+    返回:
+    - (图片字节, 下载文件名)，不需要写磁盘时文件名为None
+    """
+    IN_FLIGHT.inc()
+    try:
+        return await _run_code_request(request, request_id, bounded, on_event)
+    finally:
+        IN_FLIGHT.dec()
+
+async def _run_code_request(request: CodeRequest, request_id: str, bounded: bool, on_event):
+    """run_code_request的实现"""
+    start_time = time.time()
+    log = RequestLogAdapter(logger, {"request_id": request_id})
+    log.info(
+        "开始处理代码执行请求: timeout=%ss, 代码长度=%d字符", request.timeout, len(request.code),
+        extra={"phase": "start"}
+    )
+    
+    render_options = build_render_options(
+        request.format, request.dpi, request.max_width, request.max_height, request.quality, request.effort
+    )
+    extension = EXTENSIONS[request.format]
+    
+    # 查询渲染缓存，命中时直接返回已有图片，不再执行代码
+    loop = asyncio.get_running_loop()
+    use_cache = config.RENDER_CACHE_ENABLED and request.cache
+    cache_key = None
+    if use_cache:
+        # 数据集ID即内容哈希，数据相同的请求可以共用缓存；抽稀的输出与原图不是逐像素相同，单独缓存
+        key_options = dict(render_options)
+        if request.datasets:
+            key_options["datasets"] = request.datasets
+        if request.decimate:
+            key_options["decimate"] = True
+        cache_key = RenderCache.make_key(normalize_code(request.code).digest, key_options)
+        cached = render_cache.get_memory(cache_key)
+        tier = "内存"
+        if cached is None:
+            cached = await loop.run_in_executor(None, render_cache.get_disk, cache_key)
+            tier = "磁盘"
+        if cached is not None:
+            filename = None
+            if request.response_mode == "url":
+                # 只在内存中缓存过的图片需要先写入磁盘才能下载
+                filename = await loop.run_in_executor(None, render_cache.persist, cache_key, cached, extension)
+            total_time = time.time() - start_time
+            log.info(
+                "命中渲染缓存(%s)，总耗时: %.3f秒", tier, total_time,
+                extra={"phase": "total", "duration": total_time, "outcome": "cache_hit", "size": len(cached)}
+            )
+            record_outcome("cache_hit", total_time, image=cached, format=request.format)
+            return cached, filename
+    else:
+        render_cache.record_bypass()
+    
+    datasets = None
+    if request.datasets:
+        try:
+            datasets = await resolve_datasets(request.datasets)
+        except HTTPException as e:
+            total_time = time.time() - start_time
+            log.warning(
+                "%s，总耗时: %.3f秒", e.detail, total_time,
+                extra={"phase": "total", "duration": total_time, "outcome": "error"}
+            )
+            record_outcome("error", total_time)
+            raise
+    
+    try:
+        # 缓存未命中的请求需要先获得执行槽；服务繁忙时在有界队列中等待，队列已满或等待超时立即拒绝
+        admission_wait = await admission.acquire(bounded)
+        exec_start = time.perf_counter()
+        try:
+            # 代码在执行器的工作进程或线程中运行，不阻塞事件循环
+            log.debug("开始执行Python代码", extra={"phase": "exec"})
+            # 线程执行器未启用或线程都被超时的任务占用时回退到进程执行
+            use_thread = request.executor == "thread" and thread_executor is not None and thread_executor.available
+            executor = thread_executor if use_thread else executor_pool
+            result = await executor.run(
+                {"code": request.code, "render": render_options, "datasets": datasets, "decimate": request.decimate},
+                timeout=request.timeout, on_event=on_event
+            )
+        finally:
+            admission.release(time.perf_counter() - exec_start)
+        # 排队时间包括准入队列和执行器空闲队列中的等待
+        timings = result.setdefault("timings", {})
+        timings["queue_wait"] = timings.get("queue_wait", 0.0) + admission_wait
+    except AdmissionRejected as e:
+        total_time = time.time() - start_time
+        log.warning(
+            "%s (%s)，总耗时: %.3f秒", e, e.reason, total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "rejected"}
+        )
+        record_outcome("rejected", total_time)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except asyncio.CancelledError:
+        # 客户端已断开：排队中的请求直接出队，正在执行的工作进程被结束
+        total_time = time.time() - start_time
+        log.info(
+            "客户端已断开，取消执行，总耗时: %.3f秒", total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "cancelled"}
+        )
+        record_outcome("cancelled", total_time)
+        raise
+    except ExecutionTimeoutError as e:
+        total_time = time.time() - start_time
+        log.error(
+            "%s，总耗时: %.3f秒", e, total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "timeout"}
+        )
+        record_outcome("timeout", total_time)
+        raise HTTPException(status_code=408, detail=str(e))
+    except WorkerCrashedError as e:
+        total_time = time.time() - start_time
+        log.error(
+            "%s，总耗时: %.3f秒", e, total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "crashed"}
+        )
+        record_outcome("crashed", total_time)
+        raise HTTPException(status_code=500, detail=f"代码执行失败: {e}")
+    except ResourceLimitError as e:
+        total_time = time.time() - start_time
+        log.error(
+            "%s，总耗时: %.3f秒", e, total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "resource_limit"}
+        )
+        record_outcome("resource_limit", total_time)
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if result["status"] == "resource_limit":
+        # 内存或CPU时间超出限制，工作进程已被回收替换
+        total_time = time.time() - start_time
+        log.error(
+            "资源超出限制: %s，总耗时: %.3f秒", result["error"], total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "resource_limit"}
+        )
+        record_outcome("resource_limit", total_time, result.get("timings"))
+        raise HTTPException(status_code=400, detail=f"资源超出限制: {result['error']}")
+    
+    if result["status"] == "error":
+        # 错误信息和堆栈只记录一条，堆栈作为单独的字段
+        total_time = time.time() - start_time
+        log.error(
+            "代码执行失败: %s，总耗时: %.3f秒", result["error"], total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "error", "traceback": result["traceback"]}
+        )
+        record_outcome("error", total_time, result.get("timings"))
+        
+        # 返回详细的错误信息
+        error_msg = f"代码执行失败: {result['error']}\n\n错误详情:\n{result['traceback']}"
+        raise HTTPException(status_code=400, detail=error_msg)
+    
+    if result["status"] == "no_figure":
+        # 如果没有生成图片，记录警告并返回错误信息
+        total_time = time.time() - start_time
+        log.warning(
+            "代码执行成功但未生成图片，总耗时: %.3f秒", total_time,
+            extra={"phase": "total", "duration": total_time, "outcome": "no_figure"}
+        )
+        record_outcome("no_figure", total_time, result.get("timings"))
+        raise HTTPException(
+            status_code=400, 
+            detail="代码执行成功但未生成图片。请确保代码中包含matplotlib绘图代码。"
+        )
+    
+    image = result["image"]
+    timings = result["timings"]
+    write_start = time.perf_counter()
+    filename = None
+    if request.response_mode != "url":
+        # 图片直接随响应返回，不写磁盘
+        if use_cache:
+            render_cache.put_memory(cache_key, image)
+    elif use_cache:
+        # 写入图片存储并记录缓存索引，相同的请求可以直接复用
+        filename = await loop.run_in_executor(None, render_cache.put, cache_key, image, extension)
+    else:
+        # 文件名为图片内容的哈希，并发请求不会互相覆盖（在线程池中执行，不阻塞事件循环）
+        filename = await loop.run_in_executor(None, artifact_store.put, image, extension)
+    timings["write"] = time.perf_counter() - write_start
+    if filename:
+        log.debug("图片保存成功: %s, 大小: %d 字节", filename, len(image), extra={"phase": "write"})
+    
+    # 总耗时和各阶段耗时合并为一条记录，抽稀的点数报告附在其中
+    total_time = time.time() - start_time
+    extra = {"phase": "total", "duration": total_time, "outcome": "ok", "timings": timings, "size": len(image)}
+    decimation = result.get("decimation")
+    if decimation:
+        extra["decimation"] = decimation
+        for kind, entry in decimation.items():
+            DECIMATION_POINTS.labels(kind, "before").inc(entry["before"])
+            DECIMATION_POINTS.labels(kind, "after").inc(entry["after"])
+    log.info(
+        "请求处理完成，总耗时: %.3f秒 (排队=%.3f, 预处理=%.3f, 执行=%.3f, 渲染=%.3f, 写入=%.3f)",
+        total_time, timings["queue_wait"], timings["preprocess"], timings["exec"], timings["render"],
+        timings["write"],
+        extra=extra
+    )
+    record_outcome("ok", total_time, timings, image, request.format)
+    
+    return image, filename
 
 @app.post("/execute-code")
-async def execute_code(request: CodeRequest):
+async def execute_code(request: CodeRequest, http_request: Request):
     """
     执行Python代码并返回生成的图片
     
     参数:
     - code: 要执行的Python代码字符串
     - timeout: 执行超时时间（秒），默认30秒
+    - cache: 是否使用渲染缓存，默认True
+    - response_mode: 返回方式（url / png / base64），默认url
+    - executor: 执行方式（process / thread），默认process
+    - format / dpi / max_width / max_height / quality / effort: 输出编码参数
+    - decimate: 渲染前抽稀大数据量的折线和散点，默认False
     
     返回:
-    - 图片数据（PNG格式）
+    - url: 图片下载链接
+    - png: 图片字节（Content-Type与format一致）
+    - base64: 包含Base64编码图片的JSON
     """
-    # 记录请求开始
-    start_time = time.time()
-    request_id = f"req_{int(start_time * 1000)}"
+    check_rate_limit(http_request)
+    request_id = new_request_id()
+    try:
+        # 客户端断开连接时取消仍在排队或执行的请求，不再浪费执行资源
+        image, filename = await cancel_on_disconnect(http_request.receive, run_code_request(request, request_id))
+    except ClientDisconnected:
+        return Response(status_code=499)
+    return build_image_response(
+        request.response_mode, image, filename, MEDIA_TYPES[request.format], build_base_url(http_request)
+    )
+
+@app.post("/execute-batch")
+async def execute_batch(request: BatchRequest, http_request: Request):
+    """
+    批量执行Python代码，各项并行分派到执行器的工作进程
     
-    logger.info(f"[{request_id}] 开始处理代码执行请求")
-    logger.info(f"[{request_id}] 请求参数: timeout={request.timeout}s, 代码长度={len(request.code)}字符")
+    参数:
+    - items: CodeRequest列表，每项单独返回结果或错误，互不影响
+    - stream: 是否以NDJSON流式返回（按完成顺序，每行带index）
+    
+    返回:
+    - 每项的结果；response_mode为png的项在批量接口中以base64返回
+    """
+    if len(request.items) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"批量请求最多包含{config.BATCH_MAX_ITEMS}项")
+    check_rate_limit(http_request, len(request.items))
+    if admission.saturated():
+        raise HTTPException(
+            status_code=429, detail="服务繁忙，等待队列已满，请稍后重试",
+            headers={"Retry-After": str(admission.retry_after())}
+        )
+    
+    batch_id = new_request_id()
+    base_url = build_base_url(http_request)
+    logger.info("[%s] 开始处理批量执行请求，共%d项", batch_id, len(request.items), extra={"request_id": batch_id})
+    
+    async def run_item(index, item):
+        try:
+            # 批量请求已被接受，各项在队列中等待执行，不受队列长度和排队期限限制
+            image, filename = await run_code_request(item, f"{batch_id}_{index}", bounded=False)
+        except HTTPException as e:
+            return {"index": index, "status": "error", "status_code": e.status_code, "error": e.detail}
+        except Exception as e:
+            logger.exception("[%s_%d] 批量项执行失败: %s", batch_id, index, e, extra={"request_id": f"{batch_id}_{index}"})
+            return {"index": index, "status": "error", "status_code": 500, "error": str(e)}
+        response_mode = "base64" if item.response_mode == "png" else item.response_mode
+        body = build_image_response(response_mode, image, filename, MEDIA_TYPES[item.format], base_url)
+        return {"index": index, "status": "ok", **body}
+    
+    tasks = [asyncio.create_task(run_item(index, item)) for index, item in enumerate(request.items)]
+    
+    if request.stream:
+        async def generate():
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    yield json.dumps(await next_done, ensure_ascii=False) + "\n"
+            finally:
+                # 客户端断开时取消尚未完成的项
+                for task in tasks:
+                    task.cancel()
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
     
     try:
-        # 记录代码执行开始
-        logger.info(f"[{request_id}] 开始执行Python代码")
-        
-        # 预处理代码，去除以```python开头和以```结尾的内容
-        code_to_execute = request.code
-        if code_to_execute.startswith('```python'):
-            code_to_execute = code_to_execute[9:]  # 去除开头的```python
-        if code_to_execute.endswith('```'):
-            code_to_execute = code_to_execute[:-3]  # 去除结尾的```
-        
-        # 处理单行代码的情况，将分号分隔的代码拆分为多行
-        if ';' in code_to_execute and '\n' not in code_to_execute:
-            code_to_execute = code_to_execute.replace('; ', '\n').replace(';', '\n')
-        
-        # 处理单行中的多个import语句
-        if 'import ' in code_to_execute and code_to_execute.count('import ') > 1 and '\n' not in code_to_execute:
-            # 将多个import语句分隔开
-            import_parts = code_to_execute.split('import ')
-            if import_parts[0] == '':
-                import_parts = import_parts[1:]
-            code_to_execute = '\n'.join([f'import {part}' for part in import_parts if part.strip()])
-        
-        # 修复缩进问题
-        lines = code_to_execute.split('\n')
-        # 移除空行和只包含空格的行
-        lines = [line for line in lines if line.strip()]
-        # 计算最小缩进
-        min_indent = float('inf')
-        for line in lines:
-            if line.strip():
-                indent = len(line) - len(line.lstrip())
-                min_indent = min(min_indent, indent)
-        # 如果所有行都有缩进，则移除公共缩进
-        if min_indent != float('inf') and min_indent > 0:
-            lines = [line[min_indent:] if len(line) >= min_indent else line for line in lines]
-        code_to_execute = '\n'.join(lines)
-        
-        # 替换plt.show()为plt.savefig()，确保在API环境中能够生成图片文件
-        code_to_execute = code_to_execute.replace('plt.show()', 'plt.savefig("output.png")')
-        
-        # 创建安全的执行环境，预导入所有必要的库
-        local_vars = {
-            'plt': plt,
-            'np': np,
-            'Image': Image,
-            'io': io,
-            'base64': base64,
-            'matplotlib': matplotlib,
-            'sys': sys,
-            'traceback': traceback,
-            'time': time
-        }
-        
-        # 定义允许的内置函数
-        allowed_builtins = {
-            '__import__': __import__,
-            'print': print,
-            'len': len,
-            'range': range,
-            'list': list,
-            'dict': dict,
-            'str': str,
-            'int': int,
-            'float': float,
-            'bool': bool,
-            'exec': exec,
-            'eval': eval,
-            'enumerate': enumerate,
-            'zip': zip,
-            'map': map,
-            'filter': filter,
-            'sum': sum,
-            'max': max,
-            'min': min,
-            'abs': abs,
-            'round': round,
-            'sorted': sorted,
-            'reversed': reversed,
-            'any': any,
-            'all': all,
-            'isinstance': isinstance,
-            'hasattr': hasattr,
-            'getattr': getattr,
-            'setattr': setattr,
-            'callable': callable,
-            'open': open,
-            'type': type,
-            'issubclass': issubclass,
-            'iter': iter,
-            'next': next
-        }
-        
-        # 重定向标准输出和错误输出
-        stdout_capture = io.StringIO()
-        stderr_capture = io.StringIO()
-        
-        with redirect_stdout(stdout_capture), redirect_stderr(stderr_capture):
-            # 执行代码，使用预配置的环境
-            exec(code_to_execute, {"__builtins__": allowed_builtins}, local_vars)
-        
-        # 记录代码执行完成
-        logger.info(f"[{request_id}] Python代码执行完成")
-        
-        # 检查是否有matplotlib图形
-        if plt.get_fignums():
-            # 获取当前图形
-            fig = plt.gcf()
-            
-            # 保存图片到临时文件
-            fig.savefig("output.png")
-            
-            # 生成唯一的文件名
-            import os
-            timestamp = int(time.time())
-            filename = f"output_{timestamp}.png"
-            filepath = os.path.join("picture", filename)
-            
-            # 确保picture文件夹存在
-            os.makedirs("picture", exist_ok=True)
-            
-            # 记录图片保存开始
-            logger.info(f"[{request_id}] 开始保存图片到文件: {filepath}")
-            
-            # 将图形保存到文件
-            fig.savefig(filepath, format='png', dpi=150, bbox_inches='tight')
-            
-            # 确保文件写入完成
-            import os
-            with open(filepath, 'r') as f:
-                os.fsync(f.fileno())
-            
-            # 获取文件大小
-            file_size = os.path.getsize(filepath)
-            logger.info(f"[{request_id}] 图片保存成功: {filepath}, 大小: {file_size} 字节")
-            
-            # 同时保存到内存中的字节流用于返回
-            img_buffer = io.BytesIO()
-            fig.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
-            img_buffer.seek(0)
-            
-            # 清理图形
-            plt.close('all')
-            
-            # 计算总耗时
-            total_time = time.time() - start_time
-            logger.info(f"[{request_id}] 请求处理完成，总耗时: {total_time:.3f}秒")
-            
-            # 返回图片下载链接
-            #download_url = f"http://localhost:8000/download/{filename}"
-            # 部署阿里云时用这个
-            download_url = f"http://114.55.226.87:8000/download/{filename}" 
-            return {"download_url": download_url}
-        else:
-            # 如果没有生成图片，记录警告并返回错误信息
-            logger.warning(f"[{request_id}] 代码执行成功但未生成图片")
+        results = await cancel_on_disconnect(http_request.receive, asyncio.gather(*tasks))
+    except ClientDisconnected:
+        logger.info("[%s] 客户端已断开，取消批量请求", batch_id, extra={"request_id": batch_id})
+        return Response(status_code=499)
+    succeeded = sum(1 for item in results if item["status"] == "ok")
+    logger.info(
+        "[%s] 批量执行完成: 成功%d项, 失败%d项", batch_id, succeeded, len(results) - succeeded,
+        extra={"request_id": batch_id}
+    )
+    return {
+        "count": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    }
+
+def format_sse(event, data, event_id=None):
+    """构造一条SSE消息"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: CodeRequest, http_request: Request):
+    """
+    提交异步任务，立即返回任务ID，适合执行时间较长的代码
+    
+    参数与/execute-code相同；response_mode为png时结果以base64返回
+    
+    返回:
+    - job_id、状态，以及查询状态（status_url）和接收进度（events_url）的地址
+    - 相同内容的任务仍在执行或已成功时直接返回该任务，deduplicated为true
+    """
+    base_url = build_base_url(http_request)
+    payload = request.dict()
+    dedup_key = JobManager.make_key(payload)
+    # 不使用缓存的请求只合并仍在执行的任务，不复用已完成的结果
+    job = job_manager.find_duplicate(dedup_key, reuse_result=request.cache)
+    deduplicated = job is not None
+    if job is None:
+        check_rate_limit(http_request)
+        if admission.saturated():
             raise HTTPException(
-                status_code=400, 
-                detail="代码执行成功但未生成图片。请确保代码中包含matplotlib绘图代码。"
+                status_code=429, detail="服务繁忙，等待队列已满，请稍后重试",
+                headers={"Retry-After": str(admission.retry_after())}
             )
-            
-    except Exception as e:
-        # 记录错误信息
-        error_msg = f"代码执行失败: {str(e)}"
-        logger.error(f"[{request_id}] {error_msg}")
-        logger.error(f"[{request_id}] 错误详情: {traceback.format_exc()}")
+        request_id = new_request_id()
         
-        # 计算总耗时
-        total_time = time.time() - start_time
-        logger.error(f"[{request_id}] 请求处理失败，总耗时: {total_time:.3f}秒")
+        async def run(on_event):
+            # 任务已被接受，排队等待执行槽，不受队列长度和排队期限限制
+            image, filename = await run_code_request(request, request_id, bounded=False, on_event=on_event)
+            response_mode = "base64" if request.response_mode == "png" else request.response_mode
+            return build_image_response(response_mode, image, filename, MEDIA_TYPES[request.format], base_url)
         
-        # 返回详细的错误信息
-        error_msg = f"代码执行失败: {str(e)}\n\n错误详情:\n{traceback.format_exc()}"
-        raise HTTPException(status_code=400, detail=error_msg)
+        job = job_manager.submit(request_id, dedup_key, run)
+        logger.info("[%s] 已提交异步任务 %s", request_id, job.job_id, extra={"request_id": request_id})
+    return {
+        "job_id": job.job_id,
+        "request_id": job.request_id,
+        "status": job.status,
+        "deduplicated": deduplicated,
+        "status_url": f"{base_url}/jobs/{job.job_id}",
+        "events_url": f"{base_url}/jobs/{job.job_id}/events"
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    查询异步任务的状态和结果
+    
+    返回:
+    - status: queued / running / succeeded / failed / cancelled
+    - result: 成功时的结果（下载链接或base64图片）
+    - error: 失败时的状态码和错误信息
+    """
+    job = job_manager.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    # 任务可能由其他uvicorn工作进程执行，读取状态文件
+    state = await asyncio.get_running_loop().run_in_executor(None, job_manager.load, job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="任务不存在或结果已过期")
+    return state
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    """
+    以Server-Sent Events推送异步任务的进度和输出
+    
+    事件:
+    - state: 连接时的任务状态
+    - progress: 执行阶段变化（exec / render）
+    - output: 执行中捕获的标准输出和错误输出（stream / text）
+    - status: 任务结束
+    - result: 最终的任务状态和结果，之后连接关闭
+    断线重连时浏览器会带上Last-Event-ID，从之后的事件继续推送
+    """
+    loop = asyncio.get_running_loop()
+    job = job_manager.get(job_id)
+    state = job.to_dict() if job is not None else await loop.run_in_executor(None, job_manager.load, job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="任务不存在或结果已过期")
+    try:
+        last = int(last_event_id) if last_event_id is not None else -1
+    except ValueError:
+        last = -1
+    
+    async def stream_local(last):
+        yield format_sse("state", state)
+        while True:
+            events = await job.wait_events(last, config.JOB_SSE_KEEPALIVE)
+            for index, event in events:
+                yield format_sse(event["event"], event, index)
+                last = index
+            if job.finished and last >= len(job.events) - 1:
+                yield format_sse("result", job.to_dict())
+                return
+            if not events:
+                # 心跳，防止代理因空闲关闭连接
+                yield ": keepalive\n\n"
+    
+    async def stream_remote(state):
+        # 其他工作进程执行的任务只能读取状态文件，状态变化时推送
+        yield format_sse("state", state)
+        waited = 0.0
+        while state["status"] not in ("succeeded", "failed", "cancelled"):
+            await asyncio.sleep(1.0)
+            waited += 1.0
+            current = await loop.run_in_executor(None, job_manager.load, job_id)
+            if current is None:
+                return
+            if current["status"] != state["status"]:
+                yield format_sse("status", {"event": "status", "status": current["status"]})
+                waited = 0.0
+            elif waited >= config.JOB_SSE_KEEPALIVE:
+                yield ": keepalive\n\n"
+                waited = 0.0
+            state = current
+        yield format_sse("result", state)
+    
+    stream = stream_local(last) if job is not None else stream_remote(state)
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        # 禁止nginx缓冲，事件立即到达客户端
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """取消排队或执行中的异步任务，执行中的工作进程会被结束"""
+    if job_manager.cancel(job_id):
+        return job_manager.get(job_id).to_dict()
+    state = await asyncio.get_running_loop().run_in_executor(None, job_manager.load, job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="任务不存在或结果已过期")
+    raise HTTPException(status_code=409, detail="任务由其他工作进程执行，请在提交任务的进程上取消")
+
+@app.post("/datasets")
+async def upload_dataset(file: UploadFile = File(...)):
+    """
+    上传数据集
+
+    参数:
+    - file: .npy、.npz 或数值CSV文件（CSV有表头时每列为一个数组）
+
+    返回:
+    - dataset_id（内容哈希）、格式、各数组的形状和类型；相同内容重复上传时deduplicated为true
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        manifest, deduplicated = await loop.run_in_executor(None, dataset_store.add, file.file, file.filename)
+    except DatasetTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidDatasetError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await file.close()
+    logger.info(
+        "数据集%s: %s (%s, %d字节)", "已存在" if deduplicated else "上传完成",
+        manifest["dataset_id"], manifest["format"], manifest["bytes"]
+    )
+    return dict(manifest, deduplicated=deduplicated)
+
+@app.get("/datasets/{dataset_id}")
+async def get_dataset(dataset_id: str):
+    """查询数据集的格式、数组形状和类型"""
+    manifest = await asyncio.get_running_loop().run_in_executor(None, dataset_store.get, dataset_id, False)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="数据集不存在或已被淘汰")
+    return manifest
+
+@app.delete("/datasets/{dataset_id}")
+async def delete_dataset(dataset_id: str):
+    """删除数据集"""
+    if not await asyncio.get_running_loop().run_in_executor(None, dataset_store.remove, dataset_id):
+        raise HTTPException(status_code=404, detail="数据集不存在或已被淘汰")
+    return {"dataset_id": dataset_id, "deleted": True}
 
 @app.get("/")
 async def root():
     """API根路径，返回使用说明"""
-    logger.info("访问API根路径")
+    logger.debug("访问API根路径")
     return {
         "message": "Python代码执行API",
         "endpoints": {
-            "/execute-code": "POST - 执行Python代码并返回图片下载链接",
-            "/download/{filename}": "GET - 下载生成的图片",
+            "/execute-code": "POST - 执行Python代码并返回图片（下载链接、PNG字节或Base64）",
+            "/execute-batch": "POST - 批量并行执行Python代码",
+            "/datasets": "POST - 上传数据集（.npy / .npz / CSV），返回在/execute-code中引用的数据集ID",
+            "/jobs": "POST - 提交异步任务；GET /jobs/{job_id} 查询状态和结果，/jobs/{job_id}/events 以SSE接收进度",
+            "/download/{filename}": "GET - 下载生成的图片，可用width/height/format获取缩略图",
+            "/cache/stats": "GET - 获取渲染缓存命中统计",
+            "/metrics": "GET - Prometheus格式的性能指标",
             "/": "GET - 获取API信息"
         },
         "usage": "向/execute-code发送POST请求，包含Python代码，API将执行代码并返回生成的图片下载链接"
@@ -247,53 +786,214 @@ async def root():
 @app.get("/health")
 async def health_check():
     """健康检查接口"""
-    logger.info("健康检查请求")
-    return {"status": "healthy", "message": "API运行正常"}
+    logger.debug("健康检查请求")
+    if startup_report is None:
+        return Response(
+            content=json.dumps({"status": "starting", "message": "服务正在启动"}, ensure_ascii=False),
+            status_code=503, media_type="application/json"
+        )
+    return {"status": "healthy", "message": "API运行正常", "startup": startup_report}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """渲染缓存、衍生图缓存和图片存储统计"""
+    stats = render_cache.stats()
+    stats["derivatives"] = derivative_cache.stats()
+    stats["artifacts"] = artifact_store.stats()
+    stats["hot_files"] = hot_files.stats()
+    stats["datasets"] = await asyncio.get_running_loop().run_in_executor(None, dataset_store.stats)
+    return stats
+
+def collect_component_metrics():
+    """抓取时读取执行器、缓存和存储的统计，转换为指标"""
+    pool = executor_pool.stats()
+    render = render_cache.stats()
+    artifacts = artifact_store.stats()
+    derivatives = derivative_cache.stats()
+    hot = hot_files.stats()
+    code = code_cache_stats()
+    admitted = admission.stats()
+    collected = [
+        ("code_exec_executor_workers", "gauge", "执行进程数", [({}, pool["workers"])]),
+        ("code_exec_executor_idle", "gauge", "空闲的执行进程数", [({}, pool["idle"])]),
+        ("code_exec_executor_replaced_total", "counter", "因超时或崩溃被替换的执行进程数", [({}, pool["replaced"])]),
+        ("code_exec_executor_recycled_total", "counter", "因任务数、常驻内存或资源超限被回收的执行进程数", [
+            ({}, pool["recycled"])
+        ]),
+        ("code_exec_executor_rss_bytes", "gauge", "执行进程的常驻内存总量", [({}, pool["rss_bytes"])]),
+        ("code_exec_startup_seconds", "gauge", "启动阶段各步骤的耗时", [
+            ({"phase": phase}, seconds) for phase, seconds in (startup_report or {"timings": {}})["timings"].items()
+        ]),
+        ("code_exec_admission_executing", "gauge", "已获得执行槽的请求数", [({}, admitted["in_flight"])]),
+        ("code_exec_admission_queued", "gauge", "排队等待执行槽的请求数", [({}, admitted["queued"])]),
+        ("code_exec_admission_rejected_total", "counter", "准入控制拒绝的请求数，按原因分类", [
+            ({"reason": reason}, count) for reason, count in admitted["rejected"].items()
+        ]),
+        ("code_exec_rate_limited_total", "counter", "按客户端限流拒绝的请求数", [({}, rate_limiter.stats()["limited"])]),
+        ("code_exec_jobs", "gauge", "内存中的异步任务数，按状态分类", [
+            ({"status": status}, count) for status, count in job_manager.stats()["by_status"].items()
+        ]),
+        ("code_exec_dataset_uploads_total", "counter", "数据集上传次数，按是否为重复内容分类", [
+            ({"result": "created"}, dataset_store.uploads - dataset_store.deduplicated),
+            ({"result": "deduplicated"}, dataset_store.deduplicated)
+        ]),
+        ("code_exec_dataset_evictions_total", "counter", "超出存储预算而淘汰的数据集数", [({}, dataset_store.evictions)]),
+        ("code_exec_render_cache_lookups_total", "counter", "渲染缓存查询次数，按结果分类", [
+            ({"result": "hit_memory"}, render["hits_memory"]),
+            ({"result": "hit_disk"}, render["hits_disk"]),
+            ({"result": "miss"}, render["misses"]),
+            ({"result": "bypassed"}, render["bypassed"])
+        ]),
+        ("code_exec_render_cache_evictions_total", "counter", "渲染缓存淘汰的条目数", [({}, render["evictions"])]),
+        ("code_exec_render_cache_memory_bytes", "gauge", "渲染缓存内存层占用（字节）", [({}, render["memory_bytes"])]),
+        ("code_exec_artifact_writes_total", "counter", "写入的图片文件数", [({}, artifacts["writes"])]),
+        ("code_exec_artifact_dedup_hits_total", "counter", "内容相同而复用的图片文件数", [({}, artifacts["dedup_hits"])]),
+        ("code_exec_artifact_disk_bytes", "gauge", "图片文件总大小（字节），最近一次回收时统计", [({}, artifacts["total_bytes"])]),
+        ("code_exec_derivative_requests_total", "counter", "衍生图请求数，按结果分类", [
+            ({"result": "hit"}, derivatives["hits"]),
+            ({"result": "created"}, derivatives["created"])
+        ]),
+        ("code_exec_hot_file_lookups_total", "counter", "下载热门文件缓存查询次数，按结果分类", [
+            ({"result": "hit"}, hot["hits"]),
+            ({"result": "miss"}, hot["misses"])
+        ]),
+        ("code_exec_code_cache_lookups_total", "counter", "API进程中代码规范化缓存查询次数，按结果分类", [
+            ({"result": "hit"}, code["normalize_hits"]),
+            ({"result": "miss"}, code["normalize_misses"])
+        ])
+    ]
+    if thread_executor is not None:
+        collected.append((
+            "code_exec_thread_executor_timed_out_total", "counter", "线程执行器超时的任务数",
+            [({}, thread_executor.stats()["timed_out"])]
+        ))
+        collected.append((
+            "code_exec_thread_executor_overdue", "gauge", "线程执行器中已超时但仍占用线程的任务数",
+            [({}, thread_executor.stats()["overdue"])]
+        ))
+    return collected
+
+REGISTRY.add_collector(collect_component_metrics)
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus格式的性能指标
+    指标是本进程的统计，不在进程之间汇总；多个uvicorn工作进程共用监听端口，每次抓取由随机的进程响应，
+    返回的计数器会在互不相关的序列之间跳变，因此SERVER_WORKERS>1时返回503
+    """
+    if config.SERVER_WORKERS > 1:
+        return Response(
+            content=(
+                f"/metrics不可用: 服务以{config.SERVER_WORKERS}个uvicorn工作进程运行，指标按进程统计且不汇总，"
+                "每次抓取由随机的进程响应。需要指标时请运行多个SERVER_WORKERS=1的实例并分别抓取\n"
+            ),
+            status_code=503,
+            media_type="text/plain; charset=utf-8"
+        )
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/logs")
-async def get_logs(limit: int = 100):
-    """获取最近的日志记录"""
+async def get_logs(
+    limit: int = Query(100, ge=1, le=5000),
+    cursor: Optional[str] = None,
+    level: Optional[Literal["debug", "info", "warning", "error", "DEBUG", "INFO", "WARNING", "ERROR"]] = None,
+    request_id: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None
+):
+    """
+    获取最近的日志记录，包括轮转出的备份文件
+    
+    参数:
+    - limit: 返回的行数
+    - cursor: 上一页返回的next_cursor，继续读取更早的日志
+    - level: 只返回该级别的日志
+    - request_id: 只返回该请求（或以其为前缀的批量子请求）的日志
+    - since / until: 时间范围，例如 2024-08-12T10:00:00
+    
+    返回:
+    - logs: 按时间顺序排列的日志行
+    - next_cursor: 更早一页的游标，没有更早的日志时为null
+    """
+    log_filter = None
+    if level or request_id or since or until:
+        log_filter = LogFilter(level=level, request_id=request_id, since=since, until=until)
     try:
-        with open('api.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            # 返回最近的日志记录
-            recent_logs = lines[-limit:] if len(lines) > limit else lines
-            return {
-                "total_lines": len(lines),
-                "returned_lines": len(recent_logs),
-                "logs": recent_logs
-            }
-    except FileNotFoundError:
-        return {"error": "日志文件不存在"}
+        logs, next_cursor = await asyncio.get_running_loop().run_in_executor(
+            None, read_logs, config.LOG_FILE, limit, cursor, log_filter
+        )
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"读取日志文件失败: {str(e)}")
+        logger.error("读取日志文件失败: %s", e)
         return {"error": f"读取日志失败: {str(e)}"}
+    return {
+        "returned_lines": len(logs),
+        "logs": logs,
+        "next_cursor": next_cursor
+    }
 
 @app.get("/download/{filename}")
-async def download_image(filename: str):
+async def download_image(
+    filename: str,
+    request: Request,
+    width: Optional[int] = Query(None, ge=1, le=config.THUMBNAIL_MAX_SIDE),
+    height: Optional[int] = Query(None, ge=1, le=config.THUMBNAIL_MAX_SIDE),
+    format: Optional[Literal["png", "webp", "jpeg"]] = None
+):
     """
     下载生成的图片
     
     参数:
     - filename: 图片文件名
+    - width / height: 可选，返回不超过该尺寸的缩略图（保持宽高比，只缩小不放大）
+    - format: 可选，缩略图格式（png / webp / jpeg），默认与原图相同
     
     返回:
-    - 图片文件
+    - 图片文件；带ETag和长期Cache-Control，支持If-None-Match（304）和Range（206）
     """
-    import os
-    filepath = os.path.join("picture", filename)
+    # 只接受图片存储生成的文件名，并映射到所在的分片目录
+    filepath = artifact_store.path_for(filename)
+    if filepath is None:
+        raise HTTPException(status_code=404, detail="图片文件不存在")
+    
+    loop = asyncio.get_running_loop()
+    if width or height or format:
+        # 衍生图第一次请求时生成并缓存在磁盘上
+        try:
+            filepath = await loop.run_in_executor(
+                None, derivative_cache.get_or_create, filename, width, height, format
+            )
+        except UnsupportedDerivativeError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if filepath is None:
+            raise HTTPException(status_code=404, detail="图片文件不存在")
+        filename = os.path.basename(filepath)
     
-    # 检查文件是否存在
-    if not os.path.exists(filepath):
+    if config.ACCEL_REDIRECT_PREFIX:
+        # 由nginx用sendfile发送文件，ETag、Range和304也由nginx处理
+        return accel_redirect_response(
+            filepath, filename, config.ACCEL_REDIRECT_PREFIX, config.DOWNLOAD_MAX_AGE, root=artifact_store.directory
+        )
+    
+    # 热门文件直接从内存返回，不访问文件系统
+    entry = hot_files.get(filepath)
+    if entry is None:
+        entry = await loop.run_in_executor(None, hot_files.load, filepath, artifact_store.etag_for(filename))
+    if entry is None:
         raise HTTPException(status_code=404, detail="图片文件不存在")
     
-    # 返回文件
-    return FileResponse(filepath, media_type="image/png", filename=filename)
-
+    return await file_response(request, entry, filename, config.DOWNLOAD_MAX_AGE, loop)
 
 if __name__ == "__main__":
     import uvicorn
     logger.info("启动Python代码执行API服务")
-    logger.info("服务地址: http://0.0.0.0:8000")
-    logger.info("API文档: http://0.0.0.0:8000/docs")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    logger.info("服务地址: http://%s:%d, 工作进程数: %d", config.SERVER_HOST, config.SERVER_PORT, config.SERVER_WORKERS)
+    logger.info("API文档: http://%s:%d/docs", config.SERVER_HOST, config.SERVER_PORT)
+    if config.SERVER_WORKERS > 1:
+        logger.warning("多个工作进程时指标不在进程之间汇总，/metrics返回503")
+        # 多个工作进程时uvicorn需要以导入字符串的方式加载应用
+        uvicorn.run("main:app", host=config.SERVER_HOST, port=config.SERVER_PORT, workers=config.SERVER_WORKERS)
+    else:
+        uvicorn.run(app, host=config.SERVER_HOST, port=config.SERVER_PORT)
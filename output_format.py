@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+输出图片编码参数
+把请求中的格式、DPI、尺寸上限和编码强度转换为渲染参数；
+位图格式（png/webp/jpeg）通过matplotlib的pil_kwargs交给Pillow编码，svg为矢量输出
+本模块不导入matplotlib，API进程和工作进程都可以使用
+"""
+
+import os
+
+# 格式 -> 响应的Content-Type
+MEDIA_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'svg': 'image/svg+xml'
+}
+
+# 格式 -> 文件扩展名
+EXTENSIONS = {
+    'png': 'png',
+    'webp': 'webp',
+    'jpeg': 'jpg',
+    'svg': 'svg'
+}
+
+# 编码强度 -> 各格式的Pillow参数；fast适合预览，best体积最小但最慢
+_PNG_EFFORT = {
+    'fast': {'compress_level': 1},
+    'default': {'compress_level': 6},
+    'best': {'compress_level': 9, 'optimize': True}
+}
+_WEBP_EFFORT = {
+    'fast': {'method': 0},
+    'default': {'method': 4},
+    'best': {'method': 6}
+}
+_JPEG_EFFORT = {
+    'fast': {},
+    'default': {'optimize': True},
+    'best': {'optimize': True, 'progressive': True}
+}
+
+# jpeg/webp未指定质量时使用的默认值
+DEFAULT_QUALITY = 85
+
+
+def build_render_options(format='png', dpi=150, max_width=None, max_height=None,
+                         quality=None, effort='default'):
+    """
+    构造渲染参数字典，同时作为渲染缓存键的一部分
+
+    参数:
+    - format: png / webp / jpeg / svg
+    - dpi: 分辨率
+    - max_width / max_height: 输出图片的像素尺寸上限，超出时按比例降低DPI
+    - quality: jpeg/webp的质量（1-100）
+    - effort: 编码强度 fast / default / best
+    """
+    options = {
+        'format': format,
+        'dpi': dpi,
+        'bbox_inches': 'tight',
+        'max_width': max_width,
+        'max_height': max_height,
+        'effort': effort
+    }
+    if format in ('jpeg', 'webp'):
+        options['quality'] = quality or DEFAULT_QUALITY
+    return options
+
+
+def effective_dpi(options, figsize_inches, max_side=None):
+    """按尺寸上限计算实际使用的DPI"""
+    width_in, height_in = figsize_inches
+    dpi = options['dpi']
+    limits = [
+        (options.get('max_width'), width_in),
+        (options.get('max_height'), height_in),
+        (max_side, width_in),
+        (max_side, height_in)
+    ]
+    for limit, inches in limits:
+        if limit and inches > 0 and dpi * inches > limit:
+            dpi = limit / inches
+    return dpi
+
+
+def savefig_kwargs(options, figsize_inches, max_side=None):
+    """把渲染参数转换为savefig()的参数"""
+    fmt = options['format']
+    kwargs = {
+        'format': fmt,
+        'dpi': effective_dpi(options, figsize_inches, max_side),
+        'bbox_inches': options['bbox_inches']
+    }
+    effort = options.get('effort', 'default')
+    if fmt == 'png':
+        kwargs['pil_kwargs'] = dict(_PNG_EFFORT[effort])
+    elif fmt == 'webp':
+        kwargs['pil_kwargs'] = dict(_WEBP_EFFORT[effort], quality=options['quality'])
+    elif fmt == 'jpeg':
+        kwargs['pil_kwargs'] = dict(_JPEG_EFFORT[effort], quality=options['quality'])
+    return kwargs
+
+
+def media_type_for_filename(filename):
+    """根据文件扩展名返回Content-Type"""
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    for fmt, ext in EXTENSIONS.items():
+        if ext == extension:
+            return MEDIA_TYPES[fmt]
+    return 'application/octet-stream'
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似分位数
+对数分桶的分位数草图（与DDSketch思路相同）：
+- 每个值落入 gamma^(i-1) < x <= gamma^i 的桶，只记录桶计数
+- 分位数的相对误差不超过relative_accuracy，内存只与数值范围有关，与样本数量无关
+- 可以合并，适合流式统计日志中的耗时
+"""
+
+import math
+
+
+class QuantileSketch:
+    """对数分桶的近似分位数草图"""
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-6):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self._buckets = {}
+        self._zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        """加入一个非负样本"""
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value <= self.min_value:
+            self._zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self._buckets[key] = self._buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        """合并另一个草图（需使用相同的精度）"""
+        for key, count in other._buckets.items():
+            self._buckets[key] = self._buckets.get(key, 0) + count
+        self._zero_count += other._zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        返回第q分位数（0~1）的近似值，没有样本时返回None
+        按最近秩（nearest-rank）取第 ceil(q * count) 个样本所在的桶，与benchmark.py的统计一致；
+        样本较少时高分位数取到最慢的样本，不会被低估
+        """
+        if self.count == 0:
+            return None
+        rank = min(self.count, max(1, math.ceil(q * self.count)))
+        if rank <= self._zero_count:
+            return 0.0
+        seen = self._zero_count
+        for key in sorted(self._buckets):
+            seen += self._buckets[key]
+            if seen >= rank:
+                # 桶内取使相对误差最小的代表值
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
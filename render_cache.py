@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+渲染结果缓存
+以规范化代码和渲染参数的哈希为键，缓存已经生成的图片：
+- 内存层：有容量上限的LRU
+- 磁盘层：picture/index/ 下以键命名的索引文件，内容为图片在ArtifactStore中的文件名
+两层都按TTL过期；图片文件本身的磁盘预算由ArtifactStore的后台回收负责
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class RenderCache:
+    """两级渲染结果缓存"""
+
+    def __init__(self, store, index_dir='picture/index', memory_max_bytes=64 * 1024 * 1024,
+                 memory_max_entries=512, ttl=24 * 3600):
+        self.store = store
+        self.index_dir = index_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_max_entries = memory_max_entries
+        self.ttl = ttl
+
+        self._memory = OrderedDict()  # key -> (写入时间, 图片字节, 图片文件名，未写入磁盘时为None)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(code_digest, options):
+        """根据规范化代码的哈希和渲染参数计算缓存键"""
+        digest = hashlib.sha256()
+        digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(code_digest.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_memory(self, key):
+        """只查询内存层，命中时返回图片字节"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            stored_at, data, _ = entry
+            if time.time() - stored_at > self.ttl:
+                self._drop_memory(key)
+                return None
+            self._memory.move_to_end(key)
+            self.hits_memory += 1
+            return data
+
+    def get_disk(self, key):
+        """查询磁盘层，命中时读取图片并放入内存层（阻塞IO，应在线程池中调用）"""
+        index_path = self._index_path(key)
+        try:
+            mtime = os.path.getmtime(index_path)
+            if time.time() - mtime > self.ttl:
+                self._remove_file(index_path)
+                raise FileNotFoundError(index_path)
+            with open(index_path, 'r', encoding='utf-8') as f:
+                filename = f.read().strip()
+            path = self.store.path_for(filename)
+            if path is None:
+                raise FileNotFoundError(index_path)
+            # 图片可能已被后台回收，此时按未命中处理
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits_disk += 1
+            self._put_memory(key, data, filename, stored_at=mtime)
+        return data
+
+    def record_bypass(self):
+        """记录一次绕过缓存的请求"""
+        with self._lock:
+            self.bypassed += 1
+
+    def put_memory(self, key, data):
+        """只写入内存层，用于不需要下载文件的请求"""
+        with self._lock:
+            self._put_memory(key, data, None)
+
+    def persist(self, key, data, extension='png'):
+        """
+        确保缓存条目对应的图片文件存在（阻塞IO，应在线程池中调用）
+
+        返回:
+        - 图片文件名，可用于构造下载链接
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            filename = entry[2] if entry is not None else None
+        if filename is not None:
+            path = self.store.path_for(filename)
+            if path is not None and os.path.exists(path):
+                return filename
+        return self.put(key, data, extension)
+
+    def put(self, key, data, extension='png'):
+        """
+        写入两级缓存（阻塞IO，应在线程池中调用）
+
+        返回:
+        - 图片文件名，可用于构造下载链接
+        """
+        filename = self.store.put(data, extension)
+
+        # 索引同样先写临时文件再重命名
+        index_path = self._index_path(key)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(filename)
+        os.replace(tmp_path, index_path)
+
+        with self._lock:
+            self._put_memory(key, data, filename)
+            need_sweep = time.time() - self._last_sweep > 300
+            if need_sweep:
+                self._last_sweep = time.time()
+        if need_sweep:
+            self.sweep()
+        return filename
+
+    def sweep(self):
+        """删除过期的索引文件"""
+        now = time.time()
+        evicted = 0
+        for root, _, files in os.walk(self.index_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    expired = now - os.path.getmtime(path) > self.ttl
+                except FileNotFoundError:
+                    continue
+                if expired and self._remove_file(path):
+                    evicted += 1
+
+        with self._lock:
+            self._last_sweep = now
+            self.evictions += evicted
+
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                'hits_memory': self.hits_memory,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes
+            }
+
+    def _index_path(self, key):
+        """缓存键对应的索引文件路径"""
+        return os.path.join(self.index_dir, key[:2], key)
+
+    def _put_memory(self, key, data, filename, stored_at=None):
+        """写入内存层并按容量淘汰（调用方需持有锁）"""
+        if len(data) > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._drop_memory(key)
+        self._memory[key] = (stored_at or time.time(), data, filename)
+        self._memory_bytes += len(data)
+        while self._memory and (
+            self._memory_bytes > self.memory_max_bytes or len(self._memory) > self.memory_max_entries
+        ):
+            oldest = next(iter(self._memory))
+            self._drop_memory(oldest)
+            self.evictions += 1
+
+    def _drop_memory(self, key):
+        """从内存层删除（调用方需持有锁）"""
+        _, data, _ = self._memory.pop(key)
+        self._memory_bytes -= len(data)
+
+    def _remove_file(self, path):
+        """删除磁盘文件，文件不存在时返回False"""
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
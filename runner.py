@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代码执行逻辑
+在执行器的工作进程或线程中运行：规范化并编译代码、执行代码并渲染生成的图片
+每个任务使用独立的执行上下文（输出捕获，线程执行器中还有独立的图形注册表），可以在多个线程中同时执行
+"""
+
+import io
+import sys
+import time
+import base64
+import threading
+import traceback
+
+import matplotlib
+matplotlib.use('Agg')  # 使用非交互式后端
+import numpy as np
+from PIL import Image
+
+import config
+from code_normalizer import compile_code
+from datasets import load_dataset
+from decimation import decimate_figure
+from isolation import DeadlineExceeded, ExecutionContext
+from output_format import build_render_options, effective_dpi, savefig_kwargs
+
+
+# 定义允许的内置函数
+ALLOWED_BUILTINS = {
+    '__import__': __import__,
+    'print': print,
+    'len': len,
+    'range': range,
+    'list': list,
+    'dict': dict,
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'exec': exec,
+    'eval': eval,
+    'enumerate': enumerate,
+    'zip': zip,
+    'map': map,
+    'filter': filter,
+    'sum': sum,
+    'max': max,
+    'min': min,
+    'abs': abs,
+    'round': round,
+    'sorted': sorted,
+    'reversed': reversed,
+    'any': any,
+    'all': all,
+    'isinstance': isinstance,
+    'hasattr': hasattr,
+    'getattr': getattr,
+    'setattr': setattr,
+    'callable': callable,
+    'open': open,
+    'type': type,
+    'issubclass': issubclass,
+    'iter': iter,
+    'next': next
+}
+
+
+class ResourceLimitExceeded(Exception):
+    """任务超出了CPU时间等资源限制"""
+
+
+def render_figure(fig, options):
+    """按渲染参数把图形渲染并编码为图片字节（位图格式由Pillow编码）"""
+    img_buffer = io.BytesIO()
+    fig.savefig(img_buffer, **savefig_kwargs(options, fig.get_size_inches(), config.MAX_IMAGE_SIDE))
+    return img_buffer.getvalue()
+
+
+def build_namespace(context):
+    """创建安全的执行环境，预导入所有必要的库，plt和matplotlib路由到请求自己的上下文"""
+    namespace = dict(_BASE_NAMESPACE)
+    namespace['plt'] = context.plt
+    namespace['matplotlib'] = context.matplotlib
+    return namespace
+
+
+def build_builtins(context):
+    """允许的内置函数，__import__替换为上下文的导入钩子"""
+    builtins = dict(ALLOWED_BUILTINS)
+    builtins['__import__'] = context.import_hook
+    return builtins
+
+
+# 每个进程只构建一次基础执行环境，任务之间复制使用
+_BASE_NAMESPACE = {
+    'np': np,
+    'Image': Image,
+    'io': io,
+    'base64': base64,
+    'sys': sys,
+    'traceback': traceback,
+    'time': time
+}
+
+
+class _OutputRelay:
+    """
+    把执行中的输出和阶段变化作为事件发送给调用方
+    输出先在本地缓冲，最多每OUTPUT_FLUSH_INTERVAL秒在行尾发送一次，大量的小写入不会变成大量的消息；
+    缓冲的输出最迟在OUTPUT_FLUSH_INTERVAL秒后由定时器发送，用户代码之后不再输出时也不会滞留
+    """
+
+    OUTPUT_FLUSH_INTERVAL = 0.2
+    OUTPUT_FLUSH_BYTES = 16 * 1024
+
+    def __init__(self, emit):
+        self._emit = emit
+        self._pending = []
+        self._pending_bytes = 0
+        # 上一次发送输出的时间，第一行输出立即发送
+        self._flushed_at = 0.0
+        self._timer = None
+        # 定时器线程和执行线程都会发送事件
+        self._lock = threading.Lock()
+
+    def output(self, stream, text):
+        with self._lock:
+            self._pending.append((stream, text))
+            self._pending_bytes += len(text)
+            # 尽量在行尾发送，print的多次写入不会被拆到不同的事件中
+            if (self._pending_bytes >= self.OUTPUT_FLUSH_BYTES
+                    or ('\n' in text and time.monotonic() - self._flushed_at >= self.OUTPUT_FLUSH_INTERVAL)):
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.OUTPUT_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def phase(self, phase):
+        with self._lock:
+            self._flush()
+            self._emit({'event': 'progress', 'phase': phase})
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """发送缓冲的输出（调用方持有锁）"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        # 相邻的同一个流的输出合并为一条事件
+        merged = []
+        for stream, text in self._pending:
+            if merged and merged[-1][0] == stream:
+                merged[-1][1].append(text)
+            else:
+                merged.append((stream, [text]))
+        self._pending = []
+        self._pending_bytes = 0
+        for stream, texts in merged:
+            self._emit({'event': 'output', 'stream': stream, 'text': ''.join(texts)})
+        self._flushed_at = time.monotonic()
+
+
+def run_job(job, emit=None, isolated=False, deadline=None):
+    """
+    执行一个任务
+
+    参数:
+    - job: 任务字典，包含code字段、可选的render渲染参数、datasets数据集（变量名 -> DatasetStore.resolve的描述）
+      和decimate（渲染前抽稀大数据量的折线和散点）
+    - emit: 可选回调，执行过程中以事件字典（带event字段）的形式接收阶段变化和输出
+    - isolated: 是否使用独立的图形注册表；同一进程中并发执行多个任务（线程执行器）时必须为True，
+      否则plt就是全局的pyplot，seaborn、pandas等直接使用pyplot的库绘制的图形也能被收集
+    - deadline: 可选的截止时间（time.monotonic()的值），超过后中断用户代码；用于无法强制结束的线程执行器
+
+    返回:
+    - 结果字典，status为ok / no_figure / error / resource_limit / timeout
+    """
+    timings = {}
+    relay = _OutputRelay(emit) if emit is not None else None
+    context = ExecutionContext(on_output=relay.output if relay else None, isolated=isolated)
+
+    try:
+        phase_start = time.perf_counter()
+        # 规范化和编译结果按内容哈希缓存，重复提交的代码跳过解析和compile()
+        _, code_object = compile_code(job['code'])
+        local_vars = build_namespace(context)
+        # 数据集以只读内存映射的方式注入，与np、plt并列
+        for name, spec in (job.get('datasets') or {}).items():
+            local_vars[name] = load_dataset(spec)
+        global_vars = {"__builtins__": build_builtins(context)}
+        timings['preprocess'] = time.perf_counter() - phase_start
+
+        # 只捕获当前线程的标准输出和错误输出，执行代码
+        if relay:
+            relay.phase('exec')
+        phase_start = time.perf_counter()
+        try:
+            with context.capture_output(), context.enforce_deadline(deadline):
+                exec(code_object, global_vars, local_vars)
+        finally:
+            if relay:
+                relay.flush()
+        timings['exec'] = time.perf_counter() - phase_start
+
+        # 检查是否有matplotlib图形
+        if not context.get_fignums():
+            return {
+                'status': 'no_figure',
+                'stdout': context.stdout.getvalue(),
+                'stderr': context.stderr.getvalue(),
+                'timings': timings
+            }
+
+        fig = context.gcf()
+        options = job.get('render') or build_render_options()
+        decimation = None
+        if job.get('decimate') and options['format'] != 'svg':
+            # 按实际输出的分辨率抽稀；svg是矢量输出，没有固定的像素网格
+            phase_start = time.perf_counter()
+            dpi = effective_dpi(options, fig.get_size_inches(), config.MAX_IMAGE_SIDE)
+            decimation = decimate_figure(fig, dpi, config.DECIMATION_MIN_POINTS)
+            timings['decimate'] = time.perf_counter() - phase_start
+
+        # 只渲染一次：光栅化并编码，同一份字节交给所有使用方
+        if relay:
+            relay.phase('render')
+        phase_start = time.perf_counter()
+        image = render_figure(fig, options)
+        timings['render'] = time.perf_counter() - phase_start
+
+        result = {
+            'status': 'ok',
+            'image': image,
+            'stdout': context.stdout.getvalue(),
+            'stderr': context.stderr.getvalue(),
+            'timings': timings
+        }
+        if decimation is not None:
+            result['decimation'] = decimation
+        return result
+    except (MemoryError, ResourceLimitExceeded) as e:
+        # 超出工作进程的内存（RLIMIT_AS）或CPU时间（RLIMIT_CPU）限制
+        if isinstance(e, MemoryError):
+            message = f"内存不足: {e}" if str(e) else "内存不足"
+        else:
+            message = str(e)
+        return {
+            'status': 'resource_limit',
+            'error': message,
+            'traceback': traceback.format_exc(),
+            'stdout': context.stdout.getvalue(),
+            'stderr': context.stderr.getvalue(),
+            'timings': timings
+        }
+    except DeadlineExceeded as e:
+        # 调用方已经按超时返回，结果只用于结束本次执行
+        return {
+            'status': 'timeout',
+            'error': str(e),
+            'stdout': context.stdout.getvalue(),
+            'stderr': context.stderr.getvalue(),
+            'timings': timings
+        }
+    except Exception as e:
+        return {
+            'status': 'error',
+            'error': str(e),
+            'traceback': traceback.format_exc(),
+            'stdout': context.stdout.getvalue(),
+            'stderr': context.stderr.getvalue(),
+            'timings': timings
+        }
+    finally:
+        # 清理本请求的图形
+        context.close_all()
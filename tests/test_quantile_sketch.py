@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""QuantileSketch 的回归测试"""
+
+import pytest
+
+from quantile_sketch import QuantileSketch
+
+
+def test_high_quantile_of_few_samples_is_the_max():
+    sketch = QuantileSketch()
+    for value in (0.2, 0.392, 1.118):
+        sketch.add(value)
+    assert sketch.quantile(0.99) == pytest.approx(1.118, rel=0.01)
+    assert sketch.quantile(0.9) == pytest.approx(1.118, rel=0.01)
+    assert sketch.quantile(0.5) == pytest.approx(0.392, rel=0.01)
+
+
+def test_nearest_rank_matches_sorted_samples():
+    values = [i / 100 for i in range(1, 101)]
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    for q in (0.5, 0.9, 0.99):
+        # 最近秩：第ceil(q * n)个样本
+        assert sketch.quantile(q) == pytest.approx(values[int(q * 100) - 1], rel=0.01)
+    assert sketch.quantile(0) == pytest.approx(0.01, rel=0.01)
+
+
+def test_empty_sketch():
+    assert QuantileSketch().quantile(0.5) is None
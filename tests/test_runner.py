@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""runner.run_job 的回归测试"""
+
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pytest
+
+import runner
+
+PNG_SIGNATURE = b'\x89PNG'
+
+
+def test_plt_figure_is_rendered():
+    result = runner.run_job({'code': "plt.plot([1, 2, 3])\nprint('done')"})
+    assert result['status'] == 'ok'
+    assert result['image'].startswith(PNG_SIGNATURE)
+    assert result['stdout'] == 'done\n'
+    assert plt.get_fignums() == []
+
+
+def test_pandas_plot_is_rendered():
+    pytest.importorskip('pandas')
+    result = runner.run_job({'code': "import pandas as pd\npd.Series([1, 2, 3]).plot()"})
+    assert result['status'] == 'ok'
+    assert result['image'].startswith(PNG_SIGNATURE)
+    # 库通过全局pyplot创建的图形在任务结束后关闭
+    assert plt.get_fignums() == []
+
+
+def test_seaborn_plot_is_rendered():
+    pytest.importorskip('seaborn')
+    result = runner.run_job({'code': "import seaborn as sns\nsns.histplot([1, 2, 3])"})
+    assert result['status'] == 'ok'
+    assert result['image'].startswith(PNG_SIGNATURE)
+    assert plt.get_fignums() == []
+
+
+def test_isolated_job_does_not_touch_global_pyplot():
+    result = runner.run_job({'code': "plt.plot([1, 2, 3])"}, isolated=True)
+    assert result['status'] == 'ok'
+    assert plt.get_fignums() == []
+
+
+def test_no_figure():
+    result = runner.run_job({'code': "x = 1"})
+    assert result['status'] == 'no_figure'
+
+
+def test_deadline_interrupts_infinite_loop():
+    # 线程执行器无法强制结束线程，死循环靠截止时间检查中断
+    code = "while True:\n    try:\n        pass\n    except BaseException:\n        pass"
+    result = runner.run_job({'code': code}, isolated=True, deadline=time.monotonic() + 0.5)
+    assert result['status'] == 'timeout'
+    assert sys.gettrace() is None
+
+
+def test_output_is_streamed_while_code_runs():
+    # 输出后代码不再写入（sleep），缓冲的输出也要在sleep结束之前发送
+    events = []
+    start = time.monotonic()
+
+    def emit(event):
+        events.append((time.monotonic() - start, event))
+
+    result = runner.run_job({'code': "print('starting long job')\ntime.sleep(1.5)\nplt.plot([1])"}, emit=emit)
+    assert result['status'] == 'ok'
+    outputs = [(at, event) for at, event in events if event['event'] == 'output']
+    assert outputs[0][1]['text'] == 'starting long job\n'
+    assert outputs[0][0] < 1.0
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+缩略图和尺寸衍生图
+/download 请求带 width / height / format 参数时，用Pillow按需生成缩小后的衍生图，
+第一次请求时生成并保存在原图所在的分片目录中（thumb_ 前缀），之后直接返回；
+衍生图总大小超出预算时从最久未使用的文件开始清理
+"""
+
+import os
+import threading
+
+from PIL import Image
+
+from output_format import EXTENSIONS
+
+# 衍生图文件名前缀
+DERIVATIVE_PREFIX = 'thumb_'
+
+# 衍生图编码参数：列表页缩略图优先考虑编码速度
+_SAVE_KWARGS = {
+    'png': {'compress_level': 3},
+    'webp': {'quality': 80, 'method': 2},
+    'jpeg': {'quality': 80}
+}
+
+
+class UnsupportedDerivativeError(Exception):
+    """原图无法生成衍生图（例如svg矢量图）"""
+
+
+class DerivativeCache:
+    """衍生图磁盘缓存"""
+
+    def __init__(self, store, max_bytes=256 * 1024 * 1024):
+        self.store = store
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._total_bytes = None
+
+        self.hits = 0
+        self.created = 0
+        self.evictions = 0
+
+    def derivative_name(self, filename, width, height, fmt):
+        """衍生图文件名，包含原图名、目标尺寸和格式"""
+        stem = os.path.splitext(filename)[0]
+        return f"{DERIVATIVE_PREFIX}{stem}_{width or 0}x{height or 0}.{EXTENSIONS[fmt]}"
+
+    def get_or_create(self, filename, width=None, height=None, fmt=None):
+        """
+        返回衍生图路径，不存在时生成（阻塞IO，应在线程池中调用）
+
+        参数:
+        - filename: 原图文件名
+        - width / height: 目标尺寸上限（像素），只缩小不放大，保持宽高比
+        - fmt: 输出格式，默认与原图相同
+
+        返回:
+        - 衍生图路径；原图不存在时返回None
+        """
+        source_path = self.store.path_for(filename)
+        if source_path is None:
+            return None
+        source_ext = os.path.splitext(filename)[1].lstrip('.').lower()
+        if source_ext == 'svg':
+            raise UnsupportedDerivativeError("矢量图(svg)不支持生成缩略图")
+        if fmt is None:
+            fmt = next((f for f, ext in EXTENSIONS.items() if ext == source_ext), 'png')
+
+        name = self.derivative_name(filename, width, height, fmt)
+        path = self.store.path_for(name)
+
+        with self._lock_for(name):
+            if os.path.exists(path):
+                # 更新修改时间，清理时按最近使用时间淘汰
+                os.utime(path)
+                with self._lock:
+                    self.hits += 1
+                return path
+            if not os.path.exists(source_path):
+                return None
+            size = self._create(source_path, path, width, height, fmt)
+
+        with self._lock:
+            self.created += 1
+            if self._total_bytes is not None:
+                self._total_bytes += size
+            need_sweep = self._total_bytes is None or self._total_bytes > self.max_bytes
+        if need_sweep:
+            self.sweep()
+        return path
+
+    def sweep(self):
+        """衍生图总大小超出预算时，从最久未使用的文件开始删除"""
+        entries = []
+        for root, _, files in os.walk(self.store.directory):
+            for name in files:
+                if name.startswith(DERIVATIVE_PREFIX) and not name.endswith('.tmp'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        # 清理到预算的90%，避免频繁触发
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            self._total_bytes = total
+            self.evictions += evicted
+
+    def stats(self):
+        """返回衍生图缓存统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'created': self.created,
+                'evictions': self.evictions,
+                'total_bytes': self._total_bytes
+            }
+
+    def _lock_for(self, name):
+        """同一衍生图的并发请求只生成一次"""
+        with self._lock:
+            lock = self._key_locks.get(name)
+            if lock is None:
+                if len(self._key_locks) > 1024:
+                    self._key_locks.clear()
+                lock = self._key_locks[name] = threading.Lock()
+            return lock
+
+    def _create(self, source_path, path, width, height, fmt):
+        """生成衍生图并以临时文件加重命名的方式写入，返回文件大小"""
+        with Image.open(source_path) as img:
+            target = (width or img.width, height or img.height)
+            if img.format == 'JPEG':
+                # JPEG可以在解码阶段直接按比例缩小
+                img.draft('RGB', target)
+            img.thumbnail(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+            if fmt == 'jpeg' and img.mode != 'RGB':
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel('A') if 'A' in img.getbands() else None)
+                img = background
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            img.save(tmp_path, format=fmt.upper(), **_SAVE_KWARGS[fmt])
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
@@ -3,254 +3,383 @@
 """
 日志查看和管理脚本
 提供多种日志查看功能，包括实时监控、搜索、统计等
+search / level / time 通过 .log_index/ 下的旁路索引查询当前日志和轮转备份，
+索引在每次查询前只为新追加的内容增量更新
 """
 
 import os
 import sys
 import time
+import heapq
 import argparse
 from datetime import datetime, timedelta
 import re
 
+from log_reader import LogFilter, line_level, line_request_id, line_time, log_files, open_log, parse_log_line, read_logs
+from log_follow import LogFollower
+from log_index import LogIndex, iter_block_lines, iter_lines_from
+from quantile_sketch import QuantileSketch
+
+# 请求ID格式，搜索这类关键词时使用索引
+REQUEST_ID_PATTERN = re.compile(r'^req_\d+')
+
+# 统计时最多同时跟踪的未结束请求数
+MAX_OPEN_REQUESTS = 10000
+
+# 错误率变化最多显示的行数
+TIMELINE_ROWS = 20
+
+# 计入失败的请求结果
+FAILED_OUTCOMES = ('error', 'timeout', 'crashed', 'rejected', 'resource_limit')
+
+# 旧文本格式日志的请求开始、结束标记和结果判断
+_LEGACY_START = '开始处理代码执行请求'.encode('utf-8')
+_LEGACY_TOTAL = '总耗时'.encode('utf-8')
+_LEGACY_DURATION = re.compile(r'总耗时: ([\d.]+)秒')
+_LEGACY_OUTCOMES = (
+    ('命中渲染缓存', 'cache_hit'),
+    ('请求处理完成', 'ok'),
+    ('未生成图片', 'no_figure'),
+    ('执行超时', 'timeout'),
+    ('工作进程异常退出', 'crashed'),
+    ('失败', 'error'),
+)
+
 def view_recent_logs(limit=50):
-    """查看最近的日志记录"""
+    """查看最近的日志记录（从文件末尾向前读取，不读取整个文件）"""
     if not os.path.exists('api.log'):
         print("❌ 日志文件 api.log 不存在")
         return
     
     try:
-        with open('api.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        recent_lines, _ = read_logs('api.log', limit)
         
-        if not lines:
+        if not recent_lines:
             print("📝 日志文件为空")
             return
         
-        print(f"📊 日志文件总行数: {len(lines)}")
-        print(f"📋 显示最近 {min(limit, len(lines))} 行日志:")
+        print(f"💾 日志文件大小: {os.path.getsize('api.log') / 1024:.1f} KB")
+        print(f"📋 显示最近 {len(recent_lines)} 行日志:")
         print("=" * 80)
         
         # 显示最近的日志
-        recent_lines = lines[-limit:] if len(lines) > limit else lines
         for line in recent_lines:
             print(line.rstrip())
             
     except Exception as e:
         print(f"❌ 读取日志文件失败: {e}")
 
+def _print_match(path, line_num, raw):
+    """输出一条匹配的日志，备份文件的行前加上文件名"""
+    location = f"第{line_num}行" if path == 'api.log' else f"{path} 第{line_num}行"
+    print(f"{location}: {raw.decode('utf-8', errors='replace').rstrip()}")
+
 def search_logs(keyword, case_sensitive=False):
-    """搜索包含关键词的日志"""
+    """
+    搜索包含关键词的日志（包括轮转备份）
+    关键词为请求ID时通过索引只读取包含该请求的块，其他关键词逐行扫描
+    """
     if not os.path.exists('api.log'):
         print("❌ 日志文件 api.log 不存在")
         return
     
     try:
-        with open('api.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        segments = LogIndex('api.log').segments()
+        needle = keyword.encode('utf-8') if case_sensitive else keyword.lower().encode('utf-8')
+        use_index = REQUEST_ID_PATTERN.match(keyword) is not None
         
-        if not lines:
-            print("📝 日志文件为空")
-            return
+        print(f"🔍 搜索包含关键词 '{keyword}' 的日志:")
+        print("=" * 80)
         
-        # 搜索匹配的行
-        matched_lines = []
-        for i, line in enumerate(lines, 1):
-            if case_sensitive:
-                if keyword in line:
-                    matched_lines.append((i, line))
+        matched = 0
+        for path, index in segments:
+            if use_index:
+                # 前缀匹配，批量请求的子项（req_xxx_0 ...）也会被找到
+                block_ids = sorted({
+                    block_id
+                    for request_id, ids in index.request_ids.items() if request_id.startswith(keyword)
+                    for block_id in ids
+                })
             else:
-                if keyword.lower() in line.lower():
-                    matched_lines.append((i, line))
+                block_ids = range(len(index.blocks))
+            for line_num, raw in iter_block_lines(path, index, block_ids):
+                if needle in (raw if case_sensitive else raw.lower()):
+                    matched += 1
+                    _print_match(path, line_num, raw)
         
-        if not matched_lines:
+        if not matched:
             print(f"🔍 未找到包含关键词 '{keyword}' 的日志")
             return
-        
-        print(f"🔍 找到 {len(matched_lines)} 条包含关键词 '{keyword}' 的日志:")
         print("=" * 80)
-        
-        for line_num, line in matched_lines:
-            print(f"第{line_num}行: {line.rstrip()}")
+        print(f"🔍 找到 {matched} 条包含关键词 '{keyword}' 的日志")
             
     except Exception as e:
         print(f"❌ 搜索日志失败: {e}")
 
 def filter_logs_by_level(level):
-    """按日志级别过滤日志"""
+    """按日志级别过滤日志，只读取索引中包含该级别的块"""
     if not os.path.exists('api.log'):
         print("❌ 日志文件 api.log 不存在")
         return
     
     try:
-        with open('api.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        if not lines:
-            print("📝 日志文件为空")
-            return
-        
-        # 过滤指定级别的日志
         level_upper = level.upper()
-        filtered_lines = []
-        for i, line in enumerate(lines, 1):
-            if f" - {level_upper} - " in line:
-                filtered_lines.append((i, line))
+        segments = LogIndex('api.log').segments()
+        total = sum(index.level_counts().get(level_upper, 0) for _, index in segments)
         
-        if not filtered_lines:
+        if not total:
             print(f"🔍 未找到 {level_upper} 级别的日志")
             return
         
-        print(f"🔍 找到 {len(filtered_lines)} 条 {level_upper} 级别的日志:")
+        print(f"🔍 找到 {total} 条 {level_upper} 级别的日志:")
         print("=" * 80)
         
-        for line_num, line in filtered_lines:
-            print(f"第{line_num}行: {line.rstrip()}")
+        for path, index in segments:
+            for line_num, raw in iter_block_lines(path, index, index.blocks_with_level(level_upper)):
+                entry = parse_log_line(raw)
+                if entry and entry.get('level') == level_upper:
+                    _print_match(path, line_num, raw)
             
     except Exception as e:
         print(f"❌ 过滤日志失败: {e}")
 
 def filter_logs_by_time(hours=24):
-    """按时间过滤日志（最近N小时）"""
+    """按时间过滤日志（最近N小时），通过索引二分查找起始块，不逐行解析时间"""
     if not os.path.exists('api.log'):
         print("❌ 日志文件 api.log 不存在")
         return
     
     try:
-        with open('api.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        # 日志时间按字符串比较即可确定先后
+        threshold = (datetime.now() - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S,%f')[:23]
         
-        if not lines:
-            print("📝 日志文件为空")
-            return
-        
-        # 计算时间阈值
-        threshold_time = datetime.now() - timedelta(hours=hours)
-        filtered_lines = []
+        print(f"🔍 最近 {hours} 小时内的日志记录:")
+        print("=" * 80)
         
-        for i, line in enumerate(lines, 1):
-            try:
-                # 解析日志时间
-                time_str = line.split(' - ')[0]
-                log_time = datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S,%f')
-                if log_time >= threshold_time:
-                    filtered_lines.append((i, line))
-            except:
-                # 如果时间解析失败，跳过该行
+        matched = 0
+        for path, index in LogIndex('api.log').segments():
+            block_id = index.first_block_after(threshold)
+            if block_id is None:
                 continue
+            for line_num, raw in iter_lines_from(path, index, block_id):
+                timestamp = line_time(raw)
+                if timestamp is not None and timestamp >= threshold:
+                    matched += 1
+                    _print_match(path, line_num, raw)
         
-        if not filtered_lines:
+        if not matched:
             print(f"🔍 最近 {hours} 小时内没有日志记录")
             return
-        
-        print(f"🔍 最近 {hours} 小时内的日志记录 ({len(filtered_lines)} 条):")
         print("=" * 80)
-        
-        for line_num, line in filtered_lines:
-            print(f"第{line_num}行: {line.rstrip()}")
+        print(f"🔍 共 {matched} 条")
             
     except Exception as e:
         print(f"❌ 按时间过滤日志失败: {e}")
 
-def get_log_statistics():
-    """获取日志统计信息"""
-    if not os.path.exists('api.log'):
+def _legacy_outcome(message):
+    """旧文本格式日志没有outcome字段，按消息内容判断请求结果"""
+    for marker, outcome in _LEGACY_OUTCOMES:
+        if marker in message:
+            return outcome
+    return None
+
+def _format_seconds(value):
+    return f"{value:.3f}秒" if value is not None else "-"
+
+def get_log_statistics(top=10):
+    """
+    获取日志统计信息
+    一次流式读取当前日志和全部轮转备份（包括.gz压缩备份），按request_id关联开始和结束记录，
+    耗时分位数使用近似分位数草图计算，内存占用与日志大小无关
+    """
+    paths = log_files('api.log')
+    if not paths:
         print("❌ 日志文件 api.log 不存在")
         return
     
     try:
-        with open('api.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        if not lines:
+        total_lines = 0
+        level_counts = {}
+        request_count = 0
+        outcome_counts = {}
+        # 已开始但还没有结束记录的请求: request_id -> 开始时间
+        open_requests = {}
+        dropped_open = 0
+        latency = QuantileSketch()
+        ok_latency = QuantileSketch()
+        phase_latency = {}
+        # 每分钟的 [完成请求数, 失败请求数]
+        per_minute = {}
+        slowest = []
+        first_time = last_time = None
+        
+        for path in paths:
+            with open_log(path) as f:
+                for line in f:
+                    raw = line.rstrip(b'\r\n')
+                    if not raw:
+                        continue
+                    total_lines += 1
+                    level = line_level(raw)
+                    if level is not None:
+                        level_counts[level] = level_counts.get(level, 0) + 1
+                    timestamp = line_time(raw)
+                    if timestamp is not None:
+                        if first_time is None:
+                            first_time = timestamp
+                        last_time = timestamp
+                    
+                    # 只有请求开始和结束的记录需要完整解析
+                    is_json = raw.startswith(b'{')
+                    if is_json:
+                        if b'"phase": "start"' not in raw and b'"phase": "total"' not in raw:
+                            continue
+                    elif _LEGACY_START not in raw and _LEGACY_TOTAL not in raw:
+                        continue
+                    entry = parse_log_line(raw)
+                    if entry is None:
+                        continue
+                    request_id = entry.get('request_id') or line_request_id(raw)
+                    message = entry.get('message', '')
+                    
+                    if entry.get('phase') == 'start' or (not is_json and '开始处理代码执行请求' in message):
+                        request_count += 1
+                        if request_id:
+                            if len(open_requests) >= MAX_OPEN_REQUESTS:
+                                # 超出上限时丢弃最早的未结束请求，保证内存有界
+                                open_requests.pop(next(iter(open_requests)))
+                                dropped_open += 1
+                            open_requests[request_id] = timestamp
+                        continue
+                    
+                    if is_json:
+                        if entry.get('phase') != 'total':
+                            continue
+                        outcome = entry.get('outcome')
+                        duration = entry.get('duration')
+                    else:
+                        outcome = _legacy_outcome(message)
+                        match = _LEGACY_DURATION.search(message)
+                        duration = float(match.group(1)) if match else None
+                    if outcome is None:
+                        continue
+                    if request_id:
+                        open_requests.pop(request_id, None)
+                    outcome_counts[outcome] = outcome_counts.get(outcome, 0) + 1
+                    
+                    if timestamp is not None:
+                        minute = per_minute.setdefault(timestamp[:16], [0, 0])
+                        minute[0] += 1
+                        if outcome in FAILED_OUTCOMES:
+                            minute[1] += 1
+                    if duration is None:
+                        continue
+                    latency.add(duration)
+                    if outcome == 'ok':
+                        ok_latency.add(duration)
+                        for phase, seconds in (entry.get('timings') or {}).items():
+                            sketch = phase_latency.get(phase)
+                            if sketch is None:
+                                sketch = phase_latency[phase] = QuantileSketch()
+                            sketch.add(seconds)
+                    item = (duration, request_id or '-', timestamp or '')
+                    if len(slowest) < top:
+                        heapq.heappush(slowest, item)
+                    elif item > slowest[0]:
+                        heapq.heapreplace(slowest, item)
+        
+        if total_lines == 0:
             print("📝 日志文件为空")
             return
         
-        # 统计信息
-        total_lines = len(lines)
-        info_count = 0
-        warning_count = 0
-        error_count = 0
-        request_count = 0
-        
-        # 分析每行日志
-        for line in lines:
-            if " - INFO - " in line:
-                info_count += 1
-            elif " - WARNING - " in line:
-                warning_count += 1
-            elif " - ERROR - " in line:
-                error_count += 1
-            
-            if "开始处理代码执行请求" in line:
-                request_count += 1
-        
-        # 计算成功率
-        success_count = 0
-        for line in lines:
-            if "请求处理完成" in line:
-                success_count += 1
-        
-        success_rate = (success_count / request_count * 100) if request_count > 0 else 0
+        finished = sum(outcome_counts.values())
+        failed = sum(outcome_counts.get(outcome, 0) for outcome in FAILED_OUTCOMES)
+        success_count = outcome_counts.get('ok', 0) + outcome_counts.get('cache_hit', 0)
+        success_rate = (success_count / finished * 100) if finished > 0 else 0
         
         print("📊 日志统计信息:")
         print("=" * 50)
+        for path in paths:
+            print(f"💾 {path}: {os.path.getsize(path) / 1024:.1f} KB")
+        print(f"🕒 时间范围: {first_time} ~ {last_time}")
         print(f"📝 总日志行数: {total_lines}")
-        print(f"ℹ️  INFO级别: {info_count}")
-        print(f"⚠️  WARNING级别: {warning_count}")
-        print(f"❌ ERROR级别: {error_count}")
+        print(f"ℹ️  INFO级别: {level_counts.get('INFO', 0)}")
+        print(f"⚠️  WARNING级别: {level_counts.get('WARNING', 0)}")
+        print(f"❌ ERROR级别: {level_counts.get('ERROR', 0)}")
         print(f"🚀 总请求数: {request_count}")
+        print(f"🏁 已结束请求: {finished}")
+        for outcome, count in sorted(outcome_counts.items(), key=lambda item: -item[1]):
+            print(f"   {outcome}: {count}")
         print(f"✅ 成功请求: {success_count}")
         print(f"📈 成功率: {success_rate:.1f}%")
-        
-        # 显示文件信息
-        file_size = os.path.getsize('api.log')
-        print(f"💾 日志文件大小: {file_size / 1024:.1f} KB")
-        
-        # 显示最近的请求
-        recent_requests = []
-        for line in reversed(lines):
-            if "开始处理代码执行请求" in line:
-                time_str = line.split(' - ')[0]
-                recent_requests.append(time_str)
-                if len(recent_requests) >= 5:
-                    break
-        
-        if recent_requests:
-            print(f"\n🕒 最近5次请求时间:")
-            for req_time in recent_requests:
-                print(f"   {req_time}")
+        unfinished = len(open_requests) + dropped_open
+        if unfinished:
+            print(f"⏳ 没有结束记录的请求: {unfinished}")
+        
+        if latency.count:
+            print(f"\n⏱️  请求耗时 (共{latency.count}个):")
+            print(f"   {'':<12}{'p50':>10}{'p90':>10}{'p99':>10}{'最大':>10}")
+            rows = [('全部', latency), ('ok', ok_latency)]
+            rows.extend(sorted(phase_latency.items()))
+            for name, sketch in rows:
+                if not sketch.count:
+                    continue
+                values = [sketch.quantile(q) for q in (0.5, 0.9, 0.99)] + [sketch.max]
+                print(f"   {name:<12}" + ''.join(f"{value:>10.3f}" for value in values))
+        
+        if per_minute:
+            minutes = sorted(per_minute)
+            counts = [per_minute[minute][0] for minute in minutes]
+            peak = max(counts)
+            peak_minute = minutes[counts.index(peak)]
+            print(f"\n🚦 吞吐量: 平均 {sum(counts) / len(minutes):.1f} 请求/分钟（有请求的{len(minutes)}分钟）, "
+                  f"峰值 {peak} 请求/分钟 ({peak_minute})")
+            
+            # 按时间分为若干区间显示请求数和错误率
+            step = max(1, -(-len(minutes) // TIMELINE_ROWS))
+            print(f"\n📉 错误率变化 (每行合并{step}个有请求的分钟):")
+            for i in range(0, len(minutes), step):
+                chunk = minutes[i:i + step]
+                done = sum(per_minute[minute][0] for minute in chunk)
+                errors = sum(per_minute[minute][1] for minute in chunk)
+                rate = errors / done * 100 if done else 0
+                bar = '█' * round(rate / 5)
+                print(f"   {chunk[0]} ~ {chunk[-1][11:]}  请求 {done:>6}  失败 {errors:>5}  {rate:5.1f}% {bar}")
+        
+        if slowest:
+            print(f"\n🐢 最慢的{len(slowest)}个请求:")
+            for duration, request_id, timestamp in sorted(slowest, reverse=True):
+                print(f"   {_format_seconds(duration):>10}  {request_id}  {timestamp}")
                 
     except Exception as e:
         print(f"❌ 获取日志统计失败: {e}")
 
-def monitor_logs_realtime():
-    """实时监控日志"""
+def monitor_logs_realtime(level=None, request_id=None):
+    """
+    实时监控日志
+    Linux上通过inotify等待写入，新日志立即输出；文件被轮转或清空后自动切换到新文件
+    """
     if not os.path.exists('api.log'):
         print("❌ 日志文件 api.log 不存在")
         return
     
-    print("🔍 开始实时监控日志 (按 Ctrl+C 停止)...")
+    log_filter = LogFilter(level=level, request_id=request_id) if level or request_id else None
+    follower = LogFollower('api.log', on_reopen=lambda reason: print(f"🔄 {reason}，继续监控新文件"))
+    
+    mode = "inotify" if follower.mode == 'inotify' else "轮询"
+    print(f"🔍 开始实时监控日志（{mode}，按 Ctrl+C 停止）...")
+    if log_filter is not None:
+        conditions = [f"级别={log_filter.level}"] if level else []
+        if request_id:
+            conditions.append(f"请求ID={request_id}")
+        print(f"🔎 过滤条件: {', '.join(conditions)}")
     print("=" * 80)
     
     try:
-        # 获取当前文件大小
-        current_size = os.path.getsize('api.log')
-        
-        while True:
-            time.sleep(1)
-            
-            # 检查文件是否有新内容
-            new_size = os.path.getsize('api.log')
-            if new_size > current_size:
-                # 读取新增的内容
-                with open('api.log', 'r', encoding='utf-8') as f:
-                    f.seek(current_size)
-                    new_content = f.read()
-                    if new_content.strip():
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] {new_content.strip()}")
-                
-                current_size = new_size
-                
+        for raw in follower.lines():
+            if log_filter is not None and not log_filter.matches(raw):
+                continue
+            print(raw.decode('utf-8', errors='replace'), flush=True)
     except KeyboardInterrupt:
         print("\n⏹️ 停止实时监控")
 
@@ -283,6 +412,7 @@ def main():
     parser.add_argument('--keyword', '-k', type=str, help='搜索关键词')
     parser.add_argument('--level', '-v', type=str, choices=['info', 'warning', 'error'], help='日志级别')
     parser.add_argument('--hours', '-t', type=int, default=24, help='时间范围（小时）')
+    parser.add_argument('--request-id', '-r', type=str, help='请求ID（前缀匹配，用于monitor）')
     
     args = parser.parse_args()
     
@@ -303,7 +433,7 @@ def main():
     elif args.action == 'stats':
         get_log_statistics()
     elif args.action == 'monitor':
-        monitor_logs_realtime()
+        monitor_logs_realtime(args.level, args.request_id)
     elif args.action == 'clear':
         confirm = input("⚠️ 确定要清空所有日志吗？(y/N): ")
         if confirm.lower() == 'y':
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动预热
+服务启动时一次性完成重量级的导入和初始化，并记录各阶段耗时，第一个请求不再承担这些开销：
+- 导入numpy、matplotlib（Agg后端）、pyplot和PIL，以及执行代码的runner模块
+- 字体：查找常用的中文字体，matplotlib的字体列表缓存写入固定目录，重启后不再重新扫描系统字体
+- 样式：预先读取配置的matplotlib样式
+- 按配置预导入seaborn等可选库，用户代码第一次导入时直接从sys.modules返回
+- 可选的试渲染：按正常请求的流程执行一段绘图代码并编码为PNG
+
+API进程在启动时调用一次；fork方式启动的执行进程直接继承预热结果，工作进程中再次调用时各步骤几乎不耗时
+"""
+
+import importlib
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# 试渲染的代码，覆盖折线、散点、文字和图例等常用的绘图路径
+WARMUP_CODE = """
+x = np.linspace(0, 10, 50)
+fig, ax = plt.subplots(figsize=(4, 3))
+ax.plot(x, np.sin(x), label='sin')
+ax.scatter(x, np.cos(x), s=5, label='cos')
+ax.set_title('warm up')
+ax.legend()
+"""
+
+
+def configure_cache_dir(directory):
+    """
+    指定matplotlib的配置和缓存目录（MPLCONFIGDIR），字体列表缓存保存在其中
+
+    必须在导入matplotlib之前调用；已经设置了MPLCONFIGDIR环境变量时保持不变
+    """
+    if not directory or 'MPLCONFIGDIR' in os.environ:
+        return
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    os.environ['MPLCONFIGDIR'] = directory
+
+
+def _split(value):
+    """逗号分隔的配置项转换为列表"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [item.strip() for item in value if item.strip()]
+
+
+def _import_libraries():
+    """导入重量级的库；导入pyplot时加载字体列表缓存，缓存不存在时扫描系统字体并写入缓存"""
+    import numpy  # noqa: F401
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401
+    from PIL import Image  # noqa: F401
+    import runner  # noqa: F401
+
+
+def _warm_fonts(families):
+    """查找字体并缓存结果，返回系统中不存在的字体"""
+    from matplotlib import font_manager
+
+    available = {font.name for font in font_manager.fontManager.ttflist}
+    missing = []
+    for family in families:
+        if family not in available and family not in font_manager.font_family_aliases:
+            missing.append(family)
+            continue
+        font_manager.findfont(font_manager.FontProperties(family=family))
+    return missing
+
+
+def _warm_styles(styles):
+    """读取样式文件，返回不存在的样式"""
+    import matplotlib.style
+
+    missing = []
+    for style in styles:
+        try:
+            with matplotlib.style.context(style):
+                pass
+        except (OSError, ValueError):
+            missing.append(style)
+    return missing
+
+
+def _preload_modules(modules):
+    """预导入可选库，返回导入失败的库"""
+    failed = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.warning("预导入 %s 失败: %s", name, e)
+            failed.append(name)
+    return failed
+
+
+def _render():
+    """按正常请求的流程执行试渲染代码"""
+    import runner
+    from output_format import build_render_options
+
+    result = runner.run_job({'code': WARMUP_CODE, 'render': build_render_options()})
+    if result['status'] != 'ok':
+        raise RuntimeError(f"试渲染失败: {result.get('error') or result['status']}")
+
+
+def warm_up(fonts=(), styles=(), preload=(), render=True):
+    """
+    完成导入和预热
+
+    参数:
+    - fonts: 需要预先查找的字体名称（列表或逗号分隔的字符串）
+    - styles: 需要预先读取的matplotlib样式
+    - preload: 需要预导入的可选库
+    - render: 是否执行一次试渲染
+
+    返回:
+    - 预热报告 {'timings': {阶段: 秒数}, 'missing_fonts': [...], 'missing_styles': [...], 'preload_failed': [...]}
+    """
+    timings = {}
+    report = {'timings': timings}
+
+    start = time.perf_counter()
+    _import_libraries()
+    timings['imports'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report['missing_fonts'] = _warm_fonts(_split(fonts))
+    timings['fonts'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report['missing_styles'] = _warm_styles(_split(styles))
+    timings['styles'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report['preload_failed'] = _preload_modules(_split(preload))
+    timings['preload'] = time.perf_counter() - start
+
+    if render:
+        start = time.perf_counter()
+        _render()
+        timings['render'] = time.perf_counter() - start
+    return report
+
+
+def format_timings(timings):
+    """把各阶段耗时格式化为日志中的一段文本"""
+    return ", ".join(f"{phase}={seconds:.3f}s" for phase, seconds in timings.items())